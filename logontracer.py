@@ -9,8 +9,25 @@ import os
 import sys
 import re
 import argparse
+import codecs
+import collections
+import csv
 import datetime
+import hashlib
+import itertools
 import subprocess
+import time
+import multiprocessing
+import shutil
+import calendar
+import tempfile
+import mmap
+import struct
+import json
+import threading
+import base64
+import zlib
+import zipfile
 
 try:
     from lxml import etree
@@ -20,7 +37,8 @@ except ImportError:
 
 try:
     from Evtx.Evtx import Evtx
-    from Evtx.Views import evtx_file_xml_view
+    from Evtx.Views import render_root_node, render_root_node_with_subs, escape_value
+    from Evtx.Nodes import OpenStartElementNode, NormalSubstitutionNode, ConditionalSubstitutionNode, ValueNode, BXmlTypeNode
     has_evtx = True
 except ImportError:
     has_evtx = False
@@ -38,13 +56,13 @@ except ImportError:
     has_numpy = False
 
 try:
-    import changefinder
-    has_changefinder = True
+    from scipy import sparse
+    has_scipy = True
 except ImportError:
-    has_changefinder = False
+    has_scipy = False
 
 try:
-    from flask import Flask, render_template, request
+    from flask import Flask, Response, abort, render_template, request
     has_flask = True
 except ImportError:
     has_flask = False
@@ -80,12 +98,90 @@ WEB_PORT = 8080
 # Web application address
 WEB_HOST = "0.0.0.0"
 
+# Hidden Markov Model cache
+HMM_CACHE = {}
+
+# Neo4j connection of the web application, py2neo pools the connections behind it
+DB_GRAPH = None
+DB_LOCK = threading.Lock()
+
 # Check Event Id
 EVENT_ID = [4624, 4625, 4662, 4768, 4769, 4776, 4672, 4720, 4726, 4728, 4729, 4732, 4733, 4756, 4757, 4719, 5137, 5141]
 
+# Columns identifying an (ip)-[Event]->(user) edge
+EDGE_COLUMNS = ["eventid", "ipaddress", "username", "logintype", "status", "authname"]
+
+# Event Id counted in the ChangeFinder timelines
+TIMELINE_ID = [4624, 4625, 4768, 4769, 4776]
+
+# Event Id rendered and parsed by lxml, everything else is skipped by the pre-filter
+PREFILTER_ID = set(EVENT_ID + [1102])
+
+# Event Id of the log clear records, kept outside the --from/--to window
+CLEAR_ID = set([1102])
+
+# Event log XML namespace
+EVENT_NAMESPACE = "{http://schemas.microsoft.com/win/2004/08/events/event}"
+
+# PageRank iteration cap and convergence tolerance
+PAGERANK_LOOPS = 30
+PAGERANK_TOL = 1.0e-10
+
+# Event Id to Hidden Markov Model observation symbol
+HMM_ID = [4776, 4768, 4769, 4624, 4625, 4719]
+
+# Sequences decoded per Hidden Markov Model call
+HMM_BATCH = 10000
+
+# Symbols per slice of a Hidden Markov Model EM pass over the training store, and the EM iterations
+HMM_TRAIN_SIZE = 16 * 1024 * 1024
+HMM_TRAIN_ITER = 100
+
+# Files of the Hidden Markov Model training store: the symbols, the length and the key of each sequence
+HMM_STORE = [("symbols", np.int8), ("lengths", np.int32), ("keys", np.uint64)]
+
+# Poll interval and maximum delay of --watch in seconds
+WATCH_INTERVAL = 10
+WATCH_LATENCY = 60
+
+# Bytes read at once from an XML event log
+XML_READ_SIZE = 1024 * 1024
+
 # EVTX Header
 EVTX_HEADER = b"\x45\x6C\x66\x46\x69\x6C\x65\x00"
 
+# EVTX file header and chunk sizes
+EVTX_HEADER_SIZE = 0x1000
+EVTX_CHUNK_SIZE = 0x10000
+
+# EVTX record header magic
+EVTX_RECORD_MAGIC = b"\x2a\x2a\x00\x00"
+
+# Seconds from 1601-01-01 (FILETIME) to 1970-01-01
+FILETIME_EPOCH = 11644473600
+
+# Number of rows allocated at once by the event buffer
+BUFFER_CHUNK = 65536
+
+# Edge count keys, one row per edge and hour
+EDGE_KEYS = EDGE_COLUMNS + ["date", "dates"]
+
+# Record layout of the HMM input spilled to disk
+SPOOL_DTYPE = [("time", "<i8"), ("id", "<i4"), ("user", "<i4"), ("host", "<i4")]
+
+# Spool rows read at once, and the most temporary files of one on-disk sort
+SPOOL_BLOCK = 1024 * 1024
+SPOOL_FILES = 256
+
+# Normalized record columns of the parsed-event cache (name, dtype)
+RECORD_COLUMNS = [("eventid", "int32"), ("time", "int64"), ("computer", "object"), ("channel", "object"),
+                  ("recordid", "int64"), ("username", "object"), ("ipaddress", "object"), ("hostname", "object"),
+                  ("logintype", "int8"), ("status", "object"), ("authname", "object"), ("domain", "object"),
+                  ("sid", "object"), ("extra", "object"), ("extra2", "object")]
+
+# Start of the UTC record timestamps
+EPOCH = datetime.datetime(1970, 1, 1)
+
 # String Check list
 UCHECK = r"[%*+=\[\]\\/|;:\"<>?,&]"
 HCHECK = r"[*\\/|:\"<>?&]"
@@ -99,6 +195,41 @@ IPv6_PATTERN = re.compile(r"\A(::(([0-9a-f]|[1-9a-f][0-9a-f]{1,3})(:([0-9a-f]|[1
 # LogonTracer folder path
 FPATH = os.path.dirname(os.path.abspath(__file__))
 
+# Aggregates kept between --incremental runs, and the file format version
+STATE_PATH = FPATH + "/state/ingest.npz"
+STATE_VERSION = 1
+
+# Bloom filter of the record dedup, bits per --dedup-size key and hash functions
+BLOOM_BITS = 16
+BLOOM_HASHES = 7
+
+# ParseResult fields kept in a --map partial aggregate file, and the file format version
+PARTIAL_FIELDS = ["count", "username_set", "domain_set", "admins", "domains", "ntmlauth", "deletelog", "policylist",
+                  "addusers", "delusers", "addgroups", "removegroups", "sids", "hosts", "dcsync", "dcshadow",
+                  "starttime", "endtime", "checkpoints"]
+PARTIAL_VERSION = 2
+
+# Parsed-event cache folder and format version
+CACHE_PATH = FPATH + "/cache"
+CACHE_VERSION = 4
+
+# Result cache of the graph query API: entries and seconds to live
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_TTL = 600
+
+# Graph elements of a query API page: edges by default and the hard cap
+QUERY_PAGE_SIZE = 500
+QUERY_PAGE_MAX = 5000
+
+# Timeline resolutions, days and weeks starting on Monday roll up the hours
+TIMELINE_RESOLUTIONS = ["hour", "day", "week"]
+
+# Buckets of the timeline API before it switches to the next coarser resolution
+TIMELINE_BUCKETS = 500
+
+# Touched at the end of every ingest, drops the cached query results
+INGEST_STAMP = FPATH + "/state/ingest.stamp"
+
 # CategoryId
 CATEGORY_IDs = {
     "%%8280": "Account_Logon",
@@ -166,6 +297,20 @@ AUDITING_CONSTANTS = {
     "{0cce9242-69ae-11d9-bed3-505054503030}": "KerbCredentialValidation",
     "{0cce9243-69ae-11d9-bed3-505054503030}": "NPS"}
 
+# lxml parser and XPath expressions shared by all records
+if has_lxml:
+    XML_PARSER = etree.XMLParser(resolve_entities=False)
+    XPATH_EVENTID = etree.XPath("System/EventID")
+    XPATH_TIMECREATED = etree.XPath("System/TimeCreated")
+    XPATH_EVENTDATA = etree.XPath("EventData/Data")
+    XPATH_COMPUTER = etree.XPath("System/Computer")
+    XPATH_CHANNEL = etree.XPath("System/Channel")
+    XPATH_RECORDID = etree.XPath("System/EventRecordID")
+    XPATH_CLEARED_USER = etree.XPath("UserData/ns:LogFileCleared/ns:SubjectUserName",
+                                     namespaces={"ns": "http://manifests.microsoft.com/win/2004/08/windows/eventlog"})
+    XPATH_CLEARED_DOMAIN = etree.XPath("UserData/ns:LogFileCleared/ns:SubjectDomainName",
+                                       namespaces={"ns": "http://manifests.microsoft.com/win/2004/08/windows/eventlog"})
+
 # Flask instance
 if not has_flask:
     sys.exit("[!] Flask must be installed for this script.")
@@ -197,64 +342,237 @@ parser.add_argument("-f", "--from", dest="fromdate", action="store", type=str, m
                     help="Parse Security Event log from this time. (for example: 20170101000000)")
 parser.add_argument("-t", "--to", dest="todate", action="store", type=str, metavar="DATE",
                     help="Parse Security Event log to this time. (for example: 20170228235959)")
+parser.add_argument("-w", "--workers", dest="workers", action="store", type=int, metavar="N", default=1,
+                    help="Number of processes used to parse the event logs. (default: 1)")
+parser.add_argument("--batch", dest="batch", action="store", type=int, metavar="N", default=10000,
+                    help="Number of rows sent to Neo4j in one transaction. (default: 10000)")
+parser.add_argument("--export-csv", dest="export_csv", action="store", type=str, metavar="DIR",
+                    help="Write the graph data to neo4j-admin import CSV files in this directory instead of Neo4j.")
+parser.add_argument("--watch", dest="watch", action="store", type=str, metavar="DIR",
+                    help="Watch this directory and add new or growing EVTX/XML files to the graph incrementally.")
+parser.add_argument("--incremental", action="store_true", default=False,
+                    help="Add only the records newer than the last ones ingested for each computer and channel to the existing graph. (default: False)")
+parser.add_argument("--map", dest="map", action="store", type=str, metavar="FILE",
+                    help="Parse the event logs and write their partial aggregates to this file instead of Neo4j.")
+parser.add_argument("--reduce", dest="reduce", nargs="*", action="store", type=str, metavar="FILE",
+                    help="Combine the partial aggregate files written by --map runs and create the graph.")
+parser.add_argument("--dedup-size", dest="dedup_size", action="store", type=int, metavar="N", default=10000000,
+                    help="Drop the records seen twice by (Computer, Channel, EventRecordID), exactly up to N records and with a Bloom filter beyond. 0 disables the dedup. (default: 10000000)")
+parser.add_argument("--cache-size", dest="cache_size", action="store", type=int, metavar="MB", default=4096,
+                    help="Size limit of the parsed-event cache, 0 disables the cache. (default: 4096)")
+parser.add_argument("--summary-top", dest="summary_top", action="store", type=int, metavar="N", default=200,
+                    help="Keep the N top ranked users and hosts in full detail in the summary graph and collapse the other hosts. 0 disables the summary. (default: 200)")
 parser.add_argument("--delete", action="store_true", default=False,
                     help="Delete all nodes and relationships from this Neo4j database. (default: False)")
 args = parser.parse_args()
 
 statement_user = """
-  MERGE (user:Username{ user:{user} }) set user.rights={rights}, user.sid={sid}, user.rank={rank}, user.status={status}, user.counts={counts}, user.counts4624={counts4624}, user.counts4625={counts4625}, user.counts4768={counts4768}, user.counts4769={counts4769}, user.counts4776={counts4776}, user.detect={detect}
-  RETURN user
+  UNWIND {rows} AS row
+  MERGE (user:Username{ user:row.user }) set user.rights=row.rights, user.sid=row.sid, user.rank=row.rank, user.distance=row.distance, user.nexthop=row.nexthop, user.status=row.status, user.timeline_hour=row.timeline_hour, user.timeline_day=row.timeline_day, user.timeline_week=row.timeline_week
   """
 
 statement_ip = """
-  MERGE (ip:IPAddress{ IP:{IP} }) set ip.rank={rank}, ip.hostname={hostname}
-  RETURN ip
+  UNWIND {rows} AS row
+  MERGE (ip:IPAddress{ IP:row.IP }) set ip.rank=row.rank, ip.hostname=row.hostname, ip.group=row.group, ip.distance=row.distance, ip.nexthop=row.nexthop
   """
 
+statement_aggregate = """
+  UNWIND {rows} AS row
+  MERGE (agg:Aggregate{ name:row.name }) set agg.kind=row.kind, agg.hosts=row.hosts, agg.rank=row.rank
+  """
+
+statement_summary = """
+  UNWIND {rows} AS row
+  MATCH (user:Username{ user:row.user })
+  MATCH (ip:IPAddress{ IP:row.IP })
+  CREATE (ip)-[summary:Summary]->(user) set summary.count=row.count
+  """
+
+statement_summary_aggregate = """
+  UNWIND {rows} AS row
+  MATCH (user:Username{ user:row.user })
+  MATCH (agg:Aggregate{ name:row.IP })
+  CREATE (agg)-[summary:Summary]->(user) set summary.count=row.count
+  """
+
+# The summary graph is built again by every ingest
+statement_summary_clear = ["MATCH ()-[summary:Summary]->() DELETE summary",
+                           "MATCH (agg:Aggregate) DELETE agg"]
+
 statement_r = """
-  MATCH (user:Username{ user:{user} })
-  MATCH (ip:IPAddress{ IP:{IP} })
-  CREATE (ip)-[event:Event]->(user) set event.id={id}, event.logintype={logintype}, event.status={status}, event.count={count}, event.authname={authname}, event.date={date}
+  UNWIND {rows} AS row
+  MATCH (user:Username{ user:row.user })
+  MATCH (ip:IPAddress{ IP:row.IP })
+  CREATE (ip)-[event:Event]->(user) set event.id=row.id, event.logintype=row.logintype, event.status=row.status, event.count=row.count, event.authname=row.authname, event.date=row.date
+  """
 
-  RETURN user, ip
+# --incremental adds the new counts to the count of the last finished run, kept in event.base,
+# so writing the rows of an unfinished run again does not count them twice
+statement_r_add = """
+  UNWIND {rows} AS row
+  MATCH (user:Username{ user:row.user })
+  MATCH (ip:IPAddress{ IP:row.IP })
+  MERGE (ip)-[event:Event{ id:row.id, logintype:row.logintype, status:row.status, authname:row.authname, date:row.date }]->(user)
+  ON CREATE SET event.base=0
+  ON MATCH SET event.base=CASE WHEN event.ingest=row.ingest THEN event.base ELSE event.count END
+  SET event.count=event.base+row.count, event.ingest=row.ingest
   """
 
+# Links moved to the IP address of a host are left with no count, and a host name node with no links is removed
+statement_r_clear = ["UNWIND {hosts} AS host MATCH (ip:IPAddress{ IP:host })-[event:Event]->() WHERE event.count=0 DELETE event",
+                     "UNWIND {hosts} AS host MATCH (ip:IPAddress{ IP:host }) WHERE NOT (ip)--() DELETE ip"]
+
 statement_date = """
-  MERGE (date:Date{ date:{Daterange} }) set date.start={start}, date.end={end}
-  RETURN date
+  UNWIND {rows} AS row
+  MERGE (date:Date{ date:row.Daterange }) set date.start=row.start, date.end=row.end
   """
 
 statement_domain = """
-  MERGE (domain:Domain{ domain:{domain} })
-  RETURN domain
+  UNWIND {rows} AS row
+  MERGE (domain:Domain{ domain:row.domain })
   """
 
 statement_dr = """
-  MATCH (domain:Domain{ domain:{domain} })
-  MATCH (user:Username{ user:{user} })
+  UNWIND {rows} AS row
+  MATCH (domain:Domain{ domain:row.domain })
+  MATCH (user:Username{ user:row.user })
   CREATE (user)-[group:Group]->(domain)
+  """
 
-  RETURN user, domain
+statement_dr_add = """
+  UNWIND {rows} AS row
+  MATCH (domain:Domain{ domain:row.domain })
+  MATCH (user:Username{ user:row.user })
+  MERGE (user)-[group:Group]->(domain)
   """
 
 statement_del = """
-  MERGE (date:Deletetime{ date:{deletetime} }) set date.user={user}, date.domain={domain}
-  RETURN date
+  UNWIND {rows} AS row
+  MERGE (date:Deletetime{ date:row.deletetime }) set date.user=row.user, date.domain=row.domain
   """
 
 statement_pl = """
-  MERGE (id:ID{ id:{id} }) set id.changetime={changetime}, id.category={category}, id.sub={sub}
-  RETURN id
+  UNWIND {rows} AS row
+  MERGE (id:ID{ id:row.id }) set id.changetime=row.changetime, id.category=row.category, id.sub=row.sub
   """
 
 statement_pr = """
-  MATCH (id:ID{ id:{id} })
-  MATCH (user:Username{ user:{user} })
-  CREATE (user)-[group:Policy]->(id) set group.date={date}
+  UNWIND {rows} AS row
+  MATCH (id:ID{ id:row.id })
+  MATCH (user:Username{ user:row.user })
+  CREATE (user)-[group:Policy]->(id) set group.date=row.date
+  """
+
+statement_pr_add = """
+  UNWIND {rows} AS row
+  MATCH (id:ID{ id:row.id })
+  MATCH (user:Username{ user:row.user })
+  MERGE (user)-[group:Policy]->(id) set group.date=row.date
+  """
 
-  RETURN user, id
+# neo4j-admin import headers of the node files and the row keys written to them
+CSV_NODES = collections.OrderedDict([
+    ("IPAddress", [("IP:ID(IPAddress)", "IP"), ("rank:double", "rank"), ("hostname", "hostname"), ("group", "group"),
+                   ("distance:int", "distance"), ("nexthop", "nexthop")]),
+    ("Username", [("user:ID(Username)", "user"), ("rights", "rights"), ("sid", "sid"), ("rank:double", "rank"), ("distance:int", "distance"),
+                  ("nexthop", "nexthop"), ("status", "status"), ("timeline_hour", "timeline_hour"), ("timeline_day", "timeline_day"),
+                  ("timeline_week", "timeline_week")]),
+    ("Domain", [("domain:ID(Domain)", "domain")]),
+    ("Date", [("date:ID(Date)", "Daterange"), ("start", "start"), ("end", "end")]),
+    ("Deletetime", [("date:ID(Deletetime)", "deletetime"), ("user", "user"), ("domain", "domain")]),
+    ("ID", [(":ID(ID)", "id"), ("id:int", "id"), ("changetime", "changetime"), ("category", "category"), ("sub", "sub")]),
+    ("Aggregate", [("name:ID(Aggregate)", "name"), ("kind", "kind"), ("hosts:int", "hosts"), ("rank:double", "rank")]),
+])
+
+# neo4j-admin import headers of the relationship files and the row keys written to them
+CSV_RELATIONSHIPS = collections.OrderedDict([
+    ("Event", [(":START_ID(IPAddress)", "IP"), (":END_ID(Username)", "user"), ("id:int", "id"), ("logintype:int", "logintype"),
+               ("status", "status"), ("count:int", "count"), ("authname", "authname"), ("date:long", "date")]),
+    ("Group", [(":START_ID(Username)", "user"), (":END_ID(Domain)", "domain")]),
+    ("Policy", [(":START_ID(Username)", "user"), (":END_ID(ID)", "id"), ("date:long", "date")]),
+    ("Summary", [(":START_ID(IPAddress)", "IP"), (":END_ID(Username)", "user"), ("count:int", "count")]),
+])
+
+# Indexes used by the MATCH lookups of the bulk loader
+statement_index = ["CREATE INDEX ON :Username(user)",
+                   "CREATE INDEX ON :IPAddress(IP)",
+                   "CREATE INDEX ON :Domain(domain)",
+                   "CREATE INDEX ON :ID(id)",
+                   "CREATE INDEX ON :Aggregate(name)",
+                   "CREATE INDEX ON :IPAddress(group)"]
+
+# Graph patterns of the query API
+QUERY_PATTERNS = {
+    "Event": "MATCH (ip:IPAddress)-[event:Event]->(user:Username)",
+    "Group": "MATCH (user:Username)-[event:Group]->(ip:Domain)",
+    "Policy": "MATCH (user:Username)-[event:Policy]->(ip:ID)",
+    "Summary": "MATCH (ip)-[event:Summary]->(user:Username)",
+    "Path": "UNWIND {pairs} AS pair MATCH (ip:IPAddress{ IP:pair.IP })-[event:Event]->(user:Username{ user:pair.user })",
+}
+
+# Built-in views of the web application: pattern, condition and whether the Event ID/count and date filters apply
+QUERY_VIEWS = {
+    "all": ("Event", None, True, True),
+    "system": ("Event", "user.rights = 'system'", True, True),
+    "rdp": ("Event", "event.logintype = 10", True, True),
+    "network": ("Event", "event.logintype = 3", True, True),
+    "batch": ("Event", "event.logintype = 4", True, True),
+    "service": ("Event", "event.logintype = 5", True, True),
+    "ms14068": ("Event", "event.status =~ '.*0F' AND event.id = 4769", False, True),
+    "failed": ("Event", "event.id = 4625", False, True),
+    "ntlm": ("Event", "event.id = 4624 AND event.authname = 'NTLM' AND event.logintype = 3", False, True),
+    "adddel": ("Event", "user.status =~ 'Created.*' OR user.status =~ '.*Deleted.*' OR user.status =~ '.*RemoveGroup.*' OR user.status =~ '.*AddGroup.*'", False, True),
+    "dcs": ("Event", "user.status =~ '.*DCSync.*' OR user.status =~ '.*DCShadow.*'", False, True),
+    "domain": ("Group", None, False, False),
+    "policy": ("Policy", None, False, True),
+    "summary": ("Summary", None, False, False),
+}
+
+# Node properties matched by the search of the query API
+QUERY_FIELDS = {"Username": "user.user", "IPAddress": "ip.IP", "Hostname": "ip.hostname"}
+
+statement_query = """
+  {match} {where}
+  WITH user, event, ip, coalesce(user.rank, 0.0) AS rank {after}
+  RETURN id(user) AS user_id, labels(user)[0] AS user_label, properties(user) AS user,
+         id(event) AS event_id, type(event) AS event_type, properties(event) AS event,
+         id(ip) AS ip_id, labels(ip)[0] AS ip_label, properties(ip) AS ip, rank
+  ORDER BY rank DESC, event_id
+  LIMIT {limit}
   """
 
+statement_event_count = "MATCH ()-[event:Event]->() RETURN count(event)"
+
+statement_timeline_range = "MATCH (date:Date) RETURN date.start AS start, date.end AS end"
+
+statement_deletetime = "MATCH (date:Deletetime) RETURN date.date AS date, date.domain AS domain, date.user AS user"
+
+# Users and hosts in PageRank order
+statement_rank = {
+    "user": "MATCH (node:Username) RETURN node.user AS name, node.rank AS rank ORDER BY node.rank DESC SKIP {skip} LIMIT {limit}",
+    "host": "MATCH (node:IPAddress) RETURN node.IP AS name, node.rank AS rank ORDER BY node.rank DESC SKIP {skip} LIMIT {limit}",
+}
+
+statement_export = """
+  MATCH (user:Username)-[event:Event]-(ip:IPAddress)
+  RETURN user.user AS user, ip.IP AS IP, event.id AS id, event.logintype AS logintype, event.status AS status,
+         event.count AS count, event.authname AS authname
+  """
+
+statement_timeline = """
+  MATCH (user:Username) {where}
+  RETURN user.user AS user, user.rights AS rights, user.timeline_{resolution} AS timeline
+  """
+
+# Next hop of a node on its shortest path to an admin user
+statement_nexthop = {
+    "Username": "MATCH (node:Username{ user:{name} }) RETURN node.distance AS distance, node.nexthop AS nexthop",
+    "IPAddress": "MATCH (node:IPAddress{ IP:{name} }) RETURN node.distance AS distance, node.nexthop AS nexthop",
+}
+
+# Continue a page of the query API after the rank and event id of the cursor
+statement_query_after = "WHERE rank < {rank} OR (rank = {rank} AND id(event) > {event})"
+
 if args.user:
     NEO4J_USER = args.user
 
@@ -273,13 +591,13 @@ if args.host:
 # Web application index.html
 @app.route('/')
 def index():
-    return render_template("index.html", server_ip=NEO4J_SERVER, neo4j_password=NEO4J_PASSWORD, neo4j_user=NEO4J_USER)
+    return render_template("index.html")
 
 
 # Timeline view
 @app.route('/timeline')
 def timeline():
-    return render_template("timeline.html", server_ip=NEO4J_SERVER, neo4j_password=NEO4J_PASSWORD, neo4j_user=NEO4J_USER)
+    return render_template("timeline.html")
 
 
 # Web application logs
@@ -323,8 +641,13 @@ def do_upload():
             return "FAIL"
         if not re.search(r"\A-{0,1}[0-9]{1,2}\Z", timezone):
             return "FAIL"
+        # replace the graph unless the upload asks to add to it
+        if request.form.get("incremental") == "true":
+            loadoption = " --incremental"
+        else:
+            loadoption = " --delete"
 
-        parse_command = "nohup python3 " + FPATH + "/logontracer.py --delete -z " + timezone + logoption + filelist + " -u " + NEO4J_USER + " -p " + NEO4J_PASSWORD + " >  " + FPATH + "/static/logontracer.log 2>&1 &"
+        parse_command = "nohup python3 " + FPATH + "/logontracer.py" + loadoption + " -z " + timezone + logoption + filelist + " -u " + NEO4J_USER + " -p " + NEO4J_PASSWORD + " >  " + FPATH + "/static/logontracer.log 2>&1 &"
         subprocess.call("rm -f " + FPATH + "/static/logontracer.log > /dev/null", shell=True)
         subprocess.call(parse_command, shell=True)
         # parse_evtx(filename)
@@ -334,253 +657,2082 @@ def do_upload():
         return "FAIL"
 
 
+# LRU cache of the query API results, cleared when an ingest finished
+class QueryCache(object):
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.loading = {}
+        self.stamp = None
+        self.lock = threading.Lock()
+
+    def check_stamp(self):
+        try:
+            stamp = os.stat(INGEST_STAMP).st_mtime
+        except OSError:
+            stamp = None
+        if stamp != self.stamp:
+            self.entries.clear()
+            self.stamp = stamp
+
+    def lookup(self, key):
+        with self.lock:
+            self.check_stamp()
+            if key in self.entries:
+                value, expires = self.entries[key]
+                if expires > time.time():
+                    self.entries.move_to_end(key)
+                    return value
+                del self.entries[key]
+        return None
+
+    def current(self):
+        with self.lock:
+            return self.stamp
+
+    # results loaded before an ingest finished are not stored
+    def store(self, key, value, stamp):
+        with self.lock:
+            self.check_stamp()
+            if self.stamp == stamp:
+                self.entries[key] = (value, time.time() + self.ttl)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+
+    def fetch(self, key, load):
+        value = self.lookup(key)
+        if value is not None:
+            return value
+        with self.lock:
+            stamp = self.stamp
+            pending = self.loading.setdefault(key, threading.Lock())
+        # concurrent requests for the same result wait for the first one, a failed load releases them
+        try:
+            with pending:
+                value = self.lookup(key)
+                if value is None:
+                    value = load()
+                    self.store(key, value, stamp)
+        finally:
+            with self.lock:
+                if self.loading.get(key) is pending:
+                    del self.loading[key]
+        return value
+
+
+QUERY_CACHE = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+
+# Neo4j connection shared by the request threads
+def graph_connection():
+    global DB_GRAPH
+    with DB_LOCK:
+        if DB_GRAPH is None:
+            graph_http = "http://" + NEO4J_USER + ":" + NEO4J_PASSWORD + "@" + NEO4J_SERVER + ":" + NEO4J_PORT + "/db/data/"
+            DB_GRAPH = Graph(graph_http)
+    return DB_GRAPH
+
+
+# Graph elements of a query API page: the nodes of an edge the first time they appear on the page,
+# the edge, and the cursor of the next page (None on the last page) at the end
+def page_elements(cursor, limit):
+    nodes = set()
+    last = None
+    for i, record in enumerate(cursor):
+        if i == limit:
+            yield ["cursor", "%r:%i" % last]
+            return
+        for name in ["user", "ip"]:
+            if record[name + "_id"] not in nodes:
+                nodes.add(record[name + "_id"])
+                yield ["node", record[name + "_id"], record[name + "_label"], record[name]]
+        yield ["edge", record["event_id"], record["event_type"], record["user_id"], record["ip_id"], record["event"]]
+        last = (record["rank"], record["event_id"])
+    yield ["cursor", None]
+
+
+# Encode a query API page as one JSON object
+def json_page(cursor, limit):
+    page = {"nodes": [], "edges": [], "cursor": None}
+    for element in page_elements(cursor, limit):
+        if element[0] == "cursor":
+            page["cursor"] = element[1]
+        else:
+            page[element[0] + "s"].append(element[1:])
+    return json.dumps(page, separators=(",", ":"))
+
+
+# Stream a query API page as newline-delimited JSON and cache it when it is complete
+def ndjson_page(key, cursor, limit, stamp):
+    lines = []
+    for element in page_elements(cursor, limit):
+        lines.append(json.dumps(element, separators=(",", ":")) + "\n")
+        yield lines[-1]
+    QUERY_CACHE.store(key, "".join(lines), stamp)
+
+
+# Add the Event ID, count and date filters and the page of the request and answer from the cache
+def graph_response(pattern, conditions, parameters, use_ids, use_dates):
+    try:
+        if use_ids and request.args.get("ids") is not None:
+            parameters["ids"] = [int(eid) for eid in request.args["ids"].split(",") if eid]
+            conditions.append("event.id IN {ids}")
+        if use_ids and request.args.get("count"):
+            parameters["count"] = int(request.args["count"])
+            conditions.append("event.count > {count}")
+        if use_dates and request.args.get("from"):
+            parameters["fromdate"] = float(request.args["from"])
+            conditions.append("event.date >= {fromdate}")
+        if use_dates and request.args.get("to"):
+            parameters["todate"] = float(request.args["to"])
+            conditions.append("event.date <= {todate}")
+        limit = min(int(request.args.get("limit", QUERY_PAGE_SIZE)), QUERY_PAGE_MAX)
+        after = ""
+        if request.args.get("cursor"):
+            rank, event = request.args["cursor"].rsplit(":", 1)
+            parameters["rank"] = float(rank)
+            parameters["event"] = int(event)
+            after = statement_query_after
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+
+    where = ""
+    if conditions:
+        where = "WHERE " + " AND ".join(conditions)
+    # one more row tells whether a next page exists
+    statement = statement_query.format(match=QUERY_PATTERNS[pattern], where=where, after=after, limit=limit + 1)
+    ndjson = request.args.get("format") == "ndjson"
+    key = (statement, json.dumps(parameters, sort_keys=True), ndjson)
+    try:
+        if ndjson:
+            body = QUERY_CACHE.lookup(key)
+            if body is None:
+                stamp = QUERY_CACHE.current()
+                body = ndjson_page(key, graph_connection().run(statement, parameters), limit, stamp)
+        else:
+            body = QUERY_CACHE.fetch(key, lambda: json_page(graph_connection().run(statement, parameters), limit))
+    except Exception as e:
+        return Response(json.dumps({"error": str(e)}), status=500, mimetype="application/json")
+    if ndjson:
+        return Response(body, mimetype="application/x-ndjson")
+    return Response(body, mimetype="application/json")
+
+
+# Graph query API of the built-in views
+@app.route("/api/graph/<view>")
+def graph_view(view):
+    if view not in QUERY_VIEWS:
+        abort(404)
+    pattern, condition, use_ids, use_dates = QUERY_VIEWS[view]
+    conditions = []
+    if condition:
+        conditions.append("(" + condition + ")")
+    return graph_response(pattern, conditions, {}, use_ids, use_dates)
+
+
+# Follow the next hops stored at ingest from a user to the nearest admin user, as (user, host) pairs
+def admin_path(name):
+    graph = graph_connection()
+    pairs = []
+    label = "Username"
+    steps = None
+    while steps is None or len(pairs) < steps:
+        record = next(iter(graph.run(statement_nexthop[label], {"name": name})), None)
+        if record is None or record["distance"] is None or record["distance"] <= 0:
+            break
+        if steps is None:
+            steps = record["distance"]
+        if label == "Username":
+            pairs.append({"user": name, "IP": record["nexthop"]})
+            label = "IPAddress"
+        else:
+            pairs.append({"user": record["nexthop"], "IP": name})
+            label = "Username"
+        name = record["nexthop"]
+    return pairs
+
+
+# Graph query API of the shortest path from a user to an admin user
+@app.route("/api/path")
+def graph_path():
+    if not request.args.get("user"):
+        abort(400)
+    try:
+        pairs = QUERY_CACHE.fetch(("path", request.args["user"]), lambda: admin_path(request.args["user"]))
+    except Exception as e:
+        return Response(json.dumps({"error": str(e)}), status=500, mimetype="application/json")
+    return graph_response("Path", [], {"pairs": pairs}, False, True)
+
+
+# Graph query API of the hosts collapsed into an aggregate node of the summary graph
+@app.route("/api/expand")
+def graph_expand():
+    if not request.args.get("name"):
+        abort(400)
+    return graph_response("Event", ["ip.group = {group}"], {"group": request.args["name"]}, True, True)
+
+
+# Graph query API of the username, IP address, hostname and domain searches
+@app.route("/api/search")
+def graph_search():
+    fields = request.args.getlist("field")
+    values = request.args.getlist("value")
+    rules = request.args.getlist("rule")
+    if not values or len(fields) != len(values) or len(rules) != len(values) - 1:
+        abort(400)
+    if request.args.get("exact") == "1":
+        operator = " = "
+    else:
+        operator = " =~ "
+
+    if fields == ["Domain"]:
+        return graph_response("Group", ["ip.domain" + operator + "{value0}"], {"value0": values[0]}, False, False)
+
+    where = ""
+    parameters = {}
+    for i, (field, value) in enumerate(zip(fields, values)):
+        if field not in QUERY_FIELDS:
+            abort(400)
+        if i:
+            if rules[i - 1] not in ["AND", "OR"]:
+                abort(400)
+            where += " " + rules[i - 1] + " "
+        where += QUERY_FIELDS[field] + operator + "{value%i}" % i
+        parameters["value%i" % i] = value
+    return graph_response("Event", ["(" + where + ")"], parameters, True, True)
+
+
+# Epoch hour of a date of the timeline API
+def parse_hour(value):
+    for date_format in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            return calendar.timegm(datetime.datetime.strptime(value, date_format).timetuple()) // 3600
+        except ValueError:
+            pass
+    raise ValueError("invalid date " + value)
+
+
+# Timelines of the matching users in a window, at the finest resolution that keeps it under TIMELINE_BUCKETS buckets
+def load_timeline(patterns, first, last, resolution):
+    graph = graph_connection()
+    record = next(iter(graph.run(statement_timeline_range)), None)
+    if record is None:
+        return json.dumps({"resolution": resolution, "start": None, "buckets": 0, "users": []})
+    if first is None:
+        first = parse_hour(record["start"])
+    if last is None:
+        last = parse_hour(record["end"])
+    if resolution == "auto":
+        for resolution in TIMELINE_RESOLUTIONS:
+            if timeline_bucket(last, resolution) - timeline_bucket(first, resolution) < TIMELINE_BUCKETS:
+                break
+    first = timeline_bucket(first, resolution)
+    last = timeline_bucket(last, resolution)
+
+    where = ""
+    parameters = {}
+    if patterns:
+        where = "WHERE " + " OR ".join("user.user =~ {user%i}" % i for i in range(len(patterns)))
+        parameters = {"user%i" % i: pattern for i, pattern in enumerate(patterns)}
+    users = []
+    if last >= first:
+        for record in graph.run(statement_timeline.format(where=where, resolution=resolution), parameters):
+            if record["timeline"] is None:
+                continue
+            counts, scores = unpack_timeline(record["timeline"], first, last)
+            users.append([record["user"], record["rights"], counts.tolist(), scores.tolist()])
+    start = EPOCH + datetime.timedelta(hours=bucket_hour(first, resolution))
+    return json.dumps({"resolution": resolution, "start": start.strftime("%Y-%m-%d %H:%M:%S"), "buckets": max(last - first + 1, 0),
+                       "users": users}, separators=(",", ":"))
+
+
+# Timeline API: event counts per TIMELINE_ID and anomaly scores of the users in a window
+@app.route("/api/timeline")
+def timeline_window():
+    try:
+        first = None
+        last = None
+        if request.args.get("from"):
+            first = parse_hour(request.args["from"])
+        if request.args.get("to"):
+            last = parse_hour(request.args["to"])
+    except ValueError:
+        abort(400)
+    resolution = request.args.get("resolution", "auto")
+    if resolution not in TIMELINE_RESOLUTIONS + ["auto"]:
+        abort(400)
+    patterns = request.args.getlist("user")
+    key = ("timeline", tuple(patterns), first, last, resolution)
+    try:
+        body = QUERY_CACHE.fetch(key, lambda: load_timeline(patterns, first, last, resolution))
+    except Exception as e:
+        return Response(json.dumps({"error": str(e)}), status=500, mimetype="application/json")
+    return Response(body, mimetype="application/json")
+
+
+# Start and end dates of the loaded event logs
+@app.route("/api/daterange")
+def date_range():
+    try:
+        body = QUERY_CACHE.fetch("daterange", lambda: json.dumps(next(iter(graph_connection().run(statement_timeline_range).data()), {})))
+    except Exception as e:
+        return Response(json.dumps({"error": str(e)}), status=500, mimetype="application/json")
+    return Response(body, mimetype="application/json")
+
+
+# Date, domain and user of the log clear record, empty when the event log was not cleared
+@app.route("/api/deletetime")
+def delete_time():
+    try:
+        body = QUERY_CACHE.fetch("deletetime", lambda: json.dumps(next(iter(graph_connection().run(statement_deletetime).data()), {})))
+    except Exception as e:
+        return Response(json.dumps({"error": str(e)}), status=500, mimetype="application/json")
+    return Response(body, mimetype="application/json")
+
+
+# PageRank API: one page of the users or hosts as [name, rank] pairs
+@app.route("/api/rank/<kind>")
+def rank_page(kind):
+    if kind not in statement_rank:
+        abort(404)
+    try:
+        page = int(request.args.get("page", 0))
+        limit = min(int(request.args.get("limit", 10)), QUERY_PAGE_MAX)
+    except ValueError:
+        abort(400)
+    if page < 0 or limit < 1:
+        abort(400)
+    parameters = {"skip": page * limit, "limit": limit}
+    try:
+        body = QUERY_CACHE.fetch(("rank", kind, page, limit), lambda: json.dumps(
+            [[record["name"], record["rank"]] for record in graph_connection().run(statement_rank[kind], parameters)]))
+    except Exception as e:
+        return Response(json.dumps({"error": str(e)}), status=500, mimetype="application/json")
+    return Response(body, mimetype="application/json")
+
+
+# Export the logon events as CSV rows
+def export_lines(cursor):
+    yield "username,host,id,logontype,status,count,authname\r\n"
+    for record in cursor:
+        yield ",".join(str(record[name]) for name in ["user", "IP", "id", "logintype", "status", "count", "authname"]) + "\r\n"
+
+
+@app.route("/api/export.csv")
+def export_csv():
+    try:
+        cursor = graph_connection().run(statement_export)
+    except Exception as e:
+        return Response(json.dumps({"error": str(e)}), status=500, mimetype="application/json")
+    return Response(export_lines(cursor), mimetype="text/csv", headers={"Content-Disposition": "attachment; filename=image.csv"})
+
+
+# Append-only columnar buffer for parsed logon records, the strings are interned as they arrive
+# and kept as int32 codes into a vocabulary of each column, None is the code -1
+class EventBuffer(object):
+    def __init__(self, columns, chunk_size=BUFFER_CHUNK):
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.lengths = []
+        self.vocab = [{} if dtype == "object" else None for _, dtype in columns]
+
+    def __len__(self):
+        return sum(self.lengths)
+
+    def append(self, *values):
+        if not self.chunks or self.lengths[-1] == len(self.chunks[-1][0]):
+            self.chunks.append([np.empty(self.chunk_size, dtype=np.int32 if dtype == "object" else dtype) for _, dtype in self.columns])
+            self.lengths.append(0)
+        pos = self.lengths[-1]
+        for column, vocab, value in zip(self.chunks[-1], self.vocab, values):
+            if vocab is not None:
+                value = -1 if value is None else vocab.setdefault(value, len(vocab))
+            column[pos] = value
+        self.lengths[-1] = pos + 1
+
+    # Move the rows of another buffer to the end, its codes are translated to this vocabulary
+    def extend(self, other):
+        tables = [None if vocab is None else np.array([self.vocab[idx].setdefault(value, len(self.vocab[idx])) for value in vocab] + [-1], dtype=np.int32)
+                  for idx, vocab in enumerate(other.vocab)]
+        for chunk in other.chunks:
+            self.chunks.append([column if table is None else table[column] for column, table in zip(chunk, tables)])
+        self.lengths.extend(other.lengths)
+
+    # Release the unused tail of the last chunk
+    def trim(self):
+        if self.chunks and self.lengths[-1] < len(self.chunks[-1][0]):
+            self.chunks[-1] = [column[:self.lengths[-1]].copy() for column in self.chunks[-1]]
+
+    # A string column is a categorical with sorted categories, like one built from the strings
+    def column(self, name):
+        idx = [column for column, _ in self.columns].index(name)
+        parts = [chunk[idx][:length] for chunk, length in zip(self.chunks, self.lengths)]
+        values = np.concatenate(parts) if parts else np.empty(0, dtype=np.int32 if self.vocab[idx] is not None else self.columns[idx][1])
+        if self.vocab[idx] is None:
+            return values
+        categories = pd.Index(list(self.vocab[idx]), dtype=object)
+        order = categories.argsort()
+        ranks = np.empty(len(order) + 1, dtype=np.int32)
+        ranks[order] = np.arange(len(order), dtype=np.int32)
+        ranks[-1] = -1
+        return pd.Categorical.from_codes(ranks[values], categories=categories[order])
+
+    def to_frame(self):
+        return pd.DataFrame({name: self.column(name) for name, _ in self.columns}, columns=[name for name, _ in self.columns])
+
+
+# Partial result of parsing event log records, merged in log order
+class ParseResult(object):
+    def __init__(self):
+        self.count = 0
+        self.edges = None
+        self.username_set = []
+        self.domain_set = []
+        self.admins = []
+        self.domains = []
+        self.ntmlauth = []
+        self.deletelog = []
+        self.policylist = []
+        self.addusers = {}
+        self.delusers = {}
+        self.addgroups = {}
+        self.removegroups = {}
+        self.sids = {}
+        self.hosts = {}
+        self.dcsync = []
+        self.dcshadow = []
+        self.starttime = None
+        self.endtime = None
+        self.stoptime = None
+        self.checkpoints = {}
+
+    def merge(self, other):
+        self.count += other.count
+        for source, record_id in other.checkpoints.items():
+            self.checkpoints[source] = max(record_id, self.checkpoints.get(source, 0))
+        self.edges = merge_edges(self.edges, other.edges)
+        for name in ["username_set", "domain_set", "admins", "domains", "ntmlauth"]:
+            values = getattr(self, name)
+            seen = set(values)
+            values.extend([value for value in getattr(other, name) if value not in seen])
+        for name in ["deletelog", "policylist", "dcsync", "dcshadow"]:
+            getattr(self, name).extend(getattr(other, name))
+        for name in ["addusers", "delusers", "addgroups", "removegroups", "sids", "hosts"]:
+            getattr(self, name).update(getattr(other, name))
+        if other.starttime is not None and (self.starttime is None or self.starttime > other.starttime):
+            self.starttime = other.starttime
+        if other.endtime is not None and (self.endtime is None or self.endtime < other.endtime):
+            self.endtime = other.endtime
+        # the first record after --to ends the file
+        if other.stoptime is not None:
+            self.endtime = other.stoptime
+
+
+# Strings interned as int32 ids, one per distinct user, host, status or package name
+class SymbolTable(object):
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, values):
+        if isinstance(values, pd.Categorical):
+            codes, uniques = values.codes, values.categories
+        else:
+            codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        ids = np.empty(len(uniques), dtype=np.int32)
+        for i, value in enumerate(uniques):
+            if value not in self.ids:
+                self.ids[value] = len(self.names)
+                self.names.append(value)
+            ids[i] = self.ids[value]
+        return ids[codes]
+
+    def lookup(self, ids):
+        return np.array(self.names, dtype=object)[np.asarray(ids, dtype=np.int64)]
+
+    # Id translation table that maps the keys of a dict to its values
+    def remap(self, mapping):
+        keys = self.intern(list(mapping))
+        values = self.intern(list(mapping.values()))
+        table = np.arange(len(self.names), dtype=np.int32)
+        table[keys] = values
+        return table
+
+
+# Records seen in this run keyed by (Computer, Channel, EventRecordID), kept as an exact sorted set
+# that turns into a Bloom filter above --dedup-size keys
+class RecordFilter(object):
+    def __init__(self, size):
+        self.size = size
+        self.sources = {}
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.bloom = None
+        self.dropped = 0
+
+    # Mask of the rows of a record table seen before, the first copy in the table is kept
+    def duplicates(self, table):
+        recordid = np.asarray(table["recordid"])
+        mask = np.zeros(len(recordid), dtype=bool)
+        rows = np.flatnonzero(recordid >= 0)
+        if not len(rows):
+            return mask
+
+        computers = table["computer"]
+        channels = table["channel"]
+        pairs, pair_codes = np.unique(computers.codes[rows].astype(np.int64) * len(channels.categories) + channels.codes[rows], return_inverse=True)
+        source_ids = np.array([self.sources.setdefault((computers.categories[pair // len(channels.categories)], channels.categories[pair % len(channels.categories)]), len(self.sources))
+                               for pair in pairs], dtype=np.uint64)
+        keys = (source_ids[pair_codes.ravel()] << np.uint64(40)) | recordid[rows].astype(np.uint64)
+
+        duplicate = np.ones(len(keys), dtype=bool)
+        duplicate[np.unique(keys, return_index=True)[1]] = False
+        duplicate |= self.contains(keys)
+        self.add(keys[~duplicate])
+
+        mask[rows[duplicate]] = True
+        self.dropped += int(duplicate.sum())
+        return mask
+
+    def contains(self, keys):
+        if self.bloom is None:
+            pos = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+            return (self.keys[pos] == keys) if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        found = np.ones(len(keys), dtype=bool)
+        for bit in self.bloom_bits(keys):
+            found &= ((self.bloom[bit >> np.uint64(3)] >> (bit & np.uint64(7)).astype(np.uint8)) & 1) == 1
+        return found
+
+    def add(self, keys):
+        if self.bloom is None:
+            self.keys = np.union1d(self.keys, keys)
+            if len(self.keys) <= self.size:
+                return
+            print("\n[*] More than %i records, check the duplicates with a Bloom filter." % self.size)
+            self.bloom = np.zeros(self.size * BLOOM_BITS // 8 + 1, dtype=np.uint8)
+            keys = self.keys
+            self.keys = None
+        for bit in self.bloom_bits(keys):
+            np.bitwise_or.at(self.bloom, bit >> np.uint64(3), np.left_shift(1, bit & np.uint64(7)).astype(np.uint8))
+
+    # Bit positions of the keys, double hashing of two 64 bit mixes
+    def bloom_bits(self, keys):
+        size = np.uint64(len(self.bloom) * 8)
+        h1 = keys * np.uint64(0x9E3779B97F4A7C15)
+        h1 ^= h1 >> np.uint64(29)
+        h2 = (keys ^ np.uint64(0x94D049BB133111EB)) * np.uint64(0xBF58476D1CE4E5B9)
+        h2 ^= h2 >> np.uint64(32)
+        return [(h1 + np.uint64(i) * h2) % size for i in range(BLOOM_HASHES)]
+
+
+# Logon events of the HMM input, spilled to a temporary file in log order
+class EventSpool(object):
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.rows = 0
+
+    def write(self, etimes, eventids, users, hosts):
+        records = np.empty(len(etimes), dtype=SPOOL_DTYPE)
+        records["time"] = etimes
+        records["id"] = eventids
+        records["user"] = users
+        records["host"] = hosts
+        records.tofile(self.file)
+        self.rows += len(records)
+
+    def write_records(self, records):
+        records.astype(SPOOL_DTYPE).tofile(self.file)
+        self.rows += len(records)
+
+    # Memory mapped rows in log order
+    def records(self):
+        self.file.flush()
+        if not self.rows:
+            return np.empty(0, dtype=SPOOL_DTYPE)
+        return np.memmap(self.file, dtype=SPOOL_DTYPE, mode="r", shape=(self.rows,))
+
+    # The rows of head and then of the spool, in slices of at most SPOOL_BLOCK rows,
+    # with the hosts of the spool rows translated by host_ids
+    def slices(self, host_ids=None, head=None):
+        if head is not None and len(head):
+            yield np.array(head)
+        records = self.records()
+        for start in range(0, len(records), SPOOL_BLOCK):
+            part = np.array(records[start:start + SPOOL_BLOCK])
+            if host_ids is not None:
+                part["host"] = host_ids[part["host"]]
+            yield part
+
+    # Sort the rows by time on disk, in groups of whole days: the days are split into ranges
+    # written to temporary files, each of them read back and sorted on its own
+    def day_blocks(self, host_ids=None, head=None):
+        counts = collections.Counter()
+        for part in self.slices(None, head):
+            days, day_counts = np.unique(part["time"] // 86400, return_counts=True)
+            counts.update(dict(zip(days.tolist(), day_counts.tolist())))
+        block_size = max(SPOOL_BLOCK, sum(counts.values()) // SPOOL_FILES + 1)
+        starts = []
+        size = 0
+        for day in sorted(counts):
+            if not starts or size + counts[day] > block_size:
+                starts.append(day)
+                size = 0
+            size += counts[day]
+
+        files = [tempfile.TemporaryFile() for _ in starts]
+        try:
+            for part in self.slices(host_ids, head):
+                blocks = np.searchsorted(starts, part["time"] // 86400, side="right") - 1
+                for block in np.unique(blocks):
+                    part[blocks == block].tofile(files[block])
+            for block_file in files:
+                block_file.flush()
+                block_file.seek(0)
+                rows = np.fromfile(block_file, dtype=SPOOL_DTYPE)
+                block_file.close()
+                yield rows[np.argsort(rows["time"], kind="stable")]
+        finally:
+            for block_file in files:
+                block_file.close()
+
+    # Rows of the last day in time order
+    def last_day(self, host_ids=None, head=None):
+        days = [int(part["time"].max()) // 86400 for part in self.slices(None, head) if len(part)]
+        if not days:
+            return np.empty(0, dtype=SPOOL_DTYPE)
+        rows = np.concatenate([part[part["time"] // 86400 == max(days)] for part in self.slices(host_ids, head)])
+        return rows[np.argsort(rows["time"], kind="stable")]
+
+    def close(self):
+        self.file.close()
+
+
+# Aggregates of everything ingested so far, saved between --incremental runs
+class IngestState(object):
+    def __init__(self):
+        self.result = ParseResult()
+        self.symbols = SymbolTable()
+        self.dcsync_count = {}
+        self.dcsync = {}
+        self.dcshadow_check = set()
+        self.dcshadow = {}
+        self.hmm_tail = None
+        self.detect_hmm = []
+        self.written = {}
+        self.groups = set()
+        self.policies = 0
+        self.ingests = 0
+
+    # Yield the node rows that differ from the ones written by the previous runs
+    def changed_rows(self, rows, name, key):
+        written = self.written.setdefault(name, {})
+        for row in rows:
+            digest = hashlib.md5(repr(sorted(row.items())).encode("utf-8")).hexdigest()
+            if written.get(row[key]) != digest:
+                written[row[key]] = digest
+                yield row
+
+
+# JSON header fields of a parse result
+def result_meta(result):
+    meta = {name: getattr(result, name) for name in PARTIAL_FIELDS}
+    meta["domain_set"] = [list(pair) for pair in result.domain_set]
+    meta["checkpoints"] = [[computer, channel, record_id] for (computer, channel), record_id in result.checkpoints.items()]
+    for name in ["starttime", "endtime"]:
+        if meta[name] is not None:
+            meta[name] = meta[name].strftime("%Y-%m-%d %H:%M:%S")
+    return meta
+
+
+# Parse result of the JSON header fields, without the edges
+def meta_result(meta):
+    result = ParseResult()
+    for name in PARTIAL_FIELDS:
+        setattr(result, name, meta[name])
+    result.domain_set = [tuple(pair) for pair in meta["domain_set"]]
+    result.checkpoints = {(computer, channel): record_id for computer, channel, record_id in meta["checkpoints"]}
+    for name in ["starttime", "endtime"]:
+        if meta[name] is not None:
+            setattr(result, name, datetime.datetime.strptime(meta[name], "%Y-%m-%d %H:%M:%S"))
+    return result
+
+
+# Read the aggregates of the previous --incremental runs, numpy arrays and a JSON header like a partial aggregate file
+def load_state():
+    if not os.path.exists(STATE_PATH):
+        return IngestState()
+    try:
+        with np.load(STATE_PATH, allow_pickle=False) as data:
+            meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+            if not isinstance(meta, dict) or meta.get("version") != STATE_VERSION:
+                sys.exit("[!] {0} is not an ingest state of this version.".format(STATE_PATH))
+            edges = {name: data["edge_" + name] for name in EDGE_KEYS + ["count"]} if meta["edges"] else None
+            hmm_tail = {name: data["hmm_tail_" + name] for name, _ in SPOOL_DTYPE} if meta["hmm_tail"] else None
+    except (IOError, OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        sys.exit("[!] Can't read the ingest state {0}.".format(STATE_PATH))
+
+    state = IngestState()
+    state.result = meta_result(meta["result"])
+    if edges is not None:
+        state.result.edges = pd.DataFrame(edges, columns=EDGE_KEYS + ["count"])
+    state.symbols.names = meta["symbols"]
+    state.symbols.ids = {name: i for i, name in enumerate(state.symbols.names)}
+    for name in ["dcsync_count", "dcsync", "dcshadow", "detect_hmm", "written", "policies", "ingests"]:
+        setattr(state, name, meta[name])
+    state.dcshadow_check = set(meta["dcshadow_check"])
+    state.groups = set(tuple(pair) for pair in meta["groups"])
+    if hmm_tail is not None:
+        state.hmm_tail = np.empty(len(hmm_tail["time"]), dtype=SPOOL_DTYPE)
+        for name, _ in SPOOL_DTYPE:
+            state.hmm_tail[name] = hmm_tail[name]
+    return state
+
+
+def save_state(state):
+    if not os.path.isdir(os.path.dirname(STATE_PATH)):
+        os.makedirs(os.path.dirname(STATE_PATH))
+    meta = {"version": STATE_VERSION, "symbols": state.symbols.names, "result": result_meta(state.result),
+            "edges": state.result.edges is not None, "hmm_tail": state.hmm_tail is not None,
+            "dcshadow_check": list(state.dcshadow_check), "groups": [list(pair) for pair in state.groups],
+            "detect_hmm": [int(user) for user in state.detect_hmm]}
+    for name in ["dcsync_count", "dcsync", "dcshadow", "written", "policies", "ingests"]:
+        meta[name] = getattr(state, name)
+
+    arrays = {"meta": np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)}
+    if state.result.edges is not None:
+        for name in EDGE_KEYS + ["count"]:
+            arrays["edge_" + name] = state.result.edges[name].values
+    if state.hmm_tail is not None:
+        for name, _ in SPOOL_DTYPE:
+            arrays["hmm_tail_" + name] = state.hmm_tail[name]
+
+    with open(STATE_PATH + ".tmp", "wb") as fs:
+        np.savez_compressed(fs, **arrays)
+    os.replace(STATE_PATH + ".tmp", STATE_PATH)
+
+
+# Detect DCSync from the 4662 records in log order
+def detect_dcsync(records, dcsync_count=None, dcsync=None):
+    if dcsync_count is None:
+        dcsync_count = {}
+    if dcsync is None:
+        dcsync = {}
+    for users, etime in records:
+        for username in users:
+            dcsync_count[username] = dcsync_count.get(username, 0) + 1
+            if dcsync_count[username] == 3:
+                dcsync[username] = etime
+                dcsync_count[username] = 0
+
+    return dcsync
+
+
+# Detect DCShadow from the 5137 and 5141 records in log order
+def detect_dcshadow(records, dcshadow_check=None, dcshadow=None):
+    if dcshadow_check is None:
+        dcshadow_check = set()
+    if dcshadow is None:
+        dcshadow = {}
+    for users, etime in records:
+        for username in users:
+            if etime in dcshadow_check:
+                dcshadow[username] = etime
+            else:
+                dcshadow_check.add(etime)
+
+    return dcshadow
+
+
+# Add up two frames of edge counts, keeping the order the edges were first seen
+def merge_edges(edges, other):
+    if edges is None:
+        return other
+    if other is None:
+        return edges
+    edges = pd.concat([edges, other], ignore_index=True)
+    return edges.groupby(EDGE_KEYS, sort=False)["count"].sum().reset_index()
+
+
+# Build the per hour edges, the edges and the per user hourly counts from the edge aggregates
+def edge_frames(edges, hosts, symbols):
+    count_set = edges.groupby(["dates", "eventid", "username"], sort=False)["count"].sum().reset_index()
+    if hosts:
+        edges = edges.assign(ipaddress=symbols.remap(hosts)[edges["ipaddress"].values])
+    event_set_bydate = edges.groupby(EDGE_COLUMNS + ["date"], sort=False)["count"].sum().reset_index()
+    event_set = edges.groupby(EDGE_COLUMNS, sort=False)["count"].sum().reset_index()
+    return event_set_bydate, event_set, count_set
+
+
+# Levinson-Durbin recursion over a batch of autocovariance rows
+def levinson_durbin(r, order):
+    a = np.zeros((len(r), order + 1))
+    e = np.zeros((len(r), order + 1))
+    a[:, 0] = 1.0
+    a[:, 1] = -r[:, 1] / r[:, 0]
+    e[:, 1] = r[:, 0] + r[:, 1] * a[:, 1]
+    for k in range(1, order):
+        lam = -np.sum(a[:, :k + 1] * r[:, k + 1:0:-1], axis=1) / e[:, k]
+        u = np.concatenate([a[:, :k + 1], np.zeros((len(r), 1))], axis=1)
+        v = np.concatenate([np.zeros((len(r), 1)), a[:, k:0:-1], np.ones((len(r), 1))], axis=1)
+        a = u + lam[:, np.newaxis] * v
+        e[:, k + 1] = e[:, k] * (1.0 - lam * lam)
+
+    return a
+
+
+# SDAR model of changefinder, one state per series
+class SDARBatch(object):
+    def __init__(self, r, order):
+        self.r = r
+        self.order = order
+        self.mu = np.array([np.random.random()])
+        self.sigma = np.array([np.random.random()])
+        self.c = np.zeros((1, order + 1))
+
+    def expand(self, size):
+        self.mu = np.repeat(self.mu, size)
+        self.sigma = np.repeat(self.sigma, size)
+        self.c = np.repeat(self.c, size, axis=0)
+
+    def update(self, x, term):
+        r = self.r
+        self.mu = (1 - r) * self.mu + r * x
+        for i in range(1, self.order):
+            self.c[:, i] = (1 - r) * self.c[:, i] + r * (x - self.mu) * (term[-i] - self.mu)
+        self.c[:, 0] = (1 - r) * self.c[:, 0] + r * (x - self.mu) * (x - self.mu)
+        what = levinson_durbin(self.c, self.order)
+        xhat = np.sum(-what[:, 1:] * (np.stack(term[::-1], axis=1) - self.mu[:, np.newaxis]), axis=1) + self.mu
+        self.sigma = (1 - r) * self.sigma + r * (x - xhat) * (x - xhat)
+        return -np.log(np.exp(-0.5 * (x - xhat) ** 2 / self.sigma) / ((2 * np.pi) ** 0.5 * self.sigma ** 0.5))
+
+
+# changefinder.ChangeFinder scoring many series with numpy arrays
+class ChangeFinderBatch(object):
+    def __init__(self, r=0.5, order=1, smooth=7):
+        self.order = order
+        self.smooth = smooth
+        self.smooth2 = int(round(smooth / 2.0))
+        self.ts = []
+        self.first_scores = []
+        self.smoothed_scores = []
+        self.second_scores = []
+        self.sdar_first = SDARBatch(r, order)
+        self.sdar_second = SDARBatch(r, order)
+
+    # Copy the state of a single series to size series
+    def expand(self, size):
+        for window in [self.ts, self.first_scores, self.smoothed_scores, self.second_scores]:
+            window[:] = [np.repeat(value, size) for value in window]
+        self.sdar_first.expand(size)
+        self.sdar_second.expand(size)
+        return self
+
+    def push(self, window, value, size):
+        window.append(value)
+        if len(window) == size + 1:
+            window.pop(0)
+
+    def update(self, x):
+        if len(self.ts) == self.order:
+            self.push(self.first_scores, self.sdar_first.update(x, self.ts), self.smooth)
+        self.push(self.ts, x, self.order)
+        if len(self.first_scores) == self.smooth:
+            second_target = sum(self.first_scores)
+            if len(self.smoothed_scores) == self.order:
+                self.push(self.second_scores, self.sdar_second.update(second_target, self.smoothed_scores), self.smooth2)
+            self.push(self.smoothed_scores, second_target, self.order)
+        if len(self.second_scores) == self.smooth2:
+            return sum(self.second_scores)
+        else:
+            return np.zeros(len(x))
+
+
 # Calculate ChangeFinder
 def adetection(counts, users, starttime, tohours):
-    count_array = np.zeros((5, len(users), tohours + 1))
-    count_all_array = []
-    result_array = []
     cfdetect = {}
-    for _, event in counts.iterrows():
-        column = int((datetime.datetime.strptime(event["dates"], "%Y-%m-%d  %H:%M:%S") - starttime).total_seconds() / 3600)
-        row = users.index(event["username"])
-        # count_array[row, column, 0] = count_array[row, column, 0] + count
-        if event["eventid"] == 4624:
-            count_array[0, row, column] = event["count"]
-        elif event["eventid"] == 4625:
-            count_array[1, row, column] = event["count"]
-        elif event["eventid"] == 4768:
-            count_array[2, row, column] = event["count"]
-        elif event["eventid"] == 4769:
-            count_array[3, row, column] = event["count"]
-        elif event["eventid"] == 4776:
-            count_array[4, row, column] = event["count"]
-        elif event["eventid"] == 4719:
-            count_array[5, row, column] = event["count"]
-
-    count_sum = np.sum(count_array, axis=0)
-    count_average = count_sum.mean(axis=0)
-    num = 0
-    for udata in count_sum:
-        cf = changefinder.ChangeFinder(r=0.04, order=1, smooth=5)
-        ret = []
-        for i in count_average:
-            cf.update(i)
-
-        for i in udata:
-            score = cf.update(i)
-            ret.append(round(score, 2))
-        result_array.append(ret)
-
-        cfdetect[users[num]] = max(ret)
-
-        count_all_array.append(udata.tolist())
-        for var in range(0, 6):
-            con = []
-            for i in range(0, tohours + 1):
-                con.append(count_array[var, num, i])
-            count_all_array.append(con)
-        num += 1
-
-    return count_all_array, result_array, cfdetect
+    # The counts of the TIMELINE_ID events as sparse rows of event type, user and hour, sorted by user
+    kinds = pd.Index(TIMELINE_ID).get_indexer(counts["eventid"])
+    rows = pd.Index(users).get_indexer(counts["username"])
+    mask = (kinds >= 0) & (rows >= 0)
+    user_counts = pd.DataFrame({"kind": kinds[mask].astype(np.int32), "user": rows[mask].astype(np.int32),
+                                "hour": ((counts["dates"].values[mask] - calendar.timegm(starttime.timetuple())) // 3600).astype(np.int32),
+                                "count": counts["count"].values[mask].astype(np.int32)})
+    user_counts = user_counts.sort_values("user", kind="stable").reset_index(drop=True)
+
+    # The hourly sums of all users, one hour at a time
+    by_hour = user_counts.sort_values("hour", kind="stable")
+    hour_rows = by_hour["user"].values
+    hour_counts = by_hour["count"].values.astype(np.float64)
+    hour_starts = np.searchsorted(by_hour["hour"].values, np.arange(tohours + 2))
+    count_average = np.bincount(by_hour["hour"].values, weights=hour_counts, minlength=tohours + 1) / len(users)
+
+    # Warm up on the average once, then score every user from that state
+    cf = ChangeFinderBatch(r=0.04, order=1, smooth=5)
+    for i in count_average:
+        cf.update(np.array([i]))
+    cf = cf.expand(len(users))
+    scores = np.zeros((len(users), tohours + 1))
+    for i in range(0, tohours + 1):
+        lo, hi = hour_starts[i], hour_starts[i + 1]
+        scores[:, i] = cf.update(np.bincount(hour_rows[lo:hi], weights=hour_counts[lo:hi], minlength=len(users)))
+    result_array = np.round(scores, 2)
+
+    for user, score in zip(users, result_array.max(axis=1).tolist()):
+        cfdetect[user] = score
+
+    return user_counts, result_array, cfdetect
+
+
+# Bucket of an epoch hour at a timeline resolution
+def timeline_bucket(hours, resolution):
+    if resolution == "hour":
+        return hours
+    days = hours // 24
+    if resolution == "day":
+        return days
+    # 1970-01-01 was a Thursday
+    return (days + 3) // 7
+
+
+# First epoch hour of a timeline bucket
+def bucket_hour(bucket, resolution):
+    if resolution == "hour":
+        return bucket
+    if resolution == "day":
+        return bucket * 24
+    return (bucket * 7 - 3) * 24
+
+
+# Pack the timeline of a user over consecutive buckets: the buckets with events as gaps and their counts per TIMELINE_ID,
+# and the anomaly scores in hundredths as differences to the previous bucket, zlib compressed and base64 encoded
+def pack_timeline(first, counts, scores):
+    active = np.flatnonzero(counts.any(axis=0))
+    centis = np.round(scores * 100).astype(np.int64)
+    data = struct.pack("<qII", first, len(scores), len(active))
+    data += np.diff(active, prepend=0).astype("<u4").tobytes() + counts[:, active].T.astype("<u4").tobytes()
+    data += np.diff(centis, prepend=0).astype("<i4").tobytes()
+    return base64.b64encode(zlib.compress(data, 9)).decode("ascii")
+
+
+# Dense counts per TIMELINE_ID and anomaly scores of the buckets first to last of a packed timeline
+def unpack_timeline(packed, first, last):
+    data = zlib.decompress(base64.b64decode(packed))
+    start, nbuckets, nactive = struct.unpack_from("<qII", data)
+    offset = struct.calcsize("<qII")
+    active = np.cumsum(np.frombuffer(data, "<u4", nactive, offset).astype(np.int64)) + start
+    offset += 4 * nactive
+    values = np.frombuffer(data, "<u4", nactive * len(TIMELINE_ID), offset).reshape(nactive, len(TIMELINE_ID))
+    offset += 4 * nactive * len(TIMELINE_ID)
+    centis = np.cumsum(np.frombuffer(data, "<i4", nbuckets, offset).astype(np.int64))
+
+    counts = np.zeros((len(TIMELINE_ID), last - first + 1), dtype=np.int64)
+    window = (active >= first) & (active <= last)
+    counts[:, active[window] - first] = values[window].T
+    scores = np.zeros(last - first + 1)
+    lo = max(first, start)
+    hi = min(last, start + nbuckets - 1)
+    if lo <= hi:
+        scores[lo - first:hi - first + 1] = centis[lo - start:hi - start + 1] / 100.0
+    return counts, scores
+
+
+# Packed hourly, daily and weekly timelines of the users, daily and weekly scores are the highest of their hours.
+# The counts of a user are filled in from its sparse rows when its timeline is packed
+def timeline_rows(user_counts, scores, starttime):
+    first_hour = calendar.timegm(starttime.timetuple()) // 3600
+    hours = first_hour + np.arange(scores.shape[1])
+    user_starts = np.searchsorted(user_counts["user"].values, np.arange(len(scores) + 1))
+    kinds = user_counts["kind"].values
+    count_hours = first_hour + user_counts["hour"].values.astype(np.int64)
+    values = user_counts["count"].values
+    rows = [{} for _ in range(len(scores))]
+    for resolution in TIMELINE_RESOLUTIONS:
+        buckets = timeline_bucket(hours, resolution)
+        starts = np.flatnonzero(np.concatenate([[True], np.diff(buckets) != 0]))
+        bucket_scores = np.maximum.reduceat(scores, starts, axis=1)
+        count_buckets = timeline_bucket(count_hours, resolution) - buckets[0]
+        for i, row in enumerate(rows):
+            lo, hi = user_starts[i], user_starts[i + 1]
+            bucket_counts = np.zeros((len(TIMELINE_ID), len(starts)), dtype=np.int64)
+            np.add.at(bucket_counts, (kinds[lo:hi], count_buckets[lo:hi]), values[lo:hi])
+            row["timeline_" + resolution] = pack_timeline(int(buckets[0]), bucket_counts, bucket_scores[i])
+    return rows
 
 
 # Calculate PageRank
 def pagerank(event_set, admins, hmm, cf, ntml):
-    graph = {}
-    nodes = []
-    for _, events in event_set.iterrows():
-        nodes.append(events["ipaddress"])
-        nodes.append(events["username"])
-
-    for node in list(set(nodes)):
-        links = []
-        for _, events in event_set.iterrows():
-            if node in events["ipaddress"]:
-                links.append(events["username"])
-            if node in events["username"]:
-                links.append(events["ipaddress"])
-        graph[node] = links
-
-    # d = 0.85
-    numloops = 30
-    ranks = {}
-    d = {}
-    npages = len(graph)
+    # Number the host and user ids as pages
+    nevents = len(event_set)
+    codes, nodes = pd.factorize(np.concatenate([event_set["ipaddress"].values, event_set["username"].values]))
+    npages = len(nodes)
+    is_user = np.zeros(npages, dtype=bool)
+    is_user[codes[nevents:]] = True
+    src = np.concatenate([codes[:nevents], codes[nevents:]])
+    dst = np.concatenate([codes[nevents:], codes[:nevents]])
+
+    # Out degree counts every event, a link is followed once
+    degree = np.bincount(src, minlength=npages)
+    links = sparse.csr_matrix((np.ones(len(src)), (dst, src)), shape=(npages, npages))
+    links.sum_duplicates()
+    links.data[:] = 1.0
 
     # Calc damping factor and initial value
-    for page in graph:
-        if page in admins:
-            df = 0.6
-        elif "@" in page[-1]:
-            df = 0.85
-        else:
-            df = 0.8
-        if page in hmm:
-            df -= 0.2
-        if page in ntml:
-            df -= 0.1
-        if page in cf:
-            df -= cf[page] / 200
-
-        d[page] = df
-        ranks[page] = 1.0 / npages
-
-    for i in range(0, numloops):
-        newranks = {}
-        for page in graph:
-            newrank = (1 - d[page]) / npages
-            for node in graph:
-                if page in graph[node]:
-                    newrank = newrank + d[node] * ranks[node]/len(graph[node])
-            newranks[page] = newrank
+    damping = np.where(np.isin(nodes, admins), 0.6, np.where(is_user, 0.85, 0.8))
+    damping -= np.where(np.isin(nodes, hmm), 0.2, 0.0)
+    damping -= np.where(np.isin(nodes, ntml), 0.1, 0.0)
+    damping -= pd.Series(cf, dtype="float64").reindex(nodes).fillna(0.0).values / 200
+    ranks = np.full(npages, 1.0 / npages)
+
+    teleport = (1 - damping) / npages
+    share = damping / degree
+    for i in range(0, PAGERANK_LOOPS):
+        newranks = teleport + links.dot(share * ranks)
+        delta = np.abs(newranks - ranks).sum()
         ranks = newranks
+        if delta < PAGERANK_TOL * ranks.sum():
+            break
 
-    nranks = {}
-    max_v = max(ranks.values())
-    min_v = min(ranks.values())
-    for key, value in ranks.items():
-        nranks[key] = (value - min_v) / (max_v - min_v)
+    max_v = ranks.max()
+    min_v = ranks.min()
+    nranks = (ranks - min_v) / (max_v - min_v)
+
+    return dict(zip(nodes.tolist(), nranks.tolist()))
+
+
+# Multi-source BFS from the admin users over the user and host graph: the hop distance to the nearest admin user
+# (-1 when not connected) and the next hop on the way (-1 for the admins) of every user and host id
+def admin_paths(event_set, admins):
+    nevents = len(event_set)
+    codes, nodes = pd.factorize(np.concatenate([event_set["ipaddress"].values, event_set["username"].values]))
+    npages = len(nodes)
+    src = np.concatenate([codes[:nevents], codes[nevents:]])
+    dst = np.concatenate([codes[nevents:], codes[:nevents]])
+    links = sparse.csr_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(npages, npages))
+
+    distance = np.full(npages, -1, dtype=np.int64)
+    nexthop = np.full(npages, -1, dtype=np.int64)
+    frontier = np.flatnonzero(np.isin(nodes, admins))
+    distance[frontier] = 0
+    hops = 0
+    while len(frontier):
+        hops += 1
+        reach = links[frontier].tocoo()
+        found = distance[reach.col] < 0
+        # a node reached from several nodes of the frontier takes the first one as its next hop
+        reached, first = np.unique(reach.col[found], return_index=True)
+        distance[reached] = hops
+        nexthop[reached] = frontier[reach.row[found][first]]
+        frontier = reached
+
+    nexthop_ids = np.where(nexthop >= 0, nodes[np.maximum(nexthop, 0)], -1)
+    return dict(zip(nodes.tolist(), distance.tolist())), dict(zip(nodes.tolist(), nexthop_ids.tolist()))
+
+
+# Summary graph: the top ranked users and hosts in full detail, the other hosts collapsed into their /24 subnet,
+# or for hostnames and IPv6 addresses into the community of the top user with the most events from them
+def summarize(event_set, ranks, symbols, top):
+    users = pd.unique(event_set["username"].values)
+    hosts = pd.unique(event_set["ipaddress"].values)
+    top_users = users[np.argsort(-np.array([ranks[user] for user in users]), kind="stable")[:top]]
+    top_hosts = hosts[np.argsort(-np.array([ranks[host] for host in hosts]), kind="stable")[:top]]
+    links = event_set[np.isin(event_set["username"].values, top_users)]
+    links = links.groupby(["username", "ipaddress"], sort=False)["count"].sum().reset_index()
+
+    strongest = links.sort_values(by="count", ascending=False, kind="stable").drop_duplicates("ipaddress")
+    community = dict(zip(strongest["ipaddress"].tolist(), symbols.lookup(strongest["username"].values)))
+    groups = {}
+    aggregates = {}
+    for host in np.setdiff1d(hosts, top_hosts).tolist():
+        name = symbols.names[host]
+        if re.search(IPv4_PATTERN, name):
+            group, kind = ".".join(name.split(".")[:3]) + ".0/24", "subnet"
+        elif host in community:
+            group, kind = "community " + community[host][:-1], "community"
+        else:
+            group, kind = "others", "community"
+        groups[host] = group
+        if group not in aggregates:
+            aggregates[group] = {"name": group, "kind": kind, "hosts": 0, "rank": 0.0}
+        aggregates[group]["hosts"] += 1
+        aggregates[group]["rank"] = max(aggregates[group]["rank"], ranks[host])
+
+    # sum the links of the collapsed hosts per aggregate
+    hosts_names = np.array([groups.get(host, symbols.names[host]) for host in links["ipaddress"].tolist()], dtype=object)
+    links = links.assign(IP=hosts_names, aggregate=np.isin(links["ipaddress"].values, list(groups)))
+    links = links.groupby(["username", "IP", "aggregate"], sort=False)["count"].sum().reset_index()
+    link_rows = [{"user": username[:-1], "IP": name, "aggregate": aggregate, "count": count}
+                 for username, name, aggregate, count in zip(symbols.lookup(links["username"].values), links["IP"].tolist(),
+                                                             links["aggregate"].tolist(), links["count"].tolist())]
+    return groups, list(aggregates.values()), link_rows
+
+
+# Load the Hidden Markov Model, cached until the pickle changes
+def load_hmm():
+    mtime = os.path.getmtime(FPATH + "/model/hmm.pkl")
+    if HMM_CACHE.get("mtime") != mtime:
+        HMM_CACHE["model"] = joblib.load(FPATH + "/model/hmm.pkl")
+        HMM_CACHE["mtime"] = mtime
+
+    return HMM_CACHE["model"]
+
+
+# Build the per day, user and host event sequences of spool rows in time order in one sorted pass
+def hmm_sequences(rows, users, stime):
+    events = pd.DataFrame({"day": rows["time"] // 86400,
+                           "user": pd.Index(users).get_indexer(rows["user"]),
+                           "host": rows["host"],
+                           "id": pd.Index(HMM_ID).get_indexer(rows["id"])})
+    events = events[(events["user"] >= 0) & (events["id"] >= 0) & (events["day"] >= calendar.timegm(stime.timetuple()) // 86400)]
+    # multi-column sorts are stable, so events keep their time order
+    events = events.sort_values(["day", "user", "host"])
+
+    keys = events[["day", "user", "host"]]
+    starts = np.flatnonzero((keys != keys.shift()).any(axis=1).values)
+    lengths = np.diff(np.append(starts, len(events)))
+    keep = lengths > 2
+
+    ids = events["id"].values[np.repeat(keep, lengths)]
+    return ids, lengths[keep], events.iloc[starts[keep]][["day", "user", "host"]]
+
+
+# Key of a sequence in the training store, a hash of its day, user name and host name
+def hmm_keys(keys, users, symbols):
+    names = ["%i\x00%s\x00%s" % key for key in zip(keys["day"].tolist(), symbols.lookup(users[keys["user"].values]),
+                                                       symbols.lookup(keys["host"].values))]
+    return pd.util.hash_array(np.array(names, dtype=object))
+
+
+# Calculate Hidden Markov Model over the day blocks of the spool
+def decodehmm(blocks, users, stime):
+    detect_hmm = []
+    detected = set()
+    model = load_hmm()
+    for rows in blocks:
+        ids, lengths, keys = hmm_sequences(rows, users, stime)
+        codes = keys["user"].values
+        offsets = np.append(0, np.cumsum(lengths))
+
+        for i in range(0, len(lengths), HMM_BATCH):
+            j = min(i + HMM_BATCH, len(lengths))
+            data_decode = model.predict(ids[offsets[i]:offsets[j]].reshape(-1, 1), lengths[i:j])
+            for k in range(i, j):
+                unique_data = np.unique(data_decode[offsets[k] - offsets[i]:offsets[k + 1] - offsets[i]])
+                if unique_data.shape[0] == 2:
+                    user = users[codes[k]]
+                    if user not in detected:
+                        detected.add(user)
+                        detect_hmm.append(user)
 
-    return nranks
+    return detect_hmm
 
 
-# Calculate Hidden Markov Model
-def decodehmm(frame, users, stime):
-    detect_hmm = []
-    model = joblib.load(FPATH + "/model/hmm.pkl")
-    while(1):
-        date = stime.strftime("%Y-%m-%d")
-        for user in users:
-            hosts = np.unique(frame[(frame["user"] == user)].host.values)
-            for host in hosts:
-                udata = []
-                for _, data in frame[(frame["date"].str.contains(date)) & (frame["user"] == user) & (frame["host"] == host)].iterrows():
-                    id = data["id"]
-                    if id == 4776:
-                        udata.append(0)
-                    elif id == 4768:
-                        udata.append(1)
-                    elif id == 4769:
-                        udata.append(2)
-                    elif id == 4624:
-                        udata.append(3)
-                    elif id == 4625:
-                        udata.append(4)
-                    elif id == 4719:
-                        udata.append(5)
-                if len(udata) > 2:
-                    data_decode = model.predict(np.array([np.array(udata)], dtype="int").T)
-                    unique_data = np.unique(data_decode)
-                    if unique_data.shape[0] == 2:
-                        if user not in detect_hmm:
-                            detect_hmm.append(user)
-
-        stime += datetime.timedelta(days=1)
-        if frame.loc[(frame["date"].str.contains(date))].empty:
-            break
+# Path of a file of the Hidden Markov Model training store
+def hmm_store_path(name):
+    return FPATH + "/model/hmm_%s.bin" % name
 
-    return detect_hmm
 
+# Add the sequences of the day blocks to the training store, a sequence replaces the one of the same day, user and host
+# learned before, so the events read again by a later run do not count twice
+def store_hmm_sequences(blocks, users, symbols, stime):
+    added = {name: tempfile.TemporaryFile() for name, _ in HMM_STORE}
+    new_keys = [np.empty(0, dtype=np.uint64)]
+    try:
+        for rows in blocks:
+            ids, lengths, keys = hmm_sequences(rows, users, stime)
+            new_keys.append(hmm_keys(keys, users, symbols))
+            for name, part in zip(["symbols", "lengths", "keys"], [ids, lengths, new_keys[-1]]):
+                part.astype(dict(HMM_STORE)[name]).tofile(added[name])
+        new_keys = np.concatenate(new_keys)
+
+        lengths = np.fromfile(hmm_store_path("lengths"), dtype=np.int32) if os.path.exists(hmm_store_path("lengths")) else np.empty(0, dtype=np.int32)
+        keys = np.fromfile(hmm_store_path("keys"), dtype=np.uint64) if os.path.exists(hmm_store_path("keys")) else np.empty(0, dtype=np.uint64)
+        if len(keys) != len(lengths):
+            sys.exit("[!] The Hidden Markov Model training store in {0} is broken.".format(FPATH + "/model"))
+        replaced = np.isin(keys, new_keys)
+
+        # Rewrite the store without the replaced sequences
+        if replaced.any():
+            symbol_data = np.memmap(hmm_store_path("symbols"), dtype=np.int8, mode="r")
+            offsets = np.append(0, np.cumsum(lengths, dtype=np.int64))
+            with open(hmm_store_path("symbols") + ".tmp", "wb") as fs:
+                for start, end in hmm_slices(offsets):
+                    part = np.array(symbol_data[offsets[start]:offsets[end]])
+                    part[np.repeat(~replaced[start:end], lengths[start:end])].tofile(fs)
+            del symbol_data
+            lengths[~replaced].tofile(hmm_store_path("lengths") + ".tmp")
+            keys[~replaced].tofile(hmm_store_path("keys") + ".tmp")
+            for name, _ in HMM_STORE:
+                os.replace(hmm_store_path(name) + ".tmp", hmm_store_path(name))
+
+        for name, _ in HMM_STORE:
+            added[name].seek(0)
+            with open(hmm_store_path(name), "ab") as fs:
+                shutil.copyfileobj(added[name], fs)
+    finally:
+        for added_file in added.values():
+            added_file.close()
+
+    print("[*] Add %i sequences to the training store, %i of them replace sequences learned before." % (len(new_keys), int(replaced.sum())))
+
+
+# Ranges of whole sequences with about HMM_TRAIN_SIZE symbols
+def hmm_slices(offsets):
+    slices = []
+    start = 0
+    while start < len(offsets) - 1:
+        end = np.searchsorted(offsets, offsets[start] + HMM_TRAIN_SIZE, side="right") - 1
+        end = min(max(end, start + 1), len(offsets) - 1)
+        slices.append((start, end))
+        start = end
+    return slices
+
+
+# Learning Hidden Markov Model, each EM iteration adds up the sufficient statistics of every slice of the training store
+def learnhmm(blocks, users, symbols, stime):
+    store_hmm_sequences(blocks, users, symbols, stime)
+
+    lengths = np.fromfile(hmm_store_path("lengths"), dtype=np.int32)
+    if not len(lengths):
+        print("[*] No sequences to learn.")
+        return
+    symbol_data = np.memmap(hmm_store_path("symbols"), dtype=np.int8, mode="r")
+    offsets = np.append(0, np.cumsum(lengths, dtype=np.int64))
+    slices = hmm_slices(offsets)
 
-# Learning Hidden Markov Model
-def learnhmm(frame, users, stime):
-    lengths = []
-    data_array = np.array([])
-    
     emission_probability = np.array([[0.09,   0.05,   0.35,   0.51],
                                      [0.0003, 0.0004, 0.0003, 0.999],
                                      [0.0003, 0.0004, 0.0003, 0.999]])
-    while(1):
-        date = stime.strftime("%Y-%m-%d")
-        for user in users:
-            hosts = np.unique(frame[(frame["user"] == user)].host.values)
-            for host in hosts:
-                udata = np.array([])
-                for _, data in frame[(frame["date"].str.contains(date)) & (frame["user"] == user) & (frame["host"] == host)].iterrows():
-                    id = data["id"]
-                    udata = np.append(udata, id)
-               
-                if udata.shape[0] > 2:
-                    data_array = np.append(data_array, udata)
-                    lengths.append(udata.shape[0])
-
-        stime += datetime.timedelta(days=1)
-        if frame.loc[(frame["date"].str.contains(date))].empty:
+    model = hmm.MultinomialHMM(n_components=3, n_iter=HMM_TRAIN_ITER)
+    model.emissionprob_ = emission_probability
+    start, end = slices[0]
+    model._init(np.array(symbol_data[offsets[start]:offsets[end]], dtype="int").reshape(-1, 1), lengths[start:end])
+    model._check()
+    model.monitor_._reset()
+
+    for _ in range(model.n_iter):
+        stats = model._initialize_sufficient_statistics()
+        logprob = 0
+        for start, end in slices:
+            part, part_logprob = model._do_estep(np.array(symbol_data[offsets[start]:offsets[end]], dtype="int").reshape(-1, 1), lengths[start:end])
+            for name in stats:
+                stats[name] = stats[name] + part[name]
+            logprob += part_logprob
+        model._do_mstep(stats)
+        model.monitor_.report(logprob)
+        if model.monitor_.converged:
             break
 
-    data_array[data_array == 4776] = 0
-    data_array[data_array == 4768] = 1
-    data_array[data_array == 4769] = 2
-    data_array[data_array == 4624] = 3
-    data_array[data_array == 4625] = 4
-    data_array[data_array == 4719] = 5
-    
-    model = hmm.MultinomialHMM(n_components=3, n_iter=10000)
-    
-    model.emissionprob_ = emission_probability
-    model.fit(np.array([data_array], dtype="int").T, lengths)
     joblib.dump(model, FPATH + "/model/hmm.pkl")
+    HMM_CACHE["model"] = model
+    HMM_CACHE["mtime"] = os.path.getmtime(FPATH + "/model/hmm.pkl")
 
 
 def to_lxml(record_xml):
     rep_xml = record_xml.replace("xmlns=\"http://schemas.microsoft.com/win/2004/08/events/event\"", "")
     set_xml = "<?xml version=\"1.0\" encoding=\"utf-8\" standalone=\"yes\" ?>%s" % rep_xml
     fin_xml = set_xml.encode("utf-8")
-    parser = etree.XMLParser(resolve_entities=False)
-    return etree.fromstring(fin_xml, parser)
+    return etree.fromstring(fin_xml, XML_PARSER)
+
+
+# Substitution placeholder used to render an EVTX template once
+class TemplateMarker(object):
+    def __init__(self, index):
+        self.index = index
+
+    def string(self):
+        return "\x00%i\x00" % self.index
+
+
+class TemplateMarkers(object):
+    def __getitem__(self, index):
+        return TemplateMarker(index)
+
 
+# Find where an EVTX template keeps the EventID: ("sub", index) or ("value", eventid)
+def template_eventid(node):
+    for child in node.children():
+        if not isinstance(child, OpenStartElementNode):
+            continue
+        if child.tag_name() == "EventID":
+            for value in child.children():
+                if isinstance(value, (NormalSubstitutionNode, ConditionalSubstitutionNode)):
+                    return ("sub", value.index())
+                if isinstance(value, ValueNode):
+                    return ("value", int(value.children()[0].string()))
+            return None
+        location = template_eventid(child)
+        if location is not None:
+            return location
 
-def xml_records(filename):
+    return None
+
+
+# Render an EVTX template into literal parts and substitution indexes
+def load_template(root):
+    pieces = render_root_node_with_subs(root, TemplateMarkers()).split("\x00")
+    return pieces[0::2], [int(index) for index in pieces[1::2]], template_eventid(root.template())
+
+
+# Render an EVTX record from its cached template
+def render_record(root, template):
+    parts, indexes, _ = template
+    subs = root.substitutions()
+    xml = [parts[0]]
+    for index, part in zip(indexes, parts[1:]):
+        sub = subs[index]
+        if isinstance(sub, BXmlTypeNode):
+            xml.append(render_root_node(sub.root()))
+        else:
+            xml.append(escape_value(sub.string()))
+        xml.append(part)
+
+    return "".join(xml)
+
+
+# Locate the template and the substitution array of an EVTX record from its BinXML header
+def record_layout(record, chunk):
+    ofs = 0x18
+    if record.unpack_byte(ofs) & 0x0F == 0x0F:
+        ofs += 4
+    if record.unpack_byte(ofs) & 0x0F != 0x0C:
+        return None, None
+    template_offset = record.unpack_dword(ofs + 6)
+    ofs += 10
+    # resident template definition follows the template instance
+    if template_offset > record.offset() + ofs - 10 - chunk.offset():
+        ofs += 0x18 + record.unpack_dword(ofs + 0x14)
+
+    return template_offset, ofs
+
+
+# Read an integer substitution value of an EVTX record without parsing the others
+def record_value(record, ofs, index):
+    sub_count = record.unpack_dword(ofs)
+    if index >= sub_count:
+        return None
+    value_ofs = ofs + 4 + 4 * sub_count
+    for i in range(index):
+        value_ofs += record.unpack_word(ofs + 4 + 4 * i)
+    value_type = record.unpack_byte(ofs + 4 + 4 * index + 2)
+    if value_type == 0x04:
+        return record.unpack_byte(value_ofs)
+    if value_type == 0x06:
+        return record.unpack_word(value_ofs)
+    if value_type == 0x08:
+        return record.unpack_dword(value_ofs)
+
+    return None
+
+
+def xml_records(filename, chunks=None, clears=(), limit=0):
     if args.evtx:
         with Evtx(filename) as evtx:
-            for xml, record in evtx_file_xml_view(evtx.get_file_header()):
-                try:
-                    yield to_lxml(xml), None
-                except etree.XMLSyntaxError as e:
-                    yield xml, e
-
-    if args.xmls:
-        with open(filename, 'r') as fx:
-            xdata = fx.read()
-            fixdata = xdata.replace("<?xml version=\"1.0\" encoding=\"utf-8\" standalone=\"yes\"?>", "").replace("</Events>", "").replace("<Events>", "")
-            # fixdata = xdata.replace("<?xml version=\"1.0\" encoding=\"utf-8\" standalone=\"yes\"?>", "")
-            del xdata
-            xml_list = re.split("<Event xmlns=[\'\"]http://schemas.microsoft.com/win/2004/08/events/event[\'\"]>", fixdata)
-            del fixdata
-            for xml in xml_list:
-                if xml.startswith("<System>"):
+            if chunks is None:
+                evtx_chunks = enumerate(evtx.chunks())
+            else:
+                selected = set(chunks)
+                evtx_chunks = ((i, chunk) for i, chunk in enumerate(itertools.islice(evtx.chunks(), chunks[-1] + 1)) if i in selected)
+            for i, chunk in evtx_chunks:
+                # only the log clear records are kept from the chunks before the --from window
+                wanted = CLEAR_ID if i in clears else PREFILTER_ID
+                templates = {}
+                for record in chunk.records():
+                    # ingested by a previous --incremental run
+                    if record.record_num() <= limit:
+                        continue
+                    root = record.root()
+                    template_offset, subs_offset = record_layout(record, chunk)
+                    if template_offset is None:
+                        xml = render_root_node(root)
+                    else:
+                        if template_offset not in templates:
+                            templates[template_offset] = load_template(root)
+                        location = templates[template_offset][2]
+                        # records skipped by the EventID pre-filter are not rendered
+                        if location is not None:
+                            if location[0] == "value":
+                                eventid = location[1]
+                            else:
+                                eventid = record_value(record, subs_offset, location[1])
+                            if eventid is not None and eventid not in wanted:
+                                yield None, None
+                                continue
+                        xml = render_record(root, templates[template_offset])
                     try:
-                        yield to_lxml("<Event>" + xml), None
+                        node = to_lxml(xml)
                     except etree.XMLSyntaxError as e:
                         yield xml, e
+                        continue
+                    if wanted is CLEAR_ID and int(XPATH_EVENTID(node)[0].text) not in CLEAR_ID:
+                        yield None, None
+                    else:
+                        yield node, None
+
+    if args.xmls:
+        for element in xml_events(filename):
+            try:
+                eventid = int(element.findtext(EVENT_NAMESPACE + "System/" + EVENT_NAMESPACE + "EventID"))
+            except (TypeError, ValueError) as e:
+                yield element, e
+                continue
+            if eventid not in PREFILTER_ID:
+                yield None, None
+                continue
+            for node in list(element.iter(EVENT_NAMESPACE + "*")):
+                node.tag = node.tag[len(EVENT_NAMESPACE):]
+            yield element, None
+
+
+# Stream the Event elements of an XML event log, clearing each one after use
+def xml_events(filename):
+    parser = etree.XMLPullParser(events=("end",), tag=EVENT_NAMESPACE + "Event", resolve_entities=False, huge_tree=True, recover=True)
+    with open(filename, "rb") as fx:
+        data = fx.read(XML_READ_SIZE)
+        # wrap the events in one root element, wevtutil exports have none
+        if data.startswith(codecs.BOM_UTF8):
+            data = data[len(codecs.BOM_UTF8):]
+        if data.startswith(b"<?xml"):
+            data = data[data.index(b"?>") + 2:]
+        parser.feed(b"<Events>")
+        while data:
+            parser.feed(data)
+            for _, element in parser.read_events():
+                yield element
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            data = fx.read(XML_READ_SIZE)
+        parser.feed(b"</Events>")
+
+    for _, element in parser.read_events():
+        yield element
+    parser.close()
+
+
+# Extract the normalized fields of the records of one event log file, or of a range of its EVTX chunks
+def parse_records(task, progress=None):
+    _, filename, chunks, clears, limit, checkpoints = task
+    records = EventBuffer(RECORD_COLUMNS)
+    count = 0
+    skipped = 0
+
+    for node, err in xml_records(filename, chunks, clears, limit):
+        if err is not None:
+            continue
+        count += 1
+
+        if progress is not None and not (progress + count) % 100:
+            sys.stdout.write("\r[*] Now loading %i records." % (progress + count))
+            sys.stdout.flush()
+
+        # skipped by the EventID pre-filter
+        if node is None:
+            continue
+        eventid = int(XPATH_EVENTID(node)[0].text)
+        # rendered because the pre-filter could not find the EventID in the template
+        if eventid not in PREFILTER_ID:
+            continue
+
+        if XPATH_RECORDID(node):
+            computer = XPATH_COMPUTER(node)[0].text
+            channel = XPATH_CHANNEL(node)[0].text
+            record_id = int(XPATH_RECORDID(node)[0].text)
+            # ingested by a previous --incremental run
+            if checkpoints and record_id <= checkpoints.get((computer, channel), 0):
+                skipped += 1
+                continue
+        else:
+            computer = "-"
+            channel = "-"
+            record_id = -1
+
+        logtime = XPATH_TIMECREATED(node)[0].get("SystemTime")
+        try:
+            etime = datetime.datetime.strptime(logtime.split(".")[0], "%Y-%m-%d %H:%M:%S")
+        except:
+            etime = datetime.datetime.strptime(logtime.split(".")[0], "%Y-%m-%dT%H:%M:%S")
+        utime = calendar.timegm(etime.timetuple())
+
+        event_data = XPATH_EVENTDATA(node)
+        logintype = "-"
+        username = "-"
+        domain = "-"
+        ipaddress = "-"
+        hostname = "-"
+        status = "-"
+        sid = "-"
+        authname = "-"
+        extra = "-"
+        extra2 = "-"
+
+        ###
+        # Detect admin users
+        #  EventID 4672: Special privileges assigned to new logon
+        ###
+        if eventid == 4672:
+            for data in event_data:
+                if data.get("Name") in "SubjectUserName" and data.text is not None and not re.search(UCHECK, data.text):
+                    username = data.text.split("@")[0]
+                    if username[-1:] not in "$":
+                        username = username.lower() + "@"
+                    else:
+                        username = "-"
+        ###
+        # Detect removed user account and added user account.
+        #  EventID 4720: A user account was created
+        #  EventID 4726: A user account was deleted
+        ###
+        elif eventid in [4720, 4726]:
+            for data in event_data:
+                if data.get("Name") in "TargetUserName" and data.text is not None and not re.search(UCHECK, data.text):
+                    username = data.text.split("@")[0]
+                    if username[-1:] not in "$":
+                        username = username.lower() + "@"
+                    else:
+                        username = "-"
+        ###
+        # Detect Audit Policy Change
+        #  EventID 4719: System audit policy was changed
+        ###
+        elif eventid == 4719:
+            # missing values are carried over from the previous record by the replay
+            category = None
+            guid = None
+            for data in event_data:
+                if data.get("Name") in "SubjectUserName" and data.text is not None and not re.search(UCHECK, data.text):
+                    username = data.text.split("@")[0]
+                    if username[-1:] not in "$":
+                        username = username.lower() + "@"
+                    else:
+                        username = "-"
+                if data.get("Name") in "CategoryId" and data.text is not None and re.search(r"\A%%\d{4}\Z", data.text):
+                    category = data.text
+                if data.get("Name") in "SubcategoryGuid" and data.text is not None and re.search(r"\A{[\w\-]*}\Z", data.text):
+                    guid = data.text
+            extra = category
+            extra2 = guid
+        ###
+        # Detect added or removed users from specific group
+        #  EventID 4728: A member was added to a security-enabled global group
+        #  EventID 4732: A member was added to a security-enabled local group
+        #  EventID 4756: A member was added to a security-enabled universal group
+        #  EventID 4729: A member was removed from a security-enabled global group
+        #  EventID 4733: A member was removed from a security-enabled local group
+        #  EventID 4757: A member was removed from a security-enabled universal group
+        ###
+        elif eventid in [4728, 4732, 4756, 4729, 4733, 4757]:
+            groupname = None
+            usid = None
+            for data in event_data:
+                if data.get("Name") in "TargetUserName" and data.text is not None and not re.search(UCHECK, data.text):
+                    groupname = data.text
+                elif data.get("Name") in "MemberSid" and data.text not in "-" and data.text is not None and re.search(r"\AS-[0-9\-]*\Z", data.text):
+                    usid = data.text
+            extra = groupname
+            extra2 = usid
+        ###
+        # Detect DCSync and DCShadow, one user per Data element
+        #  EventID 4662: An operation was performed on an object
+        #  EventID 5137: A directory service object was created
+        #  EventID 5141: A directory service object was deleted
+        ###
+        elif eventid in [4662, 5137, 5141]:
+            users = []
+            for data in event_data:
+                if data.get("Name") in "SubjectUserName" and data.text is not None and not re.search(UCHECK, data.text):
+                    username = data.text.split("@")[0]
+                    if username[-1:] not in "$":
+                        username = username.lower() + "@"
+                    else:
+                        username = "-"
+                users.append(username)
+            extra = "\x00".join(users)
+        ###
+        # Detect the audit log deletion
+        # EventID 1102: The audit log was cleared
+        ###
+        elif eventid == 1102:
+            user_data = XPATH_CLEARED_USER(node)
+            domain_data = XPATH_CLEARED_DOMAIN(node)
+
+            if user_data[0].text is not None:
+                username = user_data[0].text.split("@")[0]
+                if username[-1:] not in "$":
+                    username = username.lower()
+                else:
+                    username = "-"
+
+            if domain_data[0].text is not None:
+                domain = domain_data[0].text
+        ###
+        # Parse logon logs
+        #  EventID 4624: An account was successfully logged on
+        #  EventID 4625: An account failed to log on
+        #  EventID 4768: A Kerberos authentication ticket (TGT) was requested
+        #  EventID 4769: A Kerberos service ticket was requested
+        #  EventID 4776: The domain controller attempted to validate the credentials for an account
+        ###
+        else:
+            for data in event_data:
+                # parse IP Address
+                if data.get("Name") in ["IpAddress", "Workstation"] and data.text is not None and (not re.search(HCHECK, data.text) or re.search(IPv4_PATTERN, data.text) or re.search(r"\A::ffff:\d+\.\d+\.\d+\.\d+\Z", data.text) or re.search(IPv6_PATTERN, data.text)):
+                    ipaddress = data.text.split("@")[0]
+                    ipaddress = ipaddress.lower().replace("::ffff:", "")
+                    ipaddress = ipaddress.replace("\\", "")
+                # Parse hostname
+                if data.get("Name") == "WorkstationName" and data.text is not None and (not re.search(HCHECK, data.text) or re.search(IPv4_PATTERN, data.text) or re.search(r"\A::ffff:\d+\.\d+\.\d+\.\d+\Z", data.text) or re.search(IPv6_PATTERN, data.text)):
+                    hostname = data.text.split("@")[0]
+                    hostname = hostname.lower().replace("::ffff:", "")
+                    hostname = hostname.replace("\\", "")
+                # Parse username
+                if data.get("Name") in "TargetUserName" and data.text is not None and not re.search(UCHECK, data.text):
+                    username = data.text.split("@")[0]
+                    if username[-1:] not in "$":
+                        username = username.lower() + "@"
+                    else:
+                        username = "-"
+                # Parse targeted domain name
+                if data.get("Name") in "TargetDomainName" and data.text is not None and not re.search(HCHECK, data.text):
+                    domain = data.text
+                # parse trageted user SID
+                if data.get("Name") in ["TargetUserSid", "TargetSid"] and data.text is not None and re.search(r"\AS-[0-9\-]*\Z", data.text):
+                    sid = data.text
+                # parse lonon type
+                if data.get("Name") in "LogonType" and re.search(r"\A\d{1,2}\Z", data.text):
+                    logintype = int(data.text)
+                # parse status
+                if data.get("Name") in "Status" and re.search(r"\A0x\w{8}\Z", data.text):
+                    status = data.text
+                # parse Authentication package name
+                if data.get("Name") in "AuthenticationPackageName" and re.search(r"\A\w*\Z", data.text):
+                    authname = data.text
+
+        if logintype == "-":
+            logintype = -1
+        records.append(eventid, utime, computer, channel, record_id, username, ipaddress, hostname, logintype,
+                       status, authname, domain, sid, extra, extra2)
+
+    records.trim()
+    return count, records, skipped
+
+
+# Elementwise membership test of a categorical column, evaluated once per distinct value
+def column_isin(column, values):
+    return np.append(np.isin(np.asarray(column.categories, dtype=object), values), False)[column.codes]
+
+
+# Keep the values a 4719 or group change record has, the missing ones stay those of the previous record
+def carry_fields(carried, names, *values):
+    for name, value in zip(names, values):
+        if not pd.isnull(value):
+            carried[name] = value
+        else:
+            carried.setdefault(name, "-")
+
+
+# Build the detection results of one file from its normalized record table
+def replay_records(table, tzone, fdatetime, tdatetime, checkpoints, symbols, spool, carried, dropped=None):
+    result = ParseResult()
+    eventid = np.asarray(table["eventid"])
+    etimes = np.asarray(table["time"]) + tzone * 3600
+    active = np.ones(len(eventid), dtype=bool)
+    if dropped is not None:
+        active = ~dropped
+
+    # skip the records ingested by a previous --incremental run
+    if checkpoints is not None:
+        recordid = np.asarray(table["recordid"])
+        computers = np.asarray(table["computer"].categories, dtype=object)
+        channels = np.asarray(table["channel"].categories, dtype=object)
+        limits = np.zeros((len(computers), len(channels)), dtype=np.int64)
+        for (computer, channel), record_id in checkpoints.items():
+            if computer in computers and channel in channels:
+                limits[computers.tolist().index(computer), channels.tolist().index(channel)] = record_id
+        active &= (recordid < 0) | (recordid > limits[table["computer"].codes, table["channel"].codes])
+    checked = active.copy()
+
+    is_event = np.isin(eventid, EVENT_ID)
+    if args.fromdate:
+        active &= ~(is_event & (etimes < calendar.timegm(fdatetime.timetuple())))
+    if args.todate:
+        stop = active & is_event & (etimes > calendar.timegm(tdatetime.timetuple()))
+        if stop.any():
+            cut = int(np.argmax(stop))
+            result.stoptime = EPOCH + datetime.timedelta(seconds=int(etimes[cut] // 3600 * 3600))
+            active[cut:] = False
+            checked[cut + 1:] = False
+
+    if checkpoints is not None:
+        rows = checked & (np.asarray(table["recordid"]) >= 0)
+        if rows.any():
+            latest = pd.DataFrame({"computer": table["computer"].codes[rows], "channel": table["channel"].codes[rows],
+                                   "recordid": np.asarray(table["recordid"])[rows]})
+            latest = latest.groupby(["computer", "channel"], sort=False)["recordid"].max()
+            result.checkpoints = {(table["computer"].categories[computer], table["channel"].categories[channel]): int(record_id)
+                                  for (computer, channel), record_id in latest.items()}
+
+    events = active & is_event
+    if events.any():
+        result.starttime = EPOCH + datetime.timedelta(seconds=int(etimes[events].min() // 3600 * 3600))
+        result.endtime = EPOCH + datetime.timedelta(seconds=int(etimes[events].max() // 3600 * 3600))
+
+    # logon records, kept as whole columns
+    username = table["username"]
+    ipaddress = table["ipaddress"]
+    hostname = table["hostname"]
+    no_ip = column_isin(ipaddress, ["-"])
+    logon = active & np.isin(eventid, TIMELINE_ID) & ~column_isin(username, ["-", "anonymous logon"]) & \
+        ~column_isin(ipaddress, ["::1", "127.0.0.1"]) & ~(no_ip & column_isin(hostname, ["-"]))
+    if logon.any():
+        users = username[logon]
+        user_ids = symbols.intern(users)
+        ips = ipaddress[logon]
+        hostnames = hostname[logon]
+        domain = table["domain"][logon]
+        sid = table["sid"][logon]
+        authname = table["authname"][logon]
+        hosts = np.where(no_ip[logon], symbols.intern(hostnames), symbols.intern(ips))
+        hour_list, hour_codes = np.unique(etimes[logon] // 3600 * 3600, return_inverse=True)
+        dates = np.array([int((EPOCH + datetime.timedelta(seconds=int(hour))).strftime("%s")) for hour in hour_list], dtype=np.int64)
+
+        # count the edges of each hour, the raw rows are not kept
+        edges = pd.DataFrame({"eventid": eventid[logon], "ipaddress": hosts, "username": user_ids,
+                              "logintype": np.asarray(table["logintype"])[logon], "status": symbols.intern(table["status"][logon]),
+                              "authname": symbols.intern(authname), "date": dates[hour_codes.ravel()],
+                              "dates": hour_list[hour_codes.ravel()]})
+        result.edges = edges.groupby(EDGE_KEYS, sort=False).size().rename("count").reset_index()
+        if spool is not None:
+            spool.write(etimes[logon], eventid[logon], user_ids, hosts)
+
+        result.username_set = pd.unique(np.asarray(users, dtype=object)).tolist()
+        has_domain = ~column_isin(domain, ["-"])
+        pairs = pd.DataFrame({"user": users[has_domain], "domain": domain[has_domain]}).drop_duplicates()
+        result.domain_set = list(zip(pairs["user"], pairs["domain"]))
+        result.domains = pd.unique(pairs["domain"].astype(object)).tolist()
+        has_sid = ~column_isin(sid, ["-"])
+        pairs = pd.DataFrame({"user": users[has_sid], "sid": sid[has_sid]}).drop_duplicates("user", keep="last")
+        result.sids = dict(zip(pairs["user"], pairs["sid"]))
+        has_host = ~column_isin(hostnames, ["-"]) & ~no_ip[logon]
+        pairs = pd.DataFrame({"hostname": hostnames[has_host], "ip": ips[has_host]}).drop_duplicates("hostname", keep="last")
+        result.hosts = dict(zip(pairs["hostname"], pairs["ip"]))
+        ntml = [name for name in authname.categories if name in "NTML"]
+        result.ntmlauth = pd.unique(np.asarray(users[column_isin(authname, ntml)], dtype=object)).tolist()
+
+    # other records in log order
+    admins = set()
+    for i in np.flatnonzero(active & np.isin(eventid, list(PREFILTER_ID - set(TIMELINE_ID)))):
+        etime = EPOCH + datetime.timedelta(seconds=int(etimes[i]))
+        logtime = etime.strftime("%Y-%m-%d %H:%M:%S")
+        code = eventid[i]
+        username = table["username"][i]
+        if code == 4672:
+            if username not in admins and username != "-":
+                admins.add(username)
+                result.admins.append(username)
+        elif code == 4720:
+            result.addusers[username] = logtime
+        elif code == 4726:
+            result.delusers[username] = logtime
+        elif code == 4719:
+            carry_fields(carried, ["category", "guid"], table["extra"][i], table["extra2"][i])
+            result.policylist.append([logtime, username, carried["category"], carried["guid"].lower(), int(datetime.datetime(*etime.timetuple()[:4]).strftime("%s"))])
+        elif code in [4728, 4732, 4756]:
+            carry_fields(carried, ["groupname", "usid"], table["extra"][i], table["extra2"][i])
+            result.addgroups[carried["usid"]] = "AddGroup: " + carried["groupname"] + "(" + logtime + ") "
+        elif code in [4729, 4733, 4757]:
+            carry_fields(carried, ["groupname", "usid"], table["extra"][i], table["extra2"][i])
+            result.removegroups[carried["usid"]] = "RemoveGroup: " + carried["groupname"] + "(" + logtime + ") "
+        elif code == 4662:
+            result.dcsync.append([table["extra"][i].split("\x00") if table["extra"][i] else [], logtime])
+        elif code in [5137, 5141]:
+            result.dcshadow.append([table["extra"][i].split("\x00") if table["extra"][i] else [], logtime])
+        elif code == 1102:
+            result.deletelog.extend([logtime, username, table["domain"][i]])
+
+    return result
+
+
+# Key the parsed-event cache by the content of the event log file
+def cache_key(filename):
+    digest = hashlib.sha1(("LogonTracer cache %i" % CACHE_VERSION).encode("utf-8"))
+    with open(filename, "rb") as fb:
+        data = fb.read(XML_READ_SIZE)
+        while data:
+            digest.update(data)
+            data = fb.read(XML_READ_SIZE)
+    return digest.hexdigest()
+
+
+# Load a cached record table, the columns are memory mapped .npy files
+def load_cache(key):
+    path = os.path.join(CACHE_PATH, key)
+    try:
+        with open(os.path.join(path, "meta.json"), "r") as fm:
+            meta = json.load(fm)
+        table = {}
+        for name, _ in RECORD_COLUMNS:
+            column = np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if meta["rows"] else None, allow_pickle=False)
+            if name in meta["vocab"]:
+                column = pd.Categorical.from_codes(column, categories=meta["vocab"][name])
+            table[name] = column
+    except (IOError, OSError, EOFError, KeyError, ValueError):
+        return None
+    # the last use orders the eviction
+    os.utime(path, None)
+    return meta["count"], table
+
+
+# Save a record table, string columns as their int32 category codes and the categories in a JSON header
+def save_cache(key, count, table):
+    path = os.path.join(CACHE_PATH, key)
+    tmp_path = "%s.tmp%i" % (path, os.getpid())
+    os.makedirs(tmp_path)
+    vocab = {}
+    for name, dtype in RECORD_COLUMNS:
+        column = table[name]
+        if dtype == "object":
+            vocab[name] = list(column.categories)
+            column = column.codes.astype(np.int32)
+        np.save(os.path.join(tmp_path, name + ".npy"), column)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as fm:
+        json.dump({"version": CACHE_VERSION, "count": count, "rows": len(table["eventid"]), "vocab": vocab}, fm)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+# Remove the least recently used cache entries above --cache-size MB
+def evict_cache():
+    if not os.path.isdir(CACHE_PATH):
+        return
+    entries = []
+    for name in os.listdir(CACHE_PATH):
+        path = os.path.join(CACHE_PATH, name)
+        if ".tmp" in name or not os.path.isdir(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, fname)) for fname in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= args.cache_size * 1024 * 1024:
+            break
+        shutil.rmtree(path)
+        total -= size
+        print("[*] Removed %s from the cache." % os.path.basename(path))
+
+
+# Map a whole file read-only, None for an empty file
+def map_file(fb):
+    try:
+        return mmap.mmap(fb.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return None
+
+
+# Check the EVTX header and read the last record number from the file and chunk headers
+def prescan_evtx(filename):
+    with open(filename, "rb") as fb:
+        data = map_file(fb)
+        if data is None:
+            return None
+        with data:
+            if data[0:8] != EVTX_HEADER:
+                return None
+            chunk_count = struct.unpack_from("<H", data, 42)[0]
+            chunk_count = min(chunk_count, (len(data) - EVTX_HEADER_SIZE) // EVTX_CHUNK_SIZE)
+            # the last chunk with records, starting from the second to last one
+            for i in range(chunk_count - 2, -1, -1):
+                last_record = struct.unpack_from("<Q", data, EVTX_HEADER_SIZE + i * EVTX_CHUNK_SIZE + 16)[0]
+                if last_record > 0:
+                    return last_record
+            return struct.unpack_from("<Q", data, 24)[0]
+
+
+# Check the XML declaration, the records are counted by the pull parser as they are read
+def prescan_xml(filename):
+    with open(filename, "rb") as fb:
+        head = fb.read(len(codecs.BOM_UTF8) + 6)
+    if head.startswith(codecs.BOM_UTF8):
+        head = head[len(codecs.BOM_UTF8):]
+    return b"<?xml" in head[0:6]
+
+
+# Oldest and newest record time in UTC epoch seconds and the last record number of each EVTX chunk,
+# read from the headers of its first record and of the last record the chunk header points to
+def chunk_bounds(filename):
+    bounds = []
+    with open(filename, "rb") as fb:
+        data = map_file(fb)
+        if data is None:
+            return bounds
+        with data:
+            chunk_count = struct.unpack_from("<H", data, 42)[0]
+            chunk_count = min(chunk_count, (len(data) - EVTX_HEADER_SIZE) // EVTX_CHUNK_SIZE)
+            for i in range(chunk_count):
+                chunk = EVTX_HEADER_SIZE + i * EVTX_CHUNK_SIZE
+                first = chunk + 0x200
+                last = chunk + struct.unpack_from("<I", data, chunk + 0x2C)[0]
+                if data[first:first + 4] != EVTX_RECORD_MAGIC or not first <= last <= chunk + EVTX_CHUNK_SIZE - 24 or \
+                        data[last:last + 4] != EVTX_RECORD_MAGIC:
+                    bounds.append(None)
+                    continue
+                times = [struct.unpack_from("<Q", data, offset + 16)[0] for offset in [first, last]]
+                bounds.append((min(times) // 10000000 - FILETIME_EPOCH, max(times) // 10000000 - FILETIME_EPOCH,
+                               struct.unpack_from("<Q", data, last + 8)[0]))
+
+    return bounds
+
+
+# Chunks to parse for a --from/--to window, up to the first chunk that starts after the window,
+# without the chunks whose records are all at or below the record number limit.
+# The chunks before the window are only read for their log clear records, which the window does not filter.
+def select_chunks(bounds, start, stop, limit):
+    selected = []
+    clears = set()
+    for i, times in enumerate(bounds):
+        if times is None or times[2] <= limit:
+            continue
+        if start is not None and times[1] < start:
+            clears.add(i)
+        selected.append(i)
+        if stop is not None and times[0] > stop:
+            break
+
+    return selected, clears, len(bounds)
+
+
+# Split the event logs into parse tasks
+def parse_tasks(evtx_list, files, selections, clears, limits, checkpoints):
+    tasks = []
+    for i in files:
+        evtx_file = evtx_list[i]
+        if args.evtx and (args.workers > 1 or i in selections):
+            if i in selections:
+                chunks = selections[i]
+            else:
+                with Evtx(evtx_file) as evtx:
+                    chunks = list(range(sum(1 for _ in evtx.chunks())))
+            step = max(1, len(chunks) // (args.workers * 4))
+            for first in range(0, len(chunks), step):
+                tasks.append((i, evtx_file, chunks[first:first + step], clears.get(i, set()), limits.get(i, 0), checkpoints))
+        else:
+            tasks.append((i, evtx_file, None, set(), 0, checkpoints))
+
+    return tasks
+
+
+# Computer and Channel of an EVTX file from its first record, None when its EventRecordIDs are not the record numbers
+def evtx_source(filename):
+    with Evtx(filename) as evtx:
+        for record in evtx.records():
+            node = to_lxml(record.xml())
+            if not XPATH_RECORDID(node) or int(XPATH_RECORDID(node)[0].text) != record.record_num():
+                return None
+            return XPATH_COMPUTER(node)[0].text, XPATH_CHANNEL(node)[0].text
+
+    return None
+
+
+# Send rows to neo4j in UNWIND batches of args.batch rows, one transaction per batch
+def load_rows(graph, statement, rows, name):
+    rows = iter(rows)
+    total = 0
+    start = time.time()
+    while True:
+        batch = list(itertools.islice(rows, args.batch))
+        if not batch:
+            break
+        btime = time.time()
+        tx = graph.begin()
+        tx.run(statement, {"rows": batch})
+        tx.commit()
+        total += len(batch)
+        sys.stdout.write("\r[*] Loaded %i %s rows (%i rows/s)." % (total, name, len(batch) / max(time.time() - btime, 0.001)))
+        sys.stdout.flush()
+
+    if total:
+        print("\n[*] Loaded %i %s rows in %.1f seconds." % (total, name, time.time() - start))
+
+
+# Path of a neo4j-admin import CSV file
+def csv_path(name):
+    return os.path.join(os.path.abspath(args.export_csv), name + ".csv")
+
+
+# Paths of the CSV files of a node label or relationship type, with the files of the rows that need other headers
+def csv_paths(name):
+    return [csv_path(name), csv_path(name + "_text"), csv_path(name + "_aggregate")]
+
+
+# Append rows to the neo4j-admin import CSV file of a node label or relationship type
+def export_rows(rows, name):
+    if name in CSV_NODES:
+        columns = CSV_NODES[name]
+    else:
+        columns = CSV_RELATIONSHIPS[name]
+    files = {}
+    total = 0
+    for row in rows:
+        # events without a logon type keep "-" as a string property in their own file
+        # summary links of the collapsed hosts start at Aggregate nodes
+        if name == "Event" and row["logintype"] == "-":
+            key = name + "_text"
+        elif name == "Summary" and row.get("aggregate"):
+            key = name + "_aggregate"
+        else:
+            key = name
+        if key not in files:
+            fcsv = open(csv_path(key), "w", newline="")
+            writer = csv.writer(fcsv)
+            if key == name:
+                writer.writerow([header for header, _ in columns])
+            elif key == name + "_text":
+                writer.writerow([header.replace("logintype:int", "logintype") for header, _ in columns])
+            else:
+                writer.writerow([header.replace("(IPAddress)", "(Aggregate)") for header, _ in columns])
+            files[key] = (fcsv, writer)
+        files[key][1].writerow([row[field] for _, field in columns])
+        total += 1
+
+    for fcsv, _ in files.values():
+        fcsv.close()
+    print("[*] Exported %i %s rows." % (total, name))
+
+
+# Write rows to neo4j, or to CSV files with --export-csv
+def store_rows(graph, statement, rows, name):
+    if args.export_csv:
+        export_rows(rows, name)
+    else:
+        load_rows(graph, statement, rows, name)
+
+
+# neo4j-admin import options for the exported CSV files
+def import_options():
+    options = []
+    for name in CSV_NODES:
+        if os.path.exists(csv_path(name)):
+            options.append("--nodes:%s=%s" % (name, csv_path(name)))
+    for name in CSV_RELATIONSHIPS:
+        for path in csv_paths(name):
+            if os.path.exists(path):
+                options.append("--relationships:%s=%s" % (name, path))
+
+    return options
 
 
 # Parse the EVTX file
-def parse_evtx(evtx_list):
-    event_set = pd.DataFrame(index=[], columns=["eventid", "ipaddress", "username", "logintype", "status", "authname", "date"])
-    count_set = pd.DataFrame(index=[], columns=["dates", "eventid", "username"])
-    ml_frame = pd.DataFrame(index=[], columns=["date", "user", "host", "id"])
-    username_set = []
-    domain_set = []
-    admins = []
-    domains = []
-    ntmlauth = []
-    deletelog = []
-    policylist = []
-    addusers = {}
-    delusers = {}
-    addgroups = {}
-    removegroups = {}
-    sids = {}
-    hosts = {}
-    dcsync_count = {}
-    dcsync = {}
-    dcshadow_check = []
-    dcshadow = {}
-    count = 0
+def parse_evtx(evtx_list, offsets=None):
     record_sum = 0
-    starttime = None
-    endtime = None
+    fdatetime = None
+    tdatetime = None
 
     if args.timezone:
         try:
@@ -608,364 +2760,349 @@ def parse_evtx(evtx_list):
 
     for evtx_file in evtx_list:
         if args.evtx:
-            with open(evtx_file, "rb") as fb:
-                fb_data = fb.read()[0:8]
-                if fb_data != EVTX_HEADER:
-                    sys.exit("[!] This file is not EVTX format {0}.".format(evtx_file))
-
-            chunk = -2
-            with Evtx(evtx_file) as evtx:
-                fh = evtx.get_file_header()
-                try:
-                    while True:
-                        last_chunk = list(evtx.chunks())[chunk]
-                        last_record = last_chunk.file_last_record_number()
-                        chunk -= 1
-                        if last_record > 0:
-                            record_sum = record_sum + last_record
-                            break
-                except:
-                    record_sum = record_sum + fh.next_record_number()
-
-        if args.xmls:
-            with open(evtx_file, "r") as fb:
-                fb_data = fb.read()
-                if "<?xml" not in fb_data[0:6]:
-                    sys.exit("[!] This file is not XML format {0}.".format(evtx_file))
-                record_sum += fb_data.count("<System>")
-                del fb_data
-
-    print("[*] Last record number is %i." % record_sum)
+            last_record = prescan_evtx(evtx_file)
+            if last_record is None:
+                sys.exit("[!] This file is not EVTX format {0}.".format(evtx_file))
+            record_sum += last_record
 
-    # Parse Event log
-    print("[*] Start parsing the EVTX file.")
+        if args.xmls and not prescan_xml(evtx_file):
+            sys.exit("[!] This file is not XML format {0}.".format(evtx_file))
 
-    for evtx_file in evtx_list:
-        print("[*] Parse the EVTX file %s." % evtx_file)
+    if args.evtx:
+        print("[*] Last record number is %i." % record_sum)
 
-        for node, err in xml_records(evtx_file):
-            if err is not None:
-                continue
-            count += 1
-            eventid = int(node.xpath("/Event/System/EventID")[0].text)
-
-            if not count % 100:
-                sys.stdout.write("\r[*] Now loading %i records." % count)
-                sys.stdout.flush()
-
-            if eventid in EVENT_ID:
-                logtime = node.xpath("/Event/System/TimeCreated")[0].get("SystemTime")
-                try:
-                    etime = datetime.datetime.strptime(logtime.split(".")[0], "%Y-%m-%d %H:%M:%S") + datetime.timedelta(hours=tzone)
-                except:
-                    etime = datetime.datetime.strptime(logtime.split(".")[0], "%Y-%m-%dT%H:%M:%S") + datetime.timedelta(hours=tzone)
-                stime = datetime.datetime(*etime.timetuple()[:4])
-                if args.fromdate or args.todate:
-                    if args.fromdate and fdatetime > etime:
-                        continue
-                    if args.todate and tdatetime < etime:
-                        endtime = stime
-                        break
-
-                if starttime is None:
-                    starttime = stime
-                elif starttime > etime:
-                    starttime = stime
-
-                if endtime is None:
-                    endtime = stime
-                elif endtime < etime:
-                    endtime = stime
-
-                event_data = node.xpath("/Event/EventData/Data")
-                logintype = "-"
-                username = "-"
-                domain = "-"
-                ipaddress = "-"
-                hostname = "-"
-                status = "-"
-                sid = "-"
-                authname = "-"
-
-                ###
-                # Detect admin users
-                #  EventID 4672: Special privileges assigned to new logon
-                ###
-                if eventid == 4672:
-                    for data in event_data:
-                        if data.get("Name") in "SubjectUserName" and data.text is not None and not re.search(UCHECK, data.text):
-                            username = data.text.split("@")[0]
-                            if username[-1:] not in "$":
-                                username = username.lower() + "@"
-                            else:
-                                username = "-"
-                    if username not in admins and username != "-":
-                        admins.append(username)
-                ###
-                # Detect removed user account and added user account.
-                #  EventID 4720: A user account was created
-                #  EventID 4726: A user account was deleted
-                ###
-                elif eventid in [4720, 4726]:
-                    for data in event_data:
-                        if data.get("Name") in "TargetUserName" and data.text is not None and not re.search(UCHECK, data.text):
-                            username = data.text.split("@")[0]
-                            if username[-1:] not in "$":
-                                username = username.lower() + "@"
-                            else:
-                                username = "-"
-                    if eventid == 4720:
-                        addusers[username] = etime.strftime("%Y-%m-%d %H:%M:%S")
-                    else:
-                        delusers[username] = etime.strftime("%Y-%m-%d %H:%M:%S")
-                ###
-                # Detect Audit Policy Change
-                #  EventID 4719: System audit policy was changed
-                ###
-                elif eventid == 4719:
-                    for data in event_data:
-                        if data.get("Name") in "SubjectUserName" and data.text is not None and not re.search(UCHECK, data.text):
-                            username = data.text.split("@")[0]
-                            if username[-1:] not in "$":
-                                username = username.lower() + "@"
-                            else:
-                                username = "-"
-                        if data.get("Name") in "CategoryId" and data.text is not None and re.search(r"\A%%\d{4}\Z", data.text):
-                            category = data.text
-                        if data.get("Name") in "SubcategoryGuid" and data.text is not None and re.search(r"\A{[\w\-]*}\Z", data.text):
-                            guid = data.text
-                    policylist.append([etime.strftime("%Y-%m-%d %H:%M:%S"), username, category, guid.lower(), int(stime.strftime("%s"))])
-                ###
-                # Detect added users from specific group
-                #  EventID 4728: A member was added to a security-enabled global group
-                #  EventID 4732: A member was added to a security-enabled local group
-                #  EventID 4756: A member was added to a security-enabled universal group
-                ###
-                elif eventid in [4728, 4732, 4756]:
-                    for data in event_data:
-                        if data.get("Name") in "TargetUserName" and data.text is not None and not re.search(UCHECK, data.text):
-                            groupname = data.text
-                        elif data.get("Name") in "MemberSid" and data.text not in "-" and data.text is not None and re.search(r"\AS-[0-9\-]*\Z", data.text):
-                            usid = data.text
-                    addgroups[usid] = "AddGroup: " + groupname + "(" + etime.strftime("%Y-%m-%d %H:%M:%S") + ") "
-                ###
-                # Detect removed users from specific group
-                #  EventID 4729: A member was removed from a security-enabled global group
-                #  EventID 4733: A member was removed from a security-enabled local group
-                #  EventID 4757: A member was removed from a security-enabled universal group
-                ###
-                elif eventid in [4729, 4733, 4757]:
-                    for data in event_data:
-                        if data.get("Name") in "TargetUserName" and data.text is not None and not re.search(UCHECK, data.text):
-                            groupname = data.text
-                        elif data.get("Name") in "MemberSid" and data.text not in "-" and data.text is not None and re.search(r"\AS-[0-9\-]*\Z", data.text):
-                            usid = data.text
-                    removegroups[usid] = "RemoveGroup: " + groupname + "(" + etime.strftime("%Y-%m-%d %H:%M:%S") + ") "
-                ###
-                # Detect DCSync
-                #  EventID 4662: An operation was performed on an object
-                ###
-                elif eventid == 4662:
-                    for data in event_data:
-                        if data.get("Name") in "SubjectUserName" and data.text is not None and not re.search(UCHECK, data.text):
-                            username = data.text.split("@")[0]
-                            if username[-1:] not in "$":
-                                username = username.lower() + "@"
-                            else:
-                                username = "-"
-                        dcsync_count[username] = dcsync_count.get(username, 0) + 1
-                        if dcsync_count[username] == 3:
-                            dcsync[username] = etime.strftime("%Y-%m-%d %H:%M:%S")
-                            dcsync_count[username] = 0
-                ###
-                # Detect DCShadow
-                #  EventID 5137: A directory service object was created
-                #  EventID 5141: A directory service object was deleted
-                ###
-                elif eventid in [5137, 5141]:
-                    for data in event_data:
-                        if data.get("Name") in "SubjectUserName" and data.text is not None and not re.search(UCHECK, data.text):
-                            username = data.text.split("@")[0]
-                            if username[-1:] not in "$":
-                                username = username.lower() + "@"
-                            else:
-                                username = "-"
-                        if etime.strftime("%Y-%m-%d %H:%M:%S") in dcshadow_check:
-                            dcshadow[username] = etime.strftime("%Y-%m-%d %H:%M:%S")
-                        else:
-                            dcshadow_check.append(etime.strftime("%Y-%m-%d %H:%M:%S"))
-                ###
-                # Parse logon logs
-                #  EventID 4624: An account was successfully logged on
-                #  EventID 4625: An account failed to log on
-                #  EventID 4768: A Kerberos authentication ticket (TGT) was requested
-                #  EventID 4769: A Kerberos service ticket was requested
-                #  EventID 4776: The domain controller attempted to validate the credentials for an account
-                ###
-                else:
-                    for data in event_data:
-                        # parse IP Address
-                        if data.get("Name") in ["IpAddress", "Workstation"] and data.text is not None and (not re.search(HCHECK, data.text) or re.search(IPv4_PATTERN, data.text) or re.search(r"\A::ffff:\d+\.\d+\.\d+\.\d+\Z", data.text) or re.search(IPv6_PATTERN, data.text)):
-                            ipaddress = data.text.split("@")[0]
-                            ipaddress = ipaddress.lower().replace("::ffff:", "")
-                            ipaddress = ipaddress.replace("\\", "")
-                        # Parse hostname
-                        if data.get("Name") == "WorkstationName" and data.text is not None and (not re.search(HCHECK, data.text) or re.search(IPv4_PATTERN, data.text) or re.search(r"\A::ffff:\d+\.\d+\.\d+\.\d+\Z", data.text) or re.search(IPv6_PATTERN, data.text)):
-                            hostname = data.text.split("@")[0]
-                            hostname = hostname.lower().replace("::ffff:", "")
-                            hostname = hostname.replace("\\", "")
-                        # Parse username
-                        if data.get("Name") in "TargetUserName" and data.text is not None and not re.search(UCHECK, data.text):
-                            username = data.text.split("@")[0]
-                            if username[-1:] not in "$":
-                                username = username.lower() + "@"
-                            else:
-                                username = "-"
-                        # Parse targeted domain name
-                        if data.get("Name") in "TargetDomainName" and data.text is not None and not re.search(HCHECK, data.text):
-                            domain = data.text
-                        # parse trageted user SID
-                        if data.get("Name") in ["TargetUserSid", "TargetSid"] and data.text is not None and re.search(r"\AS-[0-9\-]*\Z", data.text):
-                            sid = data.text
-                        # parse lonon type
-                        if data.get("Name") in "LogonType" and re.search(r"\A\d{1,2}\Z", data.text):
-                            logintype = int(data.text)
-                        # parse status
-                        if data.get("Name") in "Status" and re.search(r"\A0x\w{8}\Z", data.text):
-                            status = data.text
-                        # parse Authentication package name
-                        if data.get("Name") in "AuthenticationPackageName" and re.search(r"\A\w*\Z", data.text):
-                            authname = data.text
-
-                    if username != "-" and username != "anonymous logon" and ipaddress != "::1" and ipaddress != "127.0.0.1" and (ipaddress != "-" or hostname != "-"):
-                        # generate pandas series
-                        if ipaddress != "-":
-                            event_series = pd.Series([eventid, ipaddress, username, logintype, status, authname, int(stime.strftime("%s"))], index=event_set.columns)
-                            ml_series = pd.Series([etime.strftime("%Y-%m-%d %H:%M:%S"), username, ipaddress, eventid],  index=ml_frame.columns)
-                        else:
-                            event_series = pd.Series([eventid, hostname, username, logintype, status, authname, int(stime.strftime("%s"))], index=event_set.columns)
-                            ml_series = pd.Series([etime.strftime("%Y-%m-%d %H:%M:%S"), username, hostname, eventid],  index=ml_frame.columns)
-                        # append pandas series to dataframe
-                        event_set = event_set.append(event_series, ignore_index=True)
-                        ml_frame = ml_frame.append(ml_series, ignore_index=True)
-                        # print("%s,%i,%s,%s,%s,%s" % (eventid, ipaddress, username, comment, logintype))
-                        count_series = pd.Series([stime.strftime("%Y-%m-%d %H:%M:%S"), eventid, username], index=count_set.columns)
-                        count_set = count_set.append(count_series, ignore_index=True)
-                        # print("%s,%s" % (stime.strftime("%Y-%m-%d %H:%M:%S"), username))
-
-                        if domain != "-":
-                            domain_set.append([username, domain])
-
-                        if username not in username_set:
-                            username_set.append(username)
-
-                        if domain not in domains and domain != "-":
-                            domains.append(domain)
-
-                        if sid != "-":
-                            sids[username] = sid
-
-                        if hostname != "-" and ipaddress != "-":
-                            hosts[hostname] = ipaddress
-
-                        if authname in "NTML" and authname not in ntmlauth:
-                            ntmlauth.append(username)
-            ###
-            # Detect the audit log deletion
-            # EventID 1102: The audit log was cleared
-            ###
-            if eventid == 1102:
-                logtime = node.xpath("/Event/System/TimeCreated")[0].get("SystemTime")
-                try:
-                    etime = datetime.datetime.strptime(logtime.split(".")[0], "%Y-%m-%d %H:%M:%S") + datetime.timedelta(hours=tzone)
-                except:
-                    etime = datetime.datetime.strptime(logtime.split(".")[0], "%Y-%m-%dT%H:%M:%S") + datetime.timedelta(hours=tzone)
-                deletelog.append(etime.strftime("%Y-%m-%d %H:%M:%S"))
-
-                namespace = "http://manifests.microsoft.com/win/2004/08/windows/eventlog"
-                user_data = node.xpath("/Event/UserData/ns:LogFileCleared/ns:SubjectUserName", namespaces={"ns": namespace})
-                domain_data = node.xpath("/Event/UserData/ns:LogFileCleared/ns:SubjectDomainName", namespaces={"ns": namespace})
-
-                if user_data[0].text is not None:
-                    username = user_data[0].text.split("@")[0]
-                    if username[-1:] not in "$":
-                        deletelog.append(username.lower())
-                    else:
-                        deletelog.append("-")
-                else:
-                    deletelog.append("-")
+    # Parse Event log
+    print("[*] Start parsing the EVTX file.")
 
-                if domain_data[0].text is not None:
-                    deletelog.append(domain_data[0].text)
+    if args.incremental:
+        state = load_state()
+        checkpoints = state.result.checkpoints
+        print("[*] Skip the records ingested before from %i sources." % len(checkpoints))
+    else:
+        state = None
+        checkpoints = None
+
+    # Find the files parsed before, their record tables are loaded one at a time in the replay.
+    # Watched files are still growing, they are neither hashed nor cached.
+    use_cache = args.cache_size > 0 and offsets is None
+    keys = {}
+    cached = set()
+    if use_cache:
+        for i, evtx_file in enumerate(evtx_list):
+            keys[i] = cache_key(evtx_file)
+            if os.path.exists(os.path.join(CACHE_PATH, keys[i], "meta.json")):
+                cached.add(i)
+
+    files = [i for i in range(len(evtx_list)) if i not in cached]
+
+    # Skip the EVTX chunks outside --from/--to, ingested by a previous --incremental run
+    # or read by an earlier poll of --watch, only whole files are cached
+    selections = {}
+    clears = {}
+    limits = {}
+    reached = {}
+    partial_files = set()
+    if args.evtx and (args.fromdate or args.todate or checkpoints or offsets is not None) and files:
+        start = calendar.timegm(fdatetime.timetuple()) - tzone * 3600 if args.fromdate else None
+        stop = calendar.timegm(tdatetime.timetuple()) - tzone * 3600 if args.todate else None
+        chunk_sum = 0
+        for i in files:
+            bounds = chunk_bounds(evtx_list[i])
+            if checkpoints:
+                limits[i] = checkpoints.get(evtx_source(evtx_list[i]), 0)
+            if offsets is not None:
+                reached[evtx_list[i]] = max([times[2] for times in bounds if times is not None] or [0])
+                # a file with fewer records than before was replaced and is read again
+                if offsets.get(evtx_list[i], 0) <= reached[evtx_list[i]]:
+                    limits[i] = max(limits.get(i, 0), offsets.get(evtx_list[i], 0))
+            selections[i], clears[i], chunk_count = select_chunks(bounds, start, stop, limits.get(i, 0))
+            chunk_sum += chunk_count
+            if len(selections[i]) - len(clears[i]) < chunk_count or limits.get(i, 0):
+                partial_files.add(i)
+        print("[*] Parse %i of %i EVTX chunks in the time range and after the checkpoints, and the log clear records of %i chunks before it." %
+              (sum(map(len, selections.values())) - sum(map(len, clears.values())), chunk_sum, sum(map(len, clears.values()))))
+
+    tasks = parse_tasks(evtx_list, files, selections, clears, limits, checkpoints)
+    if args.workers > 1 and tasks:
+        print("[*] Parse %i tasks with %i workers." % (len(tasks), args.workers))
+        pool = multiprocessing.Pool(args.workers)
+        partials = pool.imap(parse_records, tasks)
+    else:
+        pool = None
+
+    # Replay the records of each file in log order with this run's time zone, --from/--to and checkpoints,
+    # only the aggregates and the HMM spool are kept once a file is done
+    result = ParseResult()
+    symbols = state.symbols if state is not None else SymbolTable()
+    spool = EventSpool()
+    records = RecordFilter(args.dedup_size) if args.dedup_size > 0 else None
+    carried = {}
+    pending = collections.deque(tasks)
+    loaded = 0
+    for i in range(len(evtx_list)):
+        table = load_cache(keys[i]) if i in cached else None
+        if table is not None:
+            print("[*] Load the parsed records of %s from the cache." % evtx_list[i])
+            count, table = table
+        else:
+            # the tasks of a file come in order, a broken cache entry is parsed again here
+            if i in cached:
+                file_tasks = parse_tasks(evtx_list, [i], {}, {}, {}, checkpoints)
+            else:
+                file_tasks = []
+                while pending and pending[0][0] == i:
+                    file_tasks.append(pending.popleft())
+            count = 0
+            buffer = EventBuffer(RECORD_COLUMNS)
+            for task in file_tasks:
+                if pool is None or i in cached:
+                    task_count, task_records, skipped = parse_records(task, loaded)
                 else:
-                    deletelog.append("-")
+                    task_count, task_records, skipped = next(partials)
+                if skipped:
+                    partial_files.add(i)
+                loaded += task_count
+                count += task_count
+                buffer.extend(task_records)
+                if pool is not None:
+                    sys.stdout.write("\r[*] Now loading %i records." % loaded)
+                    sys.stdout.flush()
+            table = {name: buffer.column(name) for name, _ in RECORD_COLUMNS}
+            del buffer
+            if use_cache and i not in partial_files:
+                save_cache(keys[i], count, table)
+
+        dropped = records.duplicates(table) if records is not None else None
+        partial = replay_records(table, tzone, fdatetime, tdatetime, checkpoints, symbols, spool, carried, dropped)
+        partial.count = count
+        result.merge(partial)
+        del table, dropped
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if use_cache and len(cached) < len(evtx_list):
+        evict_cache()
 
     print("\n[*] Load finished.")
-    print("[*] Total Event log is %i." % count)
+    print("[*] Total Event log is %i." % result.count)
+    if records is not None:
+        print("[*] Dropped %i duplicate records." % records.dropped)
+
+    if args.map:
+        save_partial(args.map, result, spool, symbols)
+        spool.close()
+        print("[*] Wrote the partial aggregates to %s." % args.map)
+        return
+
+    create_graph(result, spool, symbols, state)
+    spool.close()
+    if offsets is not None:
+        offsets.update(reached)
+
+
+# Write the aggregates of a --map run as numpy arrays and a JSON header, strings are stored once in the symbol list
+def save_partial(path, result, spool, symbols):
+    meta = result_meta(result)
+    meta.update({"version": PARTIAL_VERSION, "symbols": symbols.names, "edges": result.edges is not None})
+
+    records = spool.records()
+    arrays = {"meta": np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)}
+    for name, _ in SPOOL_DTYPE:
+        arrays["sequence_" + name] = records[name]
+    if result.edges is not None:
+        for name in EDGE_KEYS + ["count"]:
+            arrays["edge_" + name] = result.edges[name].values
+
+    with open(path + ".tmp", "wb") as fp:
+        np.savez_compressed(fp, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+# Read a partial aggregate file, moving its ids into this run's symbol table
+def load_partial(path, symbols):
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+            if not isinstance(meta, dict) or meta.get("version") != PARTIAL_VERSION:
+                sys.exit("[!] {0} is not a partial aggregate file of this version.".format(path))
+            sequences = {name: data["sequence_" + name] for name, _ in SPOOL_DTYPE}
+            edges = {name: data["edge_" + name] for name in EDGE_KEYS + ["count"]} if meta["edges"] else None
+    except (IOError, OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        sys.exit("[!] Can't read the partial aggregates {0}.".format(path))
+
+    ids = symbols.intern(meta["symbols"])
+    result = meta_result(meta)
+    if edges is not None:
+        result.edges = pd.DataFrame(edges, columns=EDGE_KEYS + ["count"])
+        for name in ["ipaddress", "username", "status", "authname"]:
+            result.edges[name] = ids[result.edges[name].values]
+    records = np.empty(len(sequences["time"]), dtype=SPOOL_DTYPE)
+    for name, _ in SPOOL_DTYPE:
+        records[name] = ids[sequences[name]] if name in ["user", "host"] else sequences[name]
+
+    return result, records
+
+
+# Combine the partial aggregates of --map runs in the given order
+def reduce_partials(paths):
+    if args.incremental:
+        state = load_state()
+        symbols = state.symbols
+    else:
+        state = None
+        symbols = SymbolTable()
+
+    result = ParseResult()
+    spool = EventSpool()
+    for path in paths:
+        print("[*] Read the partial aggregates %s." % path)
+        partial, records = load_partial(path, symbols)
+        result.merge(partial)
+        spool.write_records(records)
+    print("[*] Total Event log is %i." % result.count)
+
+    create_graph(result, spool, symbols, state)
+    spool.close()
+
+
+# Detect, rank and load the aggregated records into neo4j
+def create_graph(result, spool, symbols, state):
+    if result.edges is None:
+        result.edges = pd.DataFrame(np.zeros((0, len(EDGE_KEYS) + 1), dtype=np.int64), columns=EDGE_KEYS + ["count"])
+    new_edges = result.edges
+
+    # Merge the new records into the aggregates of the previous runs
+    if state is not None:
+        if not len(new_edges) and len(result.checkpoints) == 0:
+            print("[*] No new records to add.")
+            return
+        dcsync = detect_dcsync(result.dcsync, state.dcsync_count, state.dcsync)
+        dcshadow = detect_dcshadow(result.dcshadow, state.dcshadow_check, state.dcshadow)
+        result.dcsync = []
+        result.dcshadow = []
+        old_hosts = dict(state.result.hosts)
+        old_edges = state.result.edges
+        state.result.merge(result)
+        result = state.result
+    else:
+        dcsync = detect_dcsync(result.dcsync)
+        dcshadow = detect_dcshadow(result.dcshadow)
+
+    username_set = result.username_set
+    domain_set = result.domain_set
+    admins = result.admins
+    domains = result.domains
+    ntmlauth = result.ntmlauth
+    deletelog = result.deletelog
+    policylist = result.policylist
+    addusers = result.addusers
+    delusers = result.delusers
+    addgroups = result.addgroups
+    removegroups = result.removegroups
+    sids = result.sids
+    hosts = result.hosts
+    starttime = result.starttime
+    endtime = result.endtime
 
     if not username_set:
         sys.exit("[!] This event log did not include logs to be visualized. Please check the details of the event log.")
 
     tohours = int((endtime - starttime).total_seconds() / 3600)
 
-    if hosts:
-        event_set = event_set.replace(hosts)
-    event_set_bydate = event_set
-    event_set_bydate["count"] = event_set_bydate.groupby(["eventid", "ipaddress", "username", "logintype", "status", "authname", "date"])["eventid"].transform("count")
-    event_set_bydate = event_set_bydate.drop_duplicates()
-    event_set = event_set.drop("date", axis=1)
-    event_set["count"] = event_set.groupby(["eventid", "ipaddress", "username", "logintype", "status", "authname"])["eventid"].transform("count")
-    event_set = event_set.drop_duplicates()
-    count_set["count"] = count_set.groupby(["dates", "eventid", "username"])["dates"].transform("count")
-    count_set = count_set.drop_duplicates()
-    domain_set_uniq = list(map(list, set(map(tuple, domain_set))))
-
-    # Learning event logs using Hidden Markov Model
-    if hosts:
-        ml_frame = ml_frame.replace(hosts)
-    ml_frame = ml_frame.sort_values(by="date")
+    event_set_bydate, event_set, count_set = edge_frames(result.edges, hosts, symbols)
+    domain_set_uniq = [list(pair) for pair in domain_set]
+    user_ids = symbols.intern(username_set)
+    admin_set = set(admins)
+
+    # Learning event logs using Hidden Markov Model, the tail kept from the previous run is already remapped
+    host_ids = symbols.remap(hosts) if hosts else None
+    hmm_tail = state.hmm_tail if state is not None else None
     if args.learn:
         print("[*] Learning event logs using Hidden Markov Model.")
-        learnhmm(ml_frame, username_set, datetime.datetime(*starttime.timetuple()[:3]))
+        learnhmm(spool.day_blocks(host_ids, hmm_tail), user_ids, symbols, datetime.datetime(*starttime.timetuple()[:3]))
 
     # Calculate ChangeFinder
     print("[*] Calculate ChangeFinder.")
-    timelines, detects, detect_cf = adetection(count_set, username_set, starttime, tohours)
+    user_counts, detects, detect_cf = adetection(count_set, user_ids, starttime, tohours)
+    timelines = timeline_rows(user_counts, detects, starttime)
 
     # Calculate Hidden Markov Model
     print("[*] Calculate Hidden Markov Model.")
-    detect_hmm = decodehmm(ml_frame, username_set, datetime.datetime(*starttime.timetuple()[:3]))
+    detect_hmm = decodehmm(spool.day_blocks(host_ids, hmm_tail), user_ids, datetime.datetime(*starttime.timetuple()[:3]))
+    if state is not None:
+        # sequences of the last day continue in the next run
+        detected = set(state.detect_hmm)
+        detect_hmm = state.detect_hmm + [user for user in detect_hmm if user not in detected]
+        state.detect_hmm = detect_hmm
+        if spool.rows or hmm_tail is not None:
+            state.hmm_tail = spool.last_day(host_ids, hmm_tail)
 
     # Calculate PageRank
     print("[*] Calculate PageRank.")
-    ranks = pagerank(event_set, admins, detect_hmm, detect_cf, ntmlauth)
+    ranks = pagerank(event_set, symbols.intern(admins), detect_hmm, detect_cf, symbols.intern(ntmlauth))
+
+    # Calculate the shortest paths to the admin users
+    print("[*] Calculate the shortest paths to admin users.")
+    distances, nexthops = admin_paths(event_set, symbols.intern(admins))
+
+    # Summarize the graph for the overview
+    if args.summary_top > 0:
+        print("[*] Summarize the graph to the top %i users and hosts." % args.summary_top)
+        groups, aggregate_rows, summary_rows = summarize(event_set, ranks, symbols, args.summary_top)
+    else:
+        groups, aggregate_rows, summary_rows = {}, [], []
 
     # Create node
     print("[*] Creating a graph data.")
 
-    try:
-        graph_http = "http://" + NEO4J_USER + ":" + NEO4J_PASSWORD + "@" + NEO4J_SERVER + ":" + NEO4J_PORT + "/db/data/"
-        GRAPH = Graph(graph_http)
-    except:
-        sys.exit("[!] Can't connect Neo4j Database.")
+    if args.export_csv:
+        if state is not None:
+            sys.exit("[!] --export-csv can't be used with --incremental.")
+        GRAPH = None
+        if not os.path.isdir(args.export_csv):
+            os.makedirs(args.export_csv)
+        for name in list(CSV_NODES) + list(CSV_RELATIONSHIPS):
+            for path in csv_paths(name):
+                if os.path.exists(path):
+                    os.remove(path)
+    else:
+        try:
+            graph_http = "http://" + NEO4J_USER + ":" + NEO4J_PASSWORD + "@" + NEO4J_SERVER + ":" + NEO4J_PORT + "/db/data/"
+            GRAPH = Graph(graph_http)
+        except:
+            sys.exit("[!] Can't connect Neo4j Database.")
+
+        for statement in statement_index:
+            GRAPH.run(statement)
 
-    tx = GRAPH.begin()
     hosts_inv = {v: k for k, v in hosts.items()}
-    for ipaddress in event_set["ipaddress"].drop_duplicates():
+    ip_rows = []
+    for ip_id in event_set["ipaddress"].drop_duplicates():
+        ipaddress = symbols.names[ip_id]
         if ipaddress in hosts_inv:
             hostname = hosts_inv[ipaddress]
         else:
             hostname = ipaddress
-        # add the IPAddress node to neo4j
-        tx.append(statement_ip, {"IP": ipaddress, "rank": ranks[ipaddress], "hostname": hostname})
-
+        if nexthops[ip_id] >= 0:
+            nexthop = symbols.names[nexthops[ip_id]][:-1]
+        else:
+            nexthop = "-"
+        ip_rows.append({"IP": ipaddress, "rank": ranks[ip_id], "hostname": hostname, "group": groups.get(ip_id, "-"),
+                        "distance": distances[ip_id], "nexthop": nexthop})
+    if state is not None:
+        ip_rows = state.changed_rows(ip_rows, "IPAddress", "IP")
+    # add the IPAddress node to neo4j
+    store_rows(GRAPH, statement_ip, ip_rows, "IPAddress")
+
+    user_rows = []
     i = 0
-    for username in username_set:
+    for username, user_id in zip(username_set, user_ids):
         if username in sids:
             sid = sids[username]
         else:
             sid = "-"
-        if username in admins:
+        if username in admin_set:
             rights = "system"
         else:
             rights = "user"
@@ -984,39 +3121,79 @@ def parse_evtx(evtx_list):
             ustatus += "DCShadow(" + dcshadow[username] + ") "
         if not ustatus:
             ustatus = "-"
+        if nexthops.get(user_id, -1) >= 0:
+            nexthop = symbols.names[nexthops[user_id]]
+        else:
+            nexthop = "-"
 
-        # add the username node to neo4j
-        tx.append(statement_user, {"user": username[:-1], "rank": ranks[username], "rights": rights, "sid": sid, "status": ustatus,
-                                   "counts": ",".join(map(str, timelines[i*6])), "counts4624": ",".join(map(str, timelines[i*6+1])),
-                                   "counts4625": ",".join(map(str, timelines[i*6+2])), "counts4768": ",".join(map(str, timelines[i*6+3])),
-                                   "counts4769": ",".join(map(str, timelines[i*6+4])), "counts4776": ",".join(map(str, timelines[i*6+5])),
-                                   "detect": ",".join(map(str, detects[i]))})
+        user_row = {"user": username[:-1], "rank": ranks[user_id], "rights": rights, "sid": sid, "status": ustatus,
+                    "distance": distances.get(user_id, -1), "nexthop": nexthop}
+        user_row.update(timelines[i])
+        user_rows.append(user_row)
         i += 1
-
-    for domain in domains:
-        # add the domain node to neo4j
-        tx.append(statement_domain, {"domain": domain})
-
-    for _, events in event_set_bydate.iterrows():
-        # add the (username)-(event)-(ip) link to neo4j
-        tx.append(statement_r, {"user": events["username"][:-1], "IP": events["ipaddress"], "id": events["eventid"], "logintype": events["logintype"],
-                                "status": events["status"], "count": events["count"], "authname": events["authname"], "date": events["date"]})
-
-    for username, domain in domain_set_uniq:
-        # add (username)-()-(domain) link to neo4j
-        tx.append(statement_dr, {"user": username[:-1], "domain": domain})
+    if state is not None:
+        user_rows = state.changed_rows(user_rows, "Username", "user")
+    # add the username node to neo4j
+    store_rows(GRAPH, statement_user, user_rows, "Username")
+
+    domain_rows = [{"domain": domain} for domain in domains]
+    if state is not None:
+        domain_rows = state.changed_rows(domain_rows, "Domain", "domain")
+    # add the domain node to neo4j
+    store_rows(GRAPH, statement_domain, domain_rows, "Domain")
+
+    # add the (username)-(event)-(ip) link to neo4j, only the new counts with --incremental
+    # each run is numbered, the number changes once the state of a finished run is saved
+    if state is not None:
+        event_set_bydate = edge_frames(new_edges, hosts, symbols)[0]
+        statement = statement_r_add
+        ingest = state.ingests + 1
+        # the links written before under a host name or an older IP address move to its IP address
+        moved = [hostname for hostname, ip in hosts.items() if old_hosts.get(hostname, hostname) != ip]
+        if moved and old_edges is not None:
+            edges = old_edges[np.isin(old_edges["ipaddress"].values, symbols.intern(moved))]
+            removed = edge_frames(edges, old_hosts, symbols)[0]
+            removed["count"] = -removed["count"]
+            event_set_bydate = pd.concat([event_set_bydate, edge_frames(edges, hosts, symbols)[0], removed], ignore_index=True)
+            event_set_bydate = event_set_bydate.groupby(EDGE_COLUMNS + ["date"], sort=False)["count"].sum().reset_index()
+            event_set_bydate = event_set_bydate[event_set_bydate["count"] != 0]
+            for hostname in moved:
+                state.written.get("IPAddress", {}).pop(hostname, None)
+    else:
+        statement = statement_r
+    columns = [symbols.lookup(event_set_bydate[name].values) if name in ["username", "ipaddress", "status", "authname"] else event_set_bydate[name].tolist()
+               for name in ["username", "ipaddress", "eventid", "logintype", "status", "count", "authname", "date"]]
+    columns[3] = [logintype if logintype >= 0 else "-" for logintype in columns[3]]
+    event_rows = ({"user": username[:-1], "IP": ipaddress, "id": eventid, "logintype": logintype, "status": status,
+                   "count": count, "authname": authname, "date": date}
+                  for username, ipaddress, eventid, logintype, status, count, authname, date in zip(*columns))
+    if state is not None:
+        event_rows = (dict(row, ingest=ingest) for row in event_rows)
+    store_rows(GRAPH, statement, event_rows, "Event")
+
+    if state is not None:
+        domain_set_uniq = [pair for pair in domain_set_uniq if tuple(pair) not in state.groups]
+        state.groups.update(map(tuple, domain_set_uniq))
+    # add (username)-()-(domain) link to neo4j
+    store_rows(GRAPH, statement_dr_add if state is not None else statement_dr,
+               ({"user": username[:-1], "domain": domain} for username, domain in domain_set_uniq), "Group")
 
     # add the date node to neo4j
-    tx.append(statement_date, {"Daterange": "Daterange", "start": datetime.datetime(*starttime.timetuple()[:4]).strftime("%Y-%m-%d %H:%M:%S"),
-                               "end": datetime.datetime(*endtime.timetuple()[:4]).strftime("%Y-%m-%d %H:%M:%S")})
+    store_rows(GRAPH, statement_date, [{"Daterange": "Daterange", "start": datetime.datetime(*starttime.timetuple()[:4]).strftime("%Y-%m-%d %H:%M:%S"),
+                                       "end": datetime.datetime(*endtime.timetuple()[:4]).strftime("%Y-%m-%d %H:%M:%S")}], "Date")
 
     if len(deletelog):
         # add the delete flag node to neo4j
-        tx.append(statement_del, {"deletetime": deletelog[0], "user": deletelog[1], "domain": deletelog[2]})
+        store_rows(GRAPH, statement_del, [{"deletetime": deletelog[0], "user": deletelog[1], "domain": deletelog[2]}], "Deletetime")
 
     if len(policylist):
+        policy_rows = []
+        link_rows = []
         id = 0
-        for policy in policylist:
+        if state is not None:
+            id = state.policies
+            state.policies = len(policylist)
+        for policy in policylist[id:]:
             if policy[2] in CATEGORY_IDs:
                 category = CATEGORY_IDs[policy[2]]
             else:
@@ -1026,19 +3203,104 @@ def parse_evtx(evtx_list):
             else:
                 sub = policy[3]
             username = policy[1]
-            # add the policy id node to neo4j
-            tx.append(statement_pl, {"id": id, "changetime": policy[0], "category": category, "sub": sub})
-            # add (username)-(policy)-(id) link to neo4j
-            tx.append(statement_pr, {"user": username[:-1], "id": id, "date": policy[4]})
+            policy_rows.append({"id": id, "changetime": policy[0], "category": category, "sub": sub})
+            link_rows.append({"user": username[:-1], "id": id, "date": policy[4]})
             id += 1
-
-    tx.process()
-    tx.commit()
+        # add the policy id node to neo4j
+        store_rows(GRAPH, statement_pl, policy_rows, "ID")
+        # add (username)-(policy)-(id) link to neo4j
+        store_rows(GRAPH, statement_pr_add if state is not None else statement_pr, link_rows, "Policy")
+
+    # add the summary graph to neo4j, rebuilt from the new ranks
+    if GRAPH is not None:
+        for statement in statement_summary_clear:
+            GRAPH.run(statement)
+    store_rows(GRAPH, statement_aggregate, aggregate_rows, "Aggregate")
+    store_rows(GRAPH, statement_summary, [row for row in summary_rows if not row["aggregate"]], "Summary")
+    store_rows(GRAPH, statement_summary_aggregate, [row for row in summary_rows if row["aggregate"]], "Summary")
+
+    if state is not None:
+        state.ingests = ingest
+        save_state(state)
+        if moved:
+            for statement in statement_r_clear:
+                GRAPH.run(statement, hosts=moved + [old_hosts[hostname] for hostname in moved if hostname in old_hosts])
+    if args.export_csv:
+        print("[*] Import the graph data with: neo4j-admin import " + " ".join(import_options()))
+    else:
+        mark_ingest()
     print("[*] Creation of a graph data finished.")
 
 
+# Touch the ingest stamp, the web application drops its cached query results
+def mark_ingest():
+    if not os.path.isdir(os.path.dirname(INGEST_STAMP)):
+        os.makedirs(os.path.dirname(INGEST_STAMP))
+    with open(INGEST_STAMP, "w") as fs:
+        fs.write(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"))
+
+
+# Ingest one micro batch of event logs with --incremental, the EVTX files are read from their offsets
+def ingest_logs(paths, offsets):
+    evtx_files = [path for path in paths if path.lower().endswith(".evtx")]
+    xml_files = [path for path in paths if path.lower().endswith(".xml")]
+    for files, is_evtx in [(evtx_files, True), (xml_files, False)]:
+        if not files:
+            continue
+        args.evtx = files if is_evtx else None
+        args.xmls = None if is_evtx else files
+        print("[*] Ingest %s." % ", ".join(files))
+        try:
+            parse_evtx(files, offsets)
+        except SystemExit as e:
+            print(e.code)
+        except Exception as e:
+            print("[!] Can't ingest %s: %s" % (", ".join(files), e))
+        finally:
+            args.evtx = None
+            args.xmls = None
+
+
+# Poll a directory and ingest the new or growing event logs in micro batches
+def watch_logs(directory):
+    args.incremental = True
+    ingested = {}
+    pending = {}
+    # last EVTX record number read from each file
+    offsets = {}
+    print("[*] Watching %s for event logs." % directory)
+    while True:
+        now = time.time()
+        ready = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not name.lower().endswith((".evtx", ".xml")):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            if ingested.get(path) == signature:
+                continue
+            # wait until a file stops changing, but not longer than WATCH_LATENCY
+            if path in pending and (pending[path][0] == signature or now - pending[path][1] >= WATCH_LATENCY - WATCH_INTERVAL):
+                ready.append(path)
+                ingested[path] = signature
+                del pending[path]
+            elif path in pending:
+                pending[path][0] = signature
+            else:
+                pending[path] = [signature, now]
+
+        if ready:
+            ingest_logs(ready, offsets)
+            print("[*] Watching %s for event logs." % directory)
+        time.sleep(max(0, WATCH_INTERVAL - (time.time() - now)))
+
+
 def main():
-    if not has_py2neo:
+    if not has_py2neo and not args.export_csv:
         sys.exit("[!] py2neo must be installed for this script.")
 
     if not has_evtx:
@@ -1050,8 +3312,8 @@ def main():
     if not has_numpy:
         sys.exit("[!] numpy must be installed for this script.")
 
-    if not has_changefinder:
-        sys.exit("[!] changefinder must be installed for this script.")
+    if not has_scipy:
+        sys.exit("[!] scipy must be installed for this script.")
 
     if not has_pandas:
         sys.exit("[!] pandas must be installed for this script.")
@@ -1062,11 +3324,17 @@ def main():
     if not has_sklearn:
         sys.exit("[!] scikit-learn must be installed for this script.")
 
-    try:
-        graph_http = "http://" + NEO4J_USER + ":" + NEO4J_PASSWORD + "@" + NEO4J_SERVER + ":" + NEO4J_PORT + "/db/data/"
-        GRAPH = Graph(graph_http)
-    except:
-        sys.exit("[!] Can't connect Neo4j Database.")
+    # --export-csv only writes the files of an offline neo4j-admin import
+    if args.export_csv:
+        if args.delete or args.incremental or args.watch:
+            sys.exit("[!] --export-csv can't be used with --delete, --incremental or --watch.")
+        GRAPH = None
+    else:
+        try:
+            graph_http = "http://" + NEO4J_USER + ":" + NEO4J_PASSWORD + "@" + NEO4J_SERVER + ":" + NEO4J_PORT + "/db/data/"
+            GRAPH = Graph(graph_http)
+        except:
+            sys.exit("[!] Can't connect Neo4j Database.")
 
     print("[*] Script start. %s" % datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
 
@@ -1079,8 +3347,29 @@ def main():
     # Delete database data
     if args.delete:
         GRAPH.delete_all()
+        if os.path.exists(STATE_PATH):
+            os.remove(STATE_PATH)
+        mark_ingest()
         print("[*] Delete all nodes and relationships from this Neo4j database.")
 
+    # the counts of a graph loaded without the ingest state would be added twice
+    if (args.incremental or args.watch) and not os.path.exists(STATE_PATH) and GRAPH.evaluate(statement_event_count):
+        sys.exit("[!] This database was not loaded with --incremental. Add --delete to rebuild it.")
+
+    if args.watch:
+        if not os.path.isdir(args.watch):
+            sys.exit("[!] Can't open directory {0}.".format(args.watch))
+        try:
+            watch_logs(args.watch)
+        except KeyboardInterrupt:
+            print("\n[*] Stop watching %s." % args.watch)
+
+    if args.map:
+        if args.incremental:
+            sys.exit("[!] --map can't be used with --incremental.")
+        if args.evtx and args.xmls:
+            sys.exit("[!] --map takes either EVTX or XML files.")
+
     if args.evtx:
         for evtx_file in args.evtx:
             if not os.path.isfile(evtx_file):
@@ -1093,6 +3382,12 @@ def main():
                 sys.exit("[!] Can't open file {0}.".format(xml_file))
         parse_evtx(args.xmls)
 
+    if args.reduce:
+        for partial_file in args.reduce:
+            if not os.path.isfile(partial_file):
+                sys.exit("[!] Can't open file {0}.".format(partial_file))
+        reduce_partials(args.reduce)
+
     print("[*] Script end. %s" % datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
 
 
@@ -77,6 +77,17 @@ function buildGraph(graph, path, root) {
         nfcolor = "#b23aa2"
         ntype = "Domain"
       }
+      if (path[idx].labels[0] == "Aggregate") {
+        nname = path[idx].properties.name
+        nshape = "roundrectangle"
+        nfsize = "10"
+        ncolor = "#2e8b57"
+        nbcolor = "#98fb98"
+        nfcolor = "#3cb371"
+        ntype = "Aggregate"
+        nsub = path[idx].properties.hosts
+        ncategory = path[idx].properties.kind
+      }
       if (path[idx].labels[0] == "ID") {
         nname = path[idx].properties.changetime
         nuser = path[idx].properties.user
@@ -109,6 +120,7 @@ function buildGraph(graph, path, root) {
           "nsid": path[idx].properties.sid,
           "nstatus": path[idx].properties.status,
           "nhostname": path[idx].properties.hostname,
+          "ndistance": path[idx].properties.distance,
           "nsub": nsub,
           "ncategory": ncategory
         }
@@ -174,6 +186,20 @@ function buildGraph(graph, path, root) {
             "authname": path[idx].properties.authname
           }
         });
+      } else if (path[idx].type == "Summary") {
+        graph.edges.push({
+          "data": {
+            "id": objid,
+            "source": parseInt(path[parseInt(idx) - 1].identity.low) + 100,
+            "target": parseInt(path[parseInt(idx) + 1].identity.low) + 100,
+            "objid": objid,
+            "elabel": String(path[idx].properties.count),
+            "label": path[idx].type,
+            "distance": 5,
+            "ntype": "edge",
+            "count": parseInt(path[idx].properties.count)
+          }
+        });
       } else {
         graph.edges.push({
           "data": {
@@ -303,8 +329,15 @@ function qtipNode(ndata) {
     qtext += '<br>Privilege: ' + ndata._private.data["nprivilege"];
     qtext += '<br>SID: ' + ndata._private.data["nsid"];
     qtext += '<br>Status: ' + ndata._private.data["nstatus"];
+    qtext += '<br>Distance to SYSTEM: ' + distanceText(ndata._private.data["ndistance"]);
   } else if (ndata._private.data["ntype"] == "Host") {
     qtext += '<br>Hostname: ' + ndata._private.data["nhostname"];
+    qtext += '<br>Distance to SYSTEM: ' + distanceText(ndata._private.data["ndistance"]);
+  } else if (ndata._private.data["ntype"] == "Aggregate") {
+    qtext += '<br>Grouped by: ' + ndata._private.data["ncategory"];
+    qtext += '<br>Hosts: ' + ndata._private.data["nsub"];
+    qtext += '<br><button type="button" class="btn btn-primary btn-xs" onclick="expandQuery(\'' + ndata._private.data["nlabel"] + '\')">expand</button>';
+    return qtext;
   } else if (ndata._private.data["ntype"] == "Policy") {
     qtext = "";
     qtext += 'Date: ' + ndata._private.data["nlabel"];
@@ -317,6 +350,17 @@ function qtipNode(ndata) {
   return qtext;
 }
 
+/*
+distanceText
+This function formats the hop distance to the nearest system privilege user.
+*/
+function distanceText(distance) {
+  if (distance == null || distance < 0) {
+    return "-";
+  }
+  return distance + " hops";
+}
+
 /*
 qtipEdge
 This function generate the description text for each edge.
@@ -345,6 +389,8 @@ function qtipEdge(ndata) {
     qtext += "<br>Status: " + ndata._private.data["status"];
   } else if (ndata._private.data["label"] == "Group") {
     qtext = "Domain group";
+  } else if (ndata._private.data["label"] == "Summary") {
+    qtext = "<b>All events</b><br>Count: " + ndata._private.data["count"];
   } else {
     qtext = "Audit policy change";
   }
@@ -357,12 +403,44 @@ This function execute neo4j query and show all users in specific time period wit
 The result is filtered by Event ID selected in the check box.
 */
 function createAllQuery() {
-  var eidStr = getQueryID();
-  var dateStr = getDateRange();
-  eidStr = eidStr.slice(4);
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE ' + eidStr + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/all?' + $.param(getQueryParams()), "noRoot");
+}
+
+/*
+summaryQuery
+This function shows the summary graph precomputed at ingest: the top ranked users and hosts,
+and the lower ranked hosts grouped by subnet or community.
+*/
+function summaryQuery() {
+  executeView('api/graph/summary?' + $.param(getQueryParams()), "noRoot");
+}
+
+/*
+expandQuery
+This function replaces an aggregate node of the shown graph with the events of its hosts.
+*/
+function expandQuery(name) {
+  var graph = {
+    "nodes": [],
+    "edges": []
+  };
+  if (currentView) {
+    var aggregate = null;
+    for (var i = 0; i < currentView.graph.nodes.length; i++) {
+      if (currentView.graph.nodes[i].data.ntype == "Aggregate" && currentView.graph.nodes[i].data.nlabel == name) {
+        aggregate = currentView.graph.nodes[i].data.id;
+      }
+    }
+    graph.nodes = $.grep(currentView.graph.nodes, function(elem) {
+      return elem.data.id != aggregate;
+    });
+    graph.edges = $.grep(currentView.graph.edges, function(elem) {
+      return elem.data.source != aggregate && elem.data.target != aggregate;
+    });
+  }
+  var params = getQueryParams();
+  params.name = name;
+  executeView('api/expand?' + $.param(params), "noRoot", graph);
 }
 
 /*
@@ -371,11 +449,7 @@ This function execute neo4j query and show all system privilege users in specifi
 The result is filtered by Event ID selected in the check box.
 */
 function createSystemQuery() {
-  var eidStr = getQueryID();
-  var dateStr = getDateRange();
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE user.rights = "system" ' + eidStr + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/system?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -384,11 +458,7 @@ This function execute neo4j query and show RDP logon users in specific time peri
 The result is filtered by Event ID selected in the check box.
 */
 function createRDPQuery() {
-  var eidStr = getQueryID();
-  var dateStr = getDateRange();
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE event.logintype = 10 ' + eidStr + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/rdp?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -397,11 +467,7 @@ This function execute neo4j query and show users who logon via network in specif
 The result is filtered by Event ID selected in the check box.
 */
 function createNetQuery() {
-  var eidStr = getQueryID();
-  var dateStr = getDateRange();
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE event.logintype = 3 ' + eidStr + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/network?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -410,11 +476,7 @@ This function execute neo4j query and show users who logon by batch script in sp
 The result is filtered by Event ID selected in the check box.
 */
 function createBatchQuery() {
-  var eidStr = getQueryID();
-  var dateStr = getDateRange();
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE event.logintype = 4 ' + eidStr + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/batch?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -423,11 +485,7 @@ This function execute neo4j query and show users who logon from windows service
 The result is filtered by Event ID selected in the check box.
 */
 function createServiceQuery() {
-  var eidStr = getQueryID();
-  var dateStr = getDateRange();
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE event.logintype = 5 ' + eidStr + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/service?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -435,10 +493,7 @@ create14068Query
 This function execute neo4j query and show users who attempted to exploit MS14-068 in specific time period with graph.
 */
 function create14068Query() {
-  var dateStr = getDateRange();
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE event.status =~ ".*0F" AND event.id = 4769 ' + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/ms14068?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -446,10 +501,7 @@ createFailQuery
 This function execute neo4j query and show users who failed to logon in specific time period with graph.
 */
 function createFailQuery() {
-  var dateStr = getDateRange();
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE event.id = 4625 ' + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/failed?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -457,10 +509,7 @@ createNTLMQuery
 This function execute neo4j query and show users who login with NTLM authentication in specific time period with graph.
 */
 function createNTLMQuery() {
-  var dateStr = getDateRange();
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE event.id = 4624 and event.authname = "NTLM" and event.logintype = 3 ' + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/ntlm?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -468,10 +517,7 @@ adddelUserQuery
 This function execute neo4j query and show users who had be created or deleted in specific time period with graph.
 */
 function adddelUsersQuery() {
-  var dateStr = getDateRange();
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE (user.status =~ "Created.*") OR (user.status =~ ".*Deleted.*") OR (user.status =~ ".*RemoveGroup.*") OR (user.status =~ ".*AddGroup.*") ' + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/adddel?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -479,10 +525,7 @@ dcsQuery
 This function execute neo4j query and show users who executed DCSync or DCShadow in specific time period with graph.
 */
 function dcsQuery() {
-  var dateStr = getDateRange();
-  var queryStr = 'MATCH (user)-[event:Event]-(ip) WHERE (user.status =~ ".*DCSync.*") OR (user.status =~ ".*DCShadow.*") ' + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/dcs?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -490,9 +533,7 @@ dcsQuery
 This function execute neo4j query and show users who executed DCSync or DCShadow in specific time period with graph.
 */
 function createDomainQuery() {
-  var queryStr = 'MATCH (user)-[event:Group]-(ip) RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/domain?' + $.param(getQueryParams()), "noRoot");
 }
 
 /*
@@ -500,75 +541,43 @@ policyQuery
 This function execute neo4j query and show users who changed the audit policy in specific time period with graph.
 */
 function policyQuery() {
-  var dateStr = getDateRange();
-  dateStr = dateStr.slice(5);
-  queryStr = 'MATCH (user)-[event:Policy]-(ip) WHERE ' + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, "noRoot");
+  executeView('api/graph/policy?' + $.param(getQueryParams()), "noRoot");
 }
 
 function createRankQuery(setStr, qType) {
-  var dateStr = getDateRange();
   if (qType == "User") {
-    whereStr = 'user.user = "' + setStr + '" ';
-  }
-  if (qType == "Host") {
-    whereStr = 'ip.IP = "' + setStr + '" ';
-  }
-
-  if (qType != "Domain") {
-    eidStr = getQueryID();
-    queryStr = 'MATCH (user)-[event:Event]-(ip)  WHERE (' + whereStr + ') ' + eidStr + dateStr + ' RETURN user, event, ip';
+    var params = getQueryParams();
+    params.field = "Username";
+  } else if (qType == "Host") {
+    var params = getQueryParams();
+    params.field = "IPAddress";
   } else {
-    queryStr = 'MATCH (user)-[event:Group]-(ip) WHERE user.domain = "' + setStr + '" RETURN user, event, ip'
+    var params = {};
+    params.field = "Domain";
   }
-  //console.log(queryStr);
-  executeQuery(queryStr, setStr);
+  params.value = setStr;
+  params.exact = 1;
+  executeView('api/search?' + $.param(params, true), setStr);
 }
 
 /*
-getQueryID
-This function generate the neo4j query strings to filter Windows Event ID and ID count.
+getQueryParams
+This function generates the query API parameters to filter Windows Event ID, ID count and events in specific time period.
 */
-function getQueryID() {
-  var id4624Ch = document.getElementById("id4624").checked;
-  var id4625Ch = document.getElementById("id4625").checked;
-  var id4768Ch = document.getElementById("id4768").checked;
-  var id4769Ch = document.getElementById("id4769").checked;
-  var id4776Ch = document.getElementById("id4776").checked;
-  var countInt = document.getElementById("count-input").value;
-  var eidStr = "AND ("
-  if (id4624Ch) {
-    eidStr = eidStr + "event.id = 4624 OR ";
-  }
-  if (id4625Ch) {
-    eidStr = eidStr + "event.id = 4625 OR ";
-  }
-  if (id4768Ch) {
-    eidStr = eidStr + "event.id = 4768 OR ";
-  }
-  if (id4769Ch) {
-    eidStr = eidStr + "event.id = 4769 OR ";
-  }
-  if (id4776Ch) {
-    eidStr = eidStr + "event.id = 4776 OR ";
+function getQueryParams() {
+  var ids = [];
+  var eventIDs = [4624, 4625, 4768, 4769, 4776];
+  for (var i = 0; i < eventIDs.length; i++) {
+    if (document.getElementById("id" + eventIDs[i]).checked) {
+      ids.push(eventIDs[i]);
+    }
   }
-  eidStr = eidStr.slice(0, -4) + ")";
-  eidStr = eidStr + " AND event.count > " + countInt;
-
-  return eidStr;
-}
-
-/*
-getDateRange
-This function generates a neo4j query strings to filter events in specific time period.
-*/
-function getDateRange() {
-  var fromDate = new Date(document.getElementById("from-date").value).getTime() / 1000;
-  var toDate = new Date(document.getElementById("to-date").value).getTime() / 1000;
-  var dateStr = " AND (event.date >= " + fromDate + " AND event.date <= " + toDate + ")";
-
-  return dateStr;
+  return {
+    "ids": ids.join(","),
+    "count": document.getElementById("count-input").value,
+    "from": new Date(document.getElementById("from-date").value).getTime() / 1000,
+    "to": new Date(document.getElementById("to-date").value).getTime() / 1000
+  };
 }
 
 /*
@@ -576,212 +585,262 @@ createQuery
 This function generates a neo4j query strings from search box and execute the query.
 */
 function createQuery() {
-  var selectVal = document.getElementById("InputSelect").value;
   var setStr = document.getElementById("query-input").value;
-  var dateStr = getDateRange();
-
-  if (selectVal == "Username") {
-    whereStr = 'user.user =~ "' + setStr + '" ';
-  } else if (selectVal == "IPAddress") {
-    whereStr = 'ip.IP =~ "' + setStr + '" ';
-  } else {
-    whereStr = 'ip.hostname =~ "' + setStr + '" ';
-  }
+  var params = getQueryParams();
+  params.field = [document.getElementById("InputSelect").value];
+  params.value = [setStr];
+  params.rule = [];
 
   for (i = 1; i <= currentNumber; i++) {
     if (document.getElementById("query-input" + i).value) {
-      ruleStr = document.getElementById("InputRule" + i).value;
-      if (document.getElementById("InputSelect" + i).value == "Username") {
-        whereStr += ruleStr + ' user.user =~ "' + document.getElementById("query-input" + i).value + '" ';
-      } else if (document.getElementById("InputSelect" + i).value == "IPAddress") {
-        whereStr += ruleStr + ' ip.IP =~ "' + document.getElementById("query-input" + i).value + '" ';
-      } else {
-        whereStr += ruleStr + ' ip.hostname =~ "' + document.getElementById("query-input" + i).value + '" ';
-      }
+      params.field.push(document.getElementById("InputSelect" + i).value);
+      params.value.push(document.getElementById("query-input" + i).value);
+      params.rule.push(document.getElementById("InputRule" + i).value);
     }
   }
 
-  eidStr = getQueryID()
-  queryStr = 'MATCH (user)-[event:Event]-(ip)  WHERE (' + whereStr + ') ' + eidStr + dateStr + ' RETURN user, event, ip';
-  //console.log(queryStr);
-  executeQuery(queryStr, setStr);
+  executeView('api/search?' + $.param(params, true), setStr);
 }
 
 /*
 searchPath
-This function execute a neo4j query strings to search the shortest path to system privilege in specific time period.
+This function shows the shortest path to system privilege in specific time period.
+The path follows the next hops to the nearest system privilege user calculated at ingest.
 */
 function searchPath() {
   var setStr = document.getElementById("query-input").value;
-  var dateStr = getDateRange();
-  dateStr = dateStr.slice(5);
+  var params = getQueryParams();
+  params.user = setStr;
 
-  queryStr = 'MATCH (from:Username) WHERE from.user = "' + setStr + '" \
-              MATCH (to:Username) WHERE to.rights = "system" \
-              MATCH (user:Username) WHERE user IN shortestPath((from)-[:Event*]-(to)) \
-              MATCH (ip:IPAddress) WHERE ip IN shortestPath((from)-[:Event*]-(to)) \
-              MATCH (user)-[event]-(ip) WHERE ' + dateStr + ' \
-              RETURN user, ip, event'
+  executeView('api/path?' + $.param(params), setStr);
+}
 
-  //console.log(queryStr);
-  executeQuery(queryStr, setStr);
+/*
+showGraph
+This function draws the graph built from the query result.
+*/
+function showGraph(graph, root) {
+  if (graph.nodes.length == 0) {
+    searchError();
+    document.getElementById('loading').classList.add("loaded");
+  } else {
+    //console.log(graph);
+    if (root == "noRoot") {
+      rootNode = graph.nodes[0].data.id;
+    } else {
+      for (var i = 0; i < graph.nodes.length; i++) {
+        if (graph.nodes[i].data.nlabel == root) {
+          rootNode = graph.nodes[i].data.id;
+        }
+      }
+    }
+    drawGraph(graph, rootNode);
+  }
 }
 
 /*
-sendQuery
-This function sends the query to neo4j.
-If the query success, this function build the graph and draw it from the neo4j query result.
+readElement
+This function adds a graph element of the query API stream to the view.
+Nodes come before their first edge, each edge is passed to buildGraph as [user, event, ip].
 */
-function sendQuery(queryStr, root) {
-  var graph = {
-    "nodes": [],
-    "edges": []
-  };
+function readElement(view, element) {
+  if (element[0] == "node") {
+    view.nodes[element[1]] = {
+      "identity": {"low": element[1]},
+      "labels": [element[2]],
+      "properties": element[3]
+    };
+  } else if (element[0] == "edge") {
+    var event = {
+      "identity": {"low": element[1]},
+      "type": element[2],
+      "start": element[4],
+      "end": element[3],
+      "properties": element[5]
+    };
+    view.graph = buildGraph(view.graph, [view.nodes[element[3]], event, view.nodes[element[4]]], view.root);
+    view.count++;
+  } else {
+    view.cursor = element[1];
+  }
+}
+
+/*
+sendView
+This function reads one page of the query API as newline-delimited JSON and draws the graph so far.
+The next pages follow until the graph gets large, then the warning asks to continue.
+*/
+function sendView(view) {
+  var url = view.url + "&format=ndjson";
+  if (view.cursor) {
+    url += "&cursor=" + encodeURIComponent(view.cursor);
+  }
+  var buffer = "";
+  var decoder = new TextDecoder();
 
   var loading = document.getElementById('loading');
   loading.classList.remove('loaded');
 
-  session.run(queryStr)
-    .subscribe({
-      onNext: function(record) {
-        //console.log(record.get('user'), record.get('event'), record.get('ip'));
-        graph = buildGraph(graph, [record.get("user"), record.get("event"), record.get("ip")], root);
-      },
-      onCompleted: function() {
-        session.close();
-        if (graph.nodes.length == 0) {
-          searchError();
-          loading.classList.add("loaded");
-        } else {
-          //console.log(graph);
-          if (root == "noRoot") {
-            rootNode = graph.nodes[0].data.id;
-          } else {
-            for (var i = 0; i < graph.nodes.length; i++) {
-              if (graph.nodes[i].data.nlabel == root) {
-                rootNode = graph.nodes[i].data.id;
-              }
+  fetch(url)
+    .then(function(response) {
+      if (!response.ok) {
+        throw new Error(response.statusText);
+      }
+      var reader = response.body.getReader();
+      var read = function() {
+        return reader.read().then(function(chunk) {
+          if (chunk.done) {
+            return;
+          }
+          buffer += decoder.decode(chunk.value, {stream: true});
+          var lines = buffer.split("\n");
+          buffer = lines.pop();
+          for (var i = 0; i < lines.length; i++) {
+            if (lines[i]) {
+              readElement(view, JSON.parse(lines[i]));
             }
           }
-          drawGraph(graph, rootNode);
+          return read();
+        });
+      };
+      return read();
+    })
+    .then(function() {
+      if (view != currentView) {
+        return;
+      }
+      showGraph(view.graph, view.root);
+      if (view.cursor) {
+        if (view.count > view.warnCount) {
+          view.warnCount += 3000;
+          $('#warningMessage').modal({
+            show: true,
+            backdrop: 'false'
+          });
+        } else {
+          sendView(view);
         }
-      },
-      onError: function(error) {
-        searchError();
-        console.log("Error: ", error);
       }
+    })
+    .catch(function(error) {
+      searchError();
+      console.log("Error: ", error);
     });
 }
 
 /*
-executeQuery
-This function executes the neo4j query.
+executeView
+This function shows a graph from the query API page by page in rank order.
 */
-function executeQuery(queryStr, root) {
-  var countStr = queryStr.replace("user, event, ip", "COUNT(event)");
+function executeView(viewUrl, root, graph) {
+  if (!graph) {
+    graph = {
+      "nodes": [],
+      "edges": []
+    };
+  }
+  currentView = {
+    "url": viewUrl,
+    "root": root,
+    "graph": graph,
+    "nodes": {},
+    "cursor": null,
+    "count": 0,
+    "warnCount": 3000
+  };
+  sendView(currentView);
+}
 
-  session.run(countStr)
-    .subscribe({
-      onNext: function(record) {
-        recordCount = record._fields[0].low;
-      },
-      onCompleted: function() {
-        session.close();
-        if (recordCount > 3000) {
-          setqueryStr = queryStr;
-          $('#warningMessage').modal({
-            show: true,
-            backdrop: 'false'
-          });
-        } else {
-          sendQuery(queryStr, root);
-        }
+/*
+loadView
+This function reads all pages of the query API as JSON and passes the graph to the callback.
+*/
+function loadView(viewUrl, callback, view) {
+  if (!view) {
+    view = {
+      "url": viewUrl,
+      "root": "noRoot",
+      "graph": {
+        "nodes": [],
+        "edges": []
       },
-      onError: function(error) {
-        searchError();
-        console.log("Error: ", error);
+      "nodes": {},
+      "cursor": null,
+      "count": 0
+    };
+  }
+  var url = view.url + "&limit=5000";
+  if (view.cursor) {
+    url += "&cursor=" + encodeURIComponent(view.cursor);
+  }
+
+  fetch(url)
+    .then(function(response) {
+      if (!response.ok) {
+        throw new Error(response.statusText);
+      }
+      return response.json();
+    })
+    .then(function(page) {
+      for (var i = 0; i < page.nodes.length; i++) {
+        readElement(view, ["node"].concat(page.nodes[i]));
+      }
+      for (var i = 0; i < page.edges.length; i++) {
+        readElement(view, ["edge"].concat(page.edges[i]));
+      }
+      view.cursor = page.cursor;
+      if (view.cursor) {
+        loadView(viewUrl, callback, view);
+      } else {
+        callback(view.graph);
       }
+    })
+    .catch(function(error) {
+      searchError();
+      document.getElementById('loading').classList.add("loaded");
+      console.log("Error: ", error);
     });
 }
 
 /*
 diffQuery
-This function compare 2 days events from neo4j.
-If the query success, this function build the graph and draw it from the neo4j query result.
+This function compare 2 days events from the query API.
+If the query success, this function build the graph and draw it from the query result.
 */
 function diffQuery() {
-  var graph1 = {
-    "nodes": [],
-    "edges": []
-  };
-
-  root = "noRoot"
   var date1st = new Date(document.getElementById("from-day").value).getTime() / 1000;
+  var loading = document.getElementById('loading');
+  loading.classList.remove('loaded');
 
-  queryStr1st = 'MATCH (user)-[event:Event]-(ip)  WHERE event.date >= ' + date1st + ' AND event.date <= ' + (date1st + 86400) + ' RETURN user, event, ip';
-
-  session.run(queryStr1st)
-    .subscribe({
-      onNext: function(record) {
-        //console.log(record.get('user'), record.get('event'), record.get('ip'));
-        graph1 = buildGraph(graph1, [record.get("user"), record.get("event"), record.get("ip")], root);
-      },
-      onCompleted: function() {
-        session.close();
-        if (graph1.nodes.length == 0) {
-          searchError();
-        } else {
-          diffNext(graph1);
-        }
-      },
-      onError: function(error) {
-        searchError();
-        console.log("Error: ", error);
-      }
-    });
+  loadView('api/graph/all?' + $.param({"from": date1st, "to": date1st + 86400}), function(graph1) {
+    if (graph1.nodes.length == 0) {
+      searchError();
+      loading.classList.add("loaded");
+    } else {
+      diffNext(graph1);
+    }
+  });
 }
 
 function diffNext(graph1) {
-  var graph2 = {
-    "nodes": [],
-    "edges": []
-  };
-
-  root = "noRoot"
   var date2nd = new Date(document.getElementById("to-day").value).getTime() / 1000;
-
-  queryStr2nd = 'MATCH (user)-[event:Event]-(ip)  WHERE event.date >= ' + date2nd + ' AND event.date <= ' + (date2nd + 86400) + ' RETURN user, event, ip';
-
   var loading = document.getElementById('loading');
-  loading.classList.remove('loaded');
 
-  session.run(queryStr2nd)
-    .subscribe({
-      onNext: function(record) {
-        //console.log(record.get('user'), record.get('event'), record.get('ip'));
-        graph2 = buildGraph(graph2, [record.get("user"), record.get("event"), record.get("ip")], root);
-      },
-      onCompleted: function() {
-        session.close();
-        if (graph2.nodes.length == 0) {
-          searchError();
-          loading.classList.add("loaded");
-        } else {
-          graph2.edges = getArrayDiff(graph1, graph2);
-          graph2.nodes = nodeConcat(graph1, graph2);
-          if (graph2.edges.length > 0) {
-            drawGraph(graph2, graph2.nodes[0].data.id);
-          } else{
-            searchError();
-            loading.classList.add("loaded");
-          }
-        }
-      },
-      onError: function(error) {
+  loadView('api/graph/all?' + $.param({"from": date2nd, "to": date2nd + 86400}), function(graph2) {
+    if (graph2.nodes.length == 0) {
+      searchError();
+      loading.classList.add("loaded");
+    } else {
+      graph2.edges = getArrayDiff(graph1, graph2);
+      graph2.nodes = nodeConcat(graph1, graph2);
+      if (graph2.edges.length > 0) {
+        drawGraph(graph2, graph2.nodes[0].data.id);
+      } else {
         searchError();
-        console.log("Error: ", error);
+        loading.classList.add("loaded");
       }
-    });
+    }
+  });
 }
 
 function getArrayDiff(arr1, arr2) {
@@ -802,10 +861,10 @@ function nodeConcat(arr1, arr2) {
   });
 }
 
-var setqueryStr = "";
+var currentView = null;
 
-function contQuery() {
-  sendQuery(setqueryStr, "noRoot");
+function contView() {
+  sendView(currentView);
 }
 
 function pruserBack() {
@@ -813,7 +872,7 @@ function pruserBack() {
   if (rankpageUser < 0) {
     rankpageUser = 0;
   }
-  pagerankQuery(userqueryStr, "User", rankpageUser);
+  pagerankQuery("User", rankpageUser);
 }
 
 function pruserNext() {
@@ -821,7 +880,7 @@ function pruserNext() {
   if (rankpageUser < 0) {
     rankpageUser = 0;
   }
-  pagerankQuery(userqueryStr, "User", rankpageUser);
+  pagerankQuery("User", rankpageUser);
 }
 
 function prhostBack() {
@@ -829,7 +888,7 @@ function prhostBack() {
   if (rankpageHost < 0) {
     rankpageHost = 0;
   }
-  pagerankQuery(ipqueryStr, "Host", rankpageHost);
+  pagerankQuery("Host", rankpageHost);
 }
 
 function prhostNext() {
@@ -837,90 +896,53 @@ function prhostNext() {
   if (rankpageHost < 0) {
     rankpageHost = 0;
   }
-  pagerankQuery(ipqueryStr, "Host", rankpageHost);
+  pagerankQuery("Host", rankpageHost);
 }
 
-function pagerankQuery(queryStr, dataType, currentPage) {
-  var nodes = new Array();
+/*
+pagerankQuery
+This function shows one page of the users or hosts in PageRank order from the rank API.
+*/
+function pagerankQuery(dataType, currentPage) {
   var html = '<div><table class="table table-striped"><thead><tr class="col-sm-2 col-md-2">\
               <th class="col-sm-1 col-md-1">Rank</th><th class="col-sm-1 col-md-1">' + dataType +
     '</th></tr></thead><tbody class="col-sm-2 col-md-2">';
-  var startRunk = currentPage * 10;
-  queryStr = queryStr + " SKIP " + startRunk + " LIMIT " + 10;
-  session.run(queryStr)
-    .subscribe({
-      onNext: function(record) {
-        nodeData = record.get("node");
-        if (dataType == "User") {
-          nodes.push([nodeData.properties.user, nodeData.properties.rank]);
-        }
-        if (dataType == "Host") {
-          nodes.push([nodeData.properties.IP, nodeData.properties.rank]);
-        }
-      },
-      onCompleted: function() {
-        session.close();
-        for (i = 0; i < nodes.length; i++) {
-          html += '<tr><td>' + (currentPage * 10 + i + 1) + '</td><td><a onclick="createRankQuery(\'' + nodes[i][0] + '\', \'' + dataType + '\')">' + nodes[i][0] + '</a></td></tr>';
-          //console.log(nodes[i][0]);
-          //console.log(hosts[i][0]);
-        }
-        html += '</tbody></table></div>';
 
-        if (dataType == "User") {
-          var rankElem = document.getElementById("rankUser");
-        }
-        if (dataType == "Host") {
-          var rankElem = document.getElementById("rankHost");
-        }
-        rankElem.innerHTML = html;
-      },
-      onError: function(error) {
-        console.log("Error: ", error);
+  fetch('api/rank/' + dataType.toLowerCase() + '?' + $.param({"page": currentPage}))
+    .then(function(response) {
+      if (!response.ok) {
+        throw new Error(response.statusText);
+      }
+      return response.json();
+    })
+    .then(function(nodes) {
+      for (i = 0; i < nodes.length; i++) {
+        html += '<tr><td>' + (currentPage * 10 + i + 1) + '</td><td><a onclick="createRankQuery(\'' + nodes[i][0] + '\', \'' + dataType + '\')">' + nodes[i][0] + '</a></td></tr>';
       }
+      html += '</tbody></table></div>';
+
+      if (dataType == "User") {
+        var rankElem = document.getElementById("rankUser");
+      }
+      if (dataType == "Host") {
+        var rankElem = document.getElementById("rankHost");
+      }
+      rankElem.innerHTML = html;
+    })
+    .catch(function(error) {
+      console.log("Error: ", error);
     });
 }
 
+/*
+exportCSV
+This function downloads the logon events as CSV from the export API.
+*/
 function exportCSV() {
-  var queryStr = 'MATCH (user:Username)-[event:Event]-(ip:IPAddress) RETURN user, ip, event';
-  var events = new Array();
-
-  session.run(queryStr)
-    .subscribe({
-      onNext: function(record) {
-        eventData = record.get("event");
-        userData = record.get("user");
-        ipData = record.get("ip");
-        events.push([userData.properties.user, ipData.properties.IP,
-          eventData.properties.id, eventData.properties.logintype,
-          eventData.properties.status, eventData.properties.count,
-          eventData.properties.authname
-        ]);
-      },
-      onCompleted: function() {
-        session.close();
-        var rowData = "username,host,id,logontype,status,count,authname\r\n";
-        for (i = 0; i < events.length; i++) {
-          rowData += events[i][0] + ",";
-          rowData += events[i][1] + ",";
-          rowData += events[i][2] + ",";
-          rowData += events[i][3] + ",";
-          rowData += events[i][4] + ",";
-          rowData += events[i][5] + ",";
-          rowData += events[i][6] + "\r\n";
-        }
-        var downLoadLink = document.createElement("a");
-        downLoadLink.download = "image.csv";
-        downLoadLink.href = URL.createObjectURL(new Blob([rowData], {
-          type: "application.csv"
-        }));
-        downLoadLink.dataset.downloadurl = ["application/csv", downLoadLink.download, downLoadLink.href].join(":");
-        downLoadLink.click();
-      },
-      onError: function(error) {
-        console.log("Error: ", error);
-      }
-    });
+  var downLoadLink = document.createElement("a");
+  downLoadLink.download = "image.csv";
+  downLoadLink.href = "api/export.csv";
+  downLoadLink.click();
 }
 
 function exportJSON() {
@@ -942,75 +964,90 @@ function exportJPEG() {
   exptag.href = jpg64;
 }
 
+/*
+loadTimeline
+This function reads the timelines of the users in the selected window from the timeline API.
+*/
+function loadTimeline(users, callback) {
+  var params = {
+    "user": users,
+    "from": document.getElementById("timeline-from").value,
+    "to": document.getElementById("timeline-to").value,
+    "resolution": document.getElementById("timeline-resolution").value
+  };
+
+  fetch('api/timeline?' + $.param(params, true))
+    .then(function(response) {
+      if (!response.ok) {
+        throw new Error(response.statusText);
+      }
+      return response.json();
+    })
+    .then(callback)
+    .catch(function(error) {
+      searchError();
+      console.log("Error: ", error);
+    });
+}
+
+/*
+timelineDates
+This function returns the start date of each bucket of the timeline.
+*/
+function timelineDates(data) {
+  var dates = new Array();
+  var bucketDate = new Date(data.start.replace(" ", "T"));
+  for (i = 0; i < data.buckets; i++) {
+    dates.push(new Date(bucketDate.getTime()));
+    if (data.resolution == "hour") {
+      bucketDate.setHours(bucketDate.getHours() + 1);
+    } else if (data.resolution == "day") {
+      bucketDate.setDate(bucketDate.getDate() + 1);
+    } else {
+      bucketDate.setDate(bucketDate.getDate() + 7);
+    }
+  }
+  return dates;
+}
+
 function downloadCSV(csvType) {
-  var queryStr = 'MATCH (date:Date) MATCH (user:Username) RETURN date, user';
-  var users = new Array();
-
-  session.run(queryStr)
-    .subscribe({
-      onNext: function(record) {
-        nodeData = record.get("user");
-        dateData = record.get("date");
-        users.push([nodeData.properties.user, nodeData.properties.counts,
-          nodeData.properties.counts4624, nodeData.properties.counts4625,
-          nodeData.properties.counts4768, nodeData.properties.counts4769,
-          nodeData.properties.counts4776
-        ]);
-        starttime = dateData.properties.start;
-        endtime = dateData.properties.end;
-      },
-      onCompleted: function() {
-        session.close();
-
-        var startDate = new Date(starttime);
-        var rangeHours = Math.floor((Date.parse(endtime) - Date.parse(starttime)) / (1000 * 60 * 60)) + 1;
-        var rawDate = "username,";
-        if (csvType == "detail") {
-          rawDate += "id,";
-        }
-        var countData = "";
-        for (i = 0; i < rangeHours; i++) {
-          rawDate += startDate.toISOString() + ",";
-          startDate.setHours(startDate.getHours() + 1);
-        }
+  loadTimeline([], function(data) {
+    var dates = timelineDates(data);
+    var rawDate = "username,";
+    if (csvType == "detail") {
+      rawDate += "id,";
+    }
+    var countData = "";
+    for (i = 0; i < dates.length; i++) {
+      rawDate += dates[i].toISOString() + ",";
+    }
 
-        if (csvType == "summary") {
-          for (i = 0; i < users.length; i++) {
-            countData += users[i][0] + "," + users[i][1] + "\r\n";
-          }
-        } else if (csvType == "detail") {
-          for (i = 0; i < users.length; i++) {
-            countData += users[i][0];
-            for (j = 2; j <= 6; j++) {
-              if (j == 2) {
-                countData += ",4624,";
-              } else if (j == 3) {
-                countData += ",4625,";
-              } else if (j == 4) {
-                countData += ",4768,";
-              } else if (j == 5) {
-                countData += ",4769,";
-              } else if (j == 6) {
-                countData += ",4776,";
-              }
-              countData += users[i][j] + "\r\n";
-            }
-          }
+    var eventIDs = [4624, 4625, 4768, 4769, 4776];
+    for (i = 0; i < data.users.length; i++) {
+      var counts = data.users[i][2];
+      if (csvType == "summary") {
+        var total = new Array();
+        for (j = 0; j < data.buckets; j++) {
+          total.push(counts[0][j] + counts[1][j] + counts[2][j] + counts[3][j] + counts[4][j]);
+        }
+        countData += data.users[i][0] + "," + total.join(",") + "\r\n";
+      } else if (csvType == "detail") {
+        countData += data.users[i][0];
+        for (j = 0; j < eventIDs.length; j++) {
+          countData += "," + eventIDs[j] + "," + counts[j].join(",") + "\r\n";
         }
-
-        rawDate += "\r\n" + countData
-        var downLoadLink = document.createElement("a");
-        downLoadLink.download = "timeline.csv";
-        downLoadLink.href = URL.createObjectURL(new Blob([rawDate], {
-          type: "application.csv"
-        }));
-        downLoadLink.dataset.downloadurl = ["application/csv", downLoadLink.download, downLoadLink.href].join(":");
-        downLoadLink.click();
-      },
-      onError: function(error) {
-        console.log("Error: ", error);
       }
-    });
+    }
+
+    rawDate += "\r\n" + countData
+    var downLoadLink = document.createElement("a");
+    downLoadLink.download = "timeline.csv";
+    downLoadLink.href = URL.createObjectURL(new Blob([rawDate], {
+      type: "application.csv"
+    }));
+    downLoadLink.dataset.downloadurl = ["application/csv", downLoadLink.download, downLoadLink.href].join(":");
+    downLoadLink.click();
+  });
 }
 
 function downloadSummary() {
@@ -1021,21 +1058,47 @@ function downloadDetail() {
   downloadCSV("detail");
 }
 
-function createTimeline(queryStr, tableType) {
-  var users = new Array();
-  var starttime = "";
-  var endtime = "";
-  var weekTbl = new Array("Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat");
-  var bgcolorTbl = new Array("#ff7f50", "#efefef", "#efefef", "#efefef", "#efefef", "#efefef", "#b0c4de");
-
-  if (tableType == "all") {
-    var span = 'rowspan = "4"';
+/*
+timelineHeader
+This function returns the header cells that join the buckets with the same label into one cell.
+*/
+function timelineHeader(dates, label, color) {
+  var html = "";
+  var span = 0;
+  for (i = 0; i < dates.length; i++) {
+    span += 1;
+    if (i == dates.length - 1 || label(dates[i + 1]) != label(dates[i])) {
+      if (color) {
+        html += '<th bgcolor="' + color(dates[i]) + '" colspan="' + span + '">' + label(dates[i]) + '</th>';
+      } else {
+        html += '<th colspan="' + span + '">' + label(dates[i]) + '</th>';
+      }
+      span = 0;
+    }
   }
-  if (tableType == "search") {
-    var span = 'rowspan = "4" colspan="2"';
+  return html;
+}
+
+/*
+timelineCell
+This function draws one count of the timeline table in the color of its anomaly score.
+*/
+function timelineCell(count, score) {
+  if (score > 17) {
+    return '<td bgcolor="#ff5aee">' + count + '</td>';
+  } else if (score > 16) {
+    return '<td bgcolor="#ff8aee">' + count + '</td>';
+  } else if (score > 13) {
+    return '<td bgcolor="#ffbaee">' + count + '</td>';
+  } else if (score > 10) {
+    return '<td bgcolor="#ffeaee">' + count + '</td>';
   }
-  var html = '<div class="table-responsive"><table class="table table-bordered table-condensed table-striped table-wrapper" style="background-color:#EEE;"><thead><tr>\
-                    <th ' + span + '>Username</th>';
+  return '<td>' + count + '</td>';
+}
+
+function createTimeline(users, tableType) {
+  var weekTbl = new Array("Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat");
+  var bgcolorTbl = new Array("#ff7f50", "#efefef", "#efefef", "#efefef", "#efefef", "#efefef", "#b0c4de");
 
   for (i = 0; i < chartArray.length; i++) {
     if (chartArray[i]) {
@@ -1043,326 +1106,231 @@ function createTimeline(queryStr, tableType) {
     }
   }
 
-  session.run(queryStr)
-    .subscribe({
-      onNext: function(record) {
-        dateData = record.get("date");
-        nodeData = record.get("user");
-        users.push([nodeData.properties.user, nodeData.properties.counts, nodeData.properties.detect, nodeData.properties.rights, nodeData.properties.counts4624,
-          nodeData.properties.counts4625, nodeData.properties.counts4768, nodeData.properties.counts4769, nodeData.properties.counts4776
-        ]);
-        starttime = dateData.properties.start;
-        endtime = dateData.properties.end;
-      },
-      onCompleted: function() {
-        session.close();
-        var startDate = new Date(starttime);
-        var rangeHours = Math.floor((Date.parse(endtime) - Date.parse(starttime)) / (1000 * 60 * 60)) + 1;
-        var thisyear = startDate.getFullYear();
-        var thismonth = startDate.getMonth();
-        var thisday = startDate.getDate();
-        var thishour = startDate.getHours();
-        var thisdow = startDate.getDay();
-        var nextyear = null;
-        var nrangeHours = 0;
-        var weekd = 0;
-        for (i = 1; i <= rangeHours; i++) {
-          startDate.setHours(startDate.getHours() + 1);
-          if (startDate.getFullYear() != thisyear) {
-            html += '<th colspan="' + (i - nrangeHours) + '">' + thisyear + '</th>';
-            thisyear = startDate.getFullYear();
-            nrangeHours = i;
-          }
-        }
-        html += '<th colspan="' + (rangeHours - nrangeHours) + '">' + thisyear + '</th></tr><tr>';
-
-        nrangeHours = 0;
-        startDate = new Date(starttime);
-        for (i = 1; i <= rangeHours; i++) {
-          startDate.setHours(startDate.getHours() + 1);
-          if (startDate.getMonth() != thismonth) {
-            html += '<th colspan="' + (i - nrangeHours) + '">' + (thismonth + 1) + '</th>';
-            thismonth = startDate.getMonth();
-            nrangeHours = i;
-          }
-        }
-        html += '<th colspan="' + (rangeHours - nrangeHours) + '">' + (thismonth + 1) + '</th></tr><tr>';
-
-        nrangeHours = 0;
-        startDate = new Date(starttime);
-        for (i = 1; i <= rangeHours; i++) {
-          startDate.setHours(startDate.getHours() + 1);
-          if (startDate.getDate() != thisday) {
-            html += '<th bgcolor="' + bgcolorTbl[thisdow + weekd] + '" colspan="' + (i - nrangeHours) + '">' + thisday + '(' + weekTbl[thisdow + weekd] + ')</th>';
-            if (thisdow + weekd >= 6) {
-              thisdow = 0 - (weekd + 1);
-            }
-            thisday = startDate.getDate();
-            nrangeHours = i;
-            weekd += 1;
-          }
-        }
-        html += '<th bgcolor="' + bgcolorTbl[thisdow + weekd] + '" colspan="' + (rangeHours - nrangeHours) + '">' + thisday + '(' + weekTbl[thisdow + weekd] + ')</th></tr><tr>';
+  loadTimeline(users, function(data) {
+    var dates = timelineDates(data);
+    var rows = 3;
+    if (data.resolution == "hour") {
+      rows = 4;
+    }
+    if (tableType == "all") {
+      var span = 'rowspan = "' + rows + '"';
+    }
+    if (tableType == "search") {
+      var span = 'rowspan = "' + rows + '" colspan="2"';
+    }
+    var html = '<div class="table-responsive"><table class="table table-bordered table-condensed table-striped table-wrapper" style="background-color:#EEE;"><thead><tr>\
+                    <th ' + span + '>Username</th>';
 
-        for (i = 0; i < rangeHours; i++) {
-          html += '<th>' + thishour + '</th>';
-          thishour += 1;
-          if (thishour >= 24) {
-            thishour = 0;
-          }
-        }
+    html += timelineHeader(dates, function(date) {
+      return date.getFullYear();
+    });
+    html += '</tr><tr>' + timelineHeader(dates, function(date) {
+      return date.getMonth() + 1;
+    });
+    html += '</tr><tr>' + timelineHeader(dates, function(date) {
+      return date.getDate() + '(' + weekTbl[date.getDay()] + ')';
+    }, function(date) {
+      return bgcolorTbl[date.getDay()];
+    });
+    if (data.resolution == "hour") {
+      html += '</tr><tr>' + timelineHeader(dates, function(date) {
+        return date.getHours();
+      });
+    }
 
-        html += '</tr></thead><tbody>';
+    html += '</tr></thead><tbody>';
 
-        if (tableType == "all") {
-          for (i = 0; i < users.length; i++) {
-            if (users[i][3] == "system") {
-              html += '<tr><td><a onclick="clickTimeline(\'' + users[i][0] + '\')"><font color="#ff7f50">' + users[i][0] + '</font></a></td>';
-            } else {
-              html += '<tr><td><a onclick="clickTimeline(\'' + users[i][0] + '\')">' + users[i][0] + '</a></td>';
-            }
-            rowdata = users[i][1].split(",");
-            alerts = users[i][2].split(",");
-            for (j = 0; j < rowdata.length; j++) {
-              if (alerts[j] > 17) {
-                html += '<td bgcolor="#ff5aee">' + rowdata[j].split(".")[0] + '</td>';
-              } else if (alerts[j] > 16) {
-                html += '<td bgcolor="#ff8aee">' + rowdata[j].split(".")[0] + '</td>';
-              } else if (alerts[j] > 13) {
-                html += '<td bgcolor="#ffbaee">' + rowdata[j].split(".")[0] + '</td>';
-              } else if (alerts[j] > 10) {
-                html += '<td bgcolor="#ffeaee">' + rowdata[j].split(".")[0] + '</td>';
-              } else {
-                html += '<td>' + rowdata[j].split(".")[0] + '</td>';
-              }
-            }
-            html += '</tr>';
-          }
-        }
+    for (i = 0; i < data.users.length; i++) {
+      var user = data.users[i];
+      if (tableType == "all") {
+        var userSpan = '';
+      }
+      if (tableType == "search") {
+        var userSpan = ' rowspan = "5"';
+      }
+      if (user[1] == "system") {
+        html += '<tr><td' + userSpan + '><a onclick="clickTimeline(\'' + user[0] + '\')"><font color="#ff7f50">' + user[0] + '</font></a></td>';
+      } else {
+        html += '<tr><td' + userSpan + '><a onclick="clickTimeline(\'' + user[0] + '\')">' + user[0] + '</a></td>';
+      }
 
-        if (tableType == "search") {
-          for (i = 0; i < users.length; i++) {
-            if (users[i][3] == "system") {
-              html += '<tr><td rowspan = "5"><a onclick="clickTimeline(\'' + users[i][0] + '\')"><font color="#ff7f50">' + users[i][0] + '</font></a></td>';
-            } else {
-              html += '<tr><td rowspan = "5"><a onclick="clickTimeline(\'' + users[i][0] + '\')">' + users[i][0] + '</a></td>';
-            }
+      if (tableType == "all") {
+        for (j = 0; j < data.buckets; j++) {
+          html += timelineCell(user[2][0][j] + user[2][1][j] + user[2][2][j] + user[2][3][j] + user[2][4][j], user[3][j]);
+        }
+        html += '</tr>';
+      }
 
-            for (j = 4; j <= 8; j++) {
-              rowdata = users[i][j].split(",");
-              alerts = users[i][2].split(",");
-              if (j == 4) {
-                html += '<td>4624</td>';
-              } else if (j == 5) {
-                html += '<td>4625</td>';
-              } else if (j == 6) {
-                html += '<td>4768</td>';
-              } else if (j == 7) {
-                html += '<td>4769</td>';
-              } else if (j == 8) {
-                html += '<td>4776</td>';
-              }
-              for (k = 0; k < rowdata.length; k++) {
-                if (alerts[k] > 17) {
-                  html += '<td bgcolor="#ff5aee">' + rowdata[k].split(".")[0] + '</td>';
-                } else if (alerts[k] > 16) {
-                  html += '<td bgcolor="#ff8aee">' + rowdata[k].split(".")[0] + '</td>';
-                } else if (alerts[k] > 13) {
-                  html += '<td bgcolor="#ffbaee">' + rowdata[k].split(".")[0] + '</td>';
-                } else if (alerts[k] > 10) {
-                  html += '<td bgcolor="#ffeaee">' + rowdata[k].split(".")[0] + '</td>';
-                } else {
-                  html += '<td>' + rowdata[k].split(".")[0] + '</td>';
-                }
-              }
-              html += '</tr>';
-            }
+      if (tableType == "search") {
+        var eventIDs = [4624, 4625, 4768, 4769, 4776];
+        for (j = 0; j < eventIDs.length; j++) {
+          if (j > 0) {
+            html += '<tr>';
           }
+          html += '<td>' + eventIDs[j] + '</td>';
+          for (k = 0; k < data.buckets; k++) {
+            html += timelineCell(user[2][j][k], user[3][k]);
+          }
+          html += '</tr>';
         }
-        html += '</tbody></table></div>';
+      }
+    }
+    html += '</tbody></table></div>';
 
-        var timelineElem = document.getElementById("cy");
-        timelineElem.innerHTML = html;
+    var timelineElem = document.getElementById("cy");
+    timelineElem.innerHTML = html;
 
-        $(function() {
-          $(".table.table-wrapper").floatThead({
-            responsiveContainer: function($table) {
-              return $table.closest(".table-responsive");
-            }
-          });
-        });
-      },
-      onError: function(error) {
-        searchError();
-        console.log("Error: ", error);
-      }
+    $(function() {
+      $(".table.table-wrapper").floatThead({
+        responsiveContainer: function($table) {
+          return $table.closest(".table-responsive");
+        }
+      });
     });
+  });
 }
 
 var chartArray = new Array();
 
-function createTimelineGraph(queryStr) {
-  var users = new Array();
-  var dates = new Array();
-  var starttime = "";
-  var endtime = "";
-
-  session.run(queryStr)
-    .subscribe({
-      onNext: function(record) {
-        dateData = record.get("date");
-        nodeData = record.get("user");
-        users.push([nodeData.properties.user, nodeData.properties.counts4624, nodeData.properties.counts4625, nodeData.properties.counts4768,
-          nodeData.properties.counts4769, nodeData.properties.counts4776, nodeData.properties.detect
-        ]);
-        starttime = dateData.properties.start;
-        endtime = dateData.properties.end;
-      },
-      onCompleted: function() {
-        session.close();
-        var canvasArray = addCanvas(users);
-        var startDate = new Date(starttime);
-        var rangeHours = Math.floor((Date.parse(endtime) - Date.parse(starttime)) / (1000 * 60 * 60)) + 1;
-        for (i = 1; i <= rangeHours; i++) {
-          startDate.setHours(startDate.getHours() + 1);
-          dates.push(formatDate(startDate))
-        }
+function createTimelineGraph(users) {
+  loadTimeline(users, function(data) {
+    var canvasArray = addCanvas(data.users);
+    var dates = new Array();
+    var bucketDates = timelineDates(data);
+    for (i = 0; i < bucketDates.length; i++) {
+      dates.push(formatDate(bucketDates[i]));
+    }
 
-        for (i = 0; i < users.length; i++) {
-          var ctx = canvasArray[i].getContext("2d");
-          chartArray[i] = new Chart(ctx, {
-            type: "line",
-            data: {
-              labels: dates,
-              datasets: [{
-                  label: "4624",
-                  borderColor: "rgb(141, 147, 200)",
-                  backgroundColor: "rgb(141, 147, 200)",
-                  pointHoverBorderColor: "rgb(255, 0, 0)",
-                  lineTension: 0,
-                  fill: false,
-                  data: users[i][1].split(","),
-                  pointRadius: 5,
-                  pointHoverRadius: 10,
-                },
-                {
-                  label: "4625",
-                  borderColor: "rgb(89, 195, 225)",
-                  backgroundColor: "rgb(89, 195, 225)",
-                  pointHoverBorderColor: "rgb(255, 0, 0)",
-                  lineTension: 0,
-                  fill: false,
-                  data: users[i][2].split(","),
-                  pointRadius: 5,
-                  pointHoverRadius: 10,
-                },
-                {
-                  label: "4768",
-                  borderColor: "rgb(30, 44, 92)",
-                  backgroundColor: "rgb(30, 44, 92)",
-                  pointHoverBorderColor: "rgb(255, 0, 0)",
-                  lineTension: 0,
-                  fill: false,
-                  data: users[i][3].split(","),
-                  pointRadius: 5,
-                  pointHoverRadius: 10,
-                },
-                {
-                  label: "4769",
-                  borderColor: "rgb(1, 96, 140)",
-                  backgroundColor: "rgb(1, 96, 140)",
-                  pointHoverBorderColor: "rgb(255, 0, 0)",
-                  lineTension: 0,
-                  fill: false,
-                  data: users[i][4].split(","),
-                  pointRadius: 5,
-                  pointHoverRadius: 10,
-                },
-                {
-                  label: "4776",
-                  borderColor: "rgb(0, 158, 150)",
-                  backgroundColor: "rgb(0, 158, 150)",
-                  pointHoverBorderColor: "rgb(255, 0, 0)",
-                  lineTension: 0,
-                  fill: false,
-                  data: users[i][5].split(","),
-                  pointRadius: 5,
-                  pointHoverRadius: 10,
-                },
-                {
-                  label: "Anomaly Score",
-                  borderColor: "rgb(230, 0, 57)",
-                  backgroundColor: "rgb(230, 0, 57)",
-                  pointHoverBorderColor: "rgb(255, 0, 0)",
-                  lineTension: 0,
-                  fill: false,
-                  data: users[i][6].split(","),
-                  pointRadius: 5,
-                  pointHoverRadius: 10,
-                  yAxisID: "y-right",
-                },
-              ]
+    for (i = 0; i < data.users.length; i++) {
+      var ctx = canvasArray[i].getContext("2d");
+      chartArray[i] = new Chart(ctx, {
+        type: "line",
+        data: {
+          labels: dates,
+          datasets: [{
+              label: "4624",
+              borderColor: "rgb(141, 147, 200)",
+              backgroundColor: "rgb(141, 147, 200)",
+              pointHoverBorderColor: "rgb(255, 0, 0)",
+              lineTension: 0,
+              fill: false,
+              data: data.users[i][2][0],
+              pointRadius: 5,
+              pointHoverRadius: 10,
+            },
+            {
+              label: "4625",
+              borderColor: "rgb(89, 195, 225)",
+              backgroundColor: "rgb(89, 195, 225)",
+              pointHoverBorderColor: "rgb(255, 0, 0)",
+              lineTension: 0,
+              fill: false,
+              data: data.users[i][2][1],
+              pointRadius: 5,
+              pointHoverRadius: 10,
+            },
+            {
+              label: "4768",
+              borderColor: "rgb(30, 44, 92)",
+              backgroundColor: "rgb(30, 44, 92)",
+              pointHoverBorderColor: "rgb(255, 0, 0)",
+              lineTension: 0,
+              fill: false,
+              data: data.users[i][2][2],
+              pointRadius: 5,
+              pointHoverRadius: 10,
+            },
+            {
+              label: "4769",
+              borderColor: "rgb(1, 96, 140)",
+              backgroundColor: "rgb(1, 96, 140)",
+              pointHoverBorderColor: "rgb(255, 0, 0)",
+              lineTension: 0,
+              fill: false,
+              data: data.users[i][2][3],
+              pointRadius: 5,
+              pointHoverRadius: 10,
             },
-            options: {
-              responsive: true,
-              legend: {
-                position: "bottom",
+            {
+              label: "4776",
+              borderColor: "rgb(0, 158, 150)",
+              backgroundColor: "rgb(0, 158, 150)",
+              pointHoverBorderColor: "rgb(255, 0, 0)",
+              lineTension: 0,
+              fill: false,
+              data: data.users[i][2][4],
+              pointRadius: 5,
+              pointHoverRadius: 10,
+            },
+            {
+              label: "Anomaly Score",
+              borderColor: "rgb(230, 0, 57)",
+              backgroundColor: "rgb(230, 0, 57)",
+              pointHoverBorderColor: "rgb(255, 0, 0)",
+              lineTension: 0,
+              fill: false,
+              data: data.users[i][3],
+              pointRadius: 5,
+              pointHoverRadius: 10,
+              yAxisID: "y-right",
+            },
+          ]
+        },
+        options: {
+          responsive: true,
+          legend: {
+            position: "bottom",
+            fontSize: 15,
+          },
+          scales: {
+            xAxes: [{
+              display: true,
+              scaleLabel: {
+                display: true,
                 fontSize: 15,
-              },
-              scales: {
-                xAxes: [{
+                labelString: "Date"
+              }
+            }],
+            yAxes: [{
+                display: true,
+                scaleLabel: {
                   display: true,
-                  scaleLabel: {
-                    display: true,
-                    fontSize: 15,
-                    labelString: "Date"
-                  }
-                }],
-                yAxes: [{
-                    display: true,
-                    scaleLabel: {
-                      display: true,
-                      fontSize: 15,
-                      labelString: "Count"
-                    }
-                  },
-                  {
-                    display: true,
-                    id: "y-right",
-                    position: "right",
-                    scaleLabel: {
-                      display: true,
-                      fontSize: 15,
-                      labelString: "Score"
-                    },
-                    ticks: {
-                      max: 20
-                    }
-                  }
-                ]
+                  fontSize: 15,
+                  labelString: "Count"
+                }
               },
-              title: {
+              {
                 display: true,
-                fontSize: 18,
-                text: users[i][0]
-              },
-              elements: {
-                point: {
-                  pointStyle: "crossRot"
+                id: "y-right",
+                position: "right",
+                scaleLabel: {
+                  display: true,
+                  fontSize: 15,
+                  labelString: "Score"
+                },
+                ticks: {
+                  max: 20
                 }
               }
+            ]
+          },
+          title: {
+            display: true,
+            fontSize: 18,
+            text: data.users[i][0]
+          },
+          elements: {
+            point: {
+              pointStyle: "crossRot"
             }
-          });
+          }
         }
+      });
+    }
 
-        var timelineElem = document.getElementById("cy");
-        timelineElem.innerHTML = "";
-      },
-      onError: function(error) {
-        searchError();
-        console.log("Error: ", error);
-      }
-    });
+    var timelineElem = document.getElementById("cy");
+    timelineElem.innerHTML = "";
+  });
 }
 
 function addCanvas(users) {
@@ -1383,47 +1351,40 @@ function addCanvas(users) {
 }
 
 function createAlltimeline() {
-  var queryStr = 'MATCH (date:Date) MATCH (user:Username) RETURN date, user';
-  createTimeline(queryStr, "all");
+  createTimeline([], "all");
 }
 
 function searchTimeline() {
   var selectVal = document.getElementById("InputSelect").value;
-  var setStr = document.getElementById("query-input").value;
+  var users = [document.getElementById("query-input").value];
 
-  if (selectVal == "Username") {
-    whereStr = 'user.user =~ "' + setStr + '" ';
-  } else {
+  if (selectVal != "Username") {
     searchError();
   }
 
   for (i = 1; i <= currentNumber; i++) {
     if (document.getElementById("query-input" + i).value) {
       if (document.getElementById("InputSelect" + i).value == "Username") {
-        whereStr += 'or user.user =~ "' + document.getElementById("query-input" + i).value + '" ';
+        users.push(document.getElementById("query-input" + i).value);
       } else {
         searchError();
       }
     }
   }
-  var queryStr = 'MATCH (date:Date) MATCH (user:Username) WHERE (' + whereStr + ') RETURN date, user';
   var gtype = document.getElementById("timelineTypes").checked;
   if (gtype) {
-    createTimeline(queryStr, "search");
+    createTimeline(users, "search");
   } else {
-    createTimelineGraph(queryStr);
+    createTimelineGraph(users);
   }
 }
 
 function clickTimeline(setStr) {
-  whereStr = 'user.user =~ "' + setStr + '" ';
-
-  var queryStr = 'MATCH (date:Date) MATCH (user:Username) WHERE (' + whereStr + ') RETURN date, user';
   var gtype = document.getElementById("timelineTypes").checked;
   if (gtype) {
-    createTimeline(queryStr, "search");
+    createTimeline([setStr], "search");
   } else {
-    createTimelineGraph(queryStr);
+    createTimelineGraph([setStr]);
   }
 }
 
@@ -1432,31 +1393,24 @@ logdeleteCheck
 push alert if the event log had deleted.
 */
 function logdeleteCheck() {
-  var queryStr = "MATCH (date:Deletetime) RETURN date";
-  var ddata = "";
-
-  session.run(queryStr)
-    .subscribe({
-      onNext: function(record) {
-        ddata = record.get("date");
-      },
-      onCompleted: function() {
-        session.close();
-        if (ddata.length != 0) {
-          delDate = ddata.properties.date;
-          delDomain = ddata.properties.domain;
-          delUser = ddata.properties.user;
-
-          var elemMsg = document.getElementById("error");
-          elemMsg.innerHTML =
-            '<div class="alert alert-danger alert-dismissible" id="alertfadeout" role="alert"><button type="button" class="close" data-dismiss="alert" aria-label="close">\
-            <span aria-hidden="true">×</span></button><strong>IMPORTANT</strong>: Delete Event Log has detected! If you have not deleted the event log, the attacker may have deleted it.\
-            <br>DATE: ' + delDate + '  DOMAIN: ' + delDomain + '  USERNAME: ' + delUser + '</div>';
-        }
-      },
-      onError: function(error) {
-        console.log("Error: ", error);
+  fetch('api/deletetime')
+    .then(function(response) {
+      if (!response.ok) {
+        throw new Error(response.statusText);
+      }
+      return response.json();
+    })
+    .then(function(ddata) {
+      if (ddata.date) {
+        var elemMsg = document.getElementById("error");
+        elemMsg.innerHTML =
+          '<div class="alert alert-danger alert-dismissible" id="alertfadeout" role="alert"><button type="button" class="close" data-dismiss="alert" aria-label="close">\
+          <span aria-hidden="true">×</span></button><strong>IMPORTANT</strong>: Delete Event Log has detected! If you have not deleted the event log, the attacker may have deleted it.\
+          <br>DATE: ' + ddata.date + '  DOMAIN: ' + ddata.domain + '  USERNAME: ' + ddata.user + '</div>';
       }
+    })
+    .catch(function(error) {
+      console.log("Error: ", error);
     });
 }
 
@@ -1496,6 +1450,7 @@ function file_upload() {
     }
     formData.append("timezone", timezone);
     formData.append("logtype", logtype);
+    formData.append("incremental", document.getElementById("incremental").checked);
     var xmlhttp = new XMLHttpRequest();
     xmlhttp.upload.addEventListener("progress", progressHandler, false);
     xmlhttp.addEventListener("load", completeHandler, false);
@@ -1574,70 +1529,68 @@ function parseEVTX() {
 
 /*
 loaddate
-load date info from neo4j
+load date info from the date range API
 */
 function loaddate() {
-  var queryStr = 'MATCH (date:Date) RETURN date';
-
-  session.run(queryStr)
-    .subscribe({
-      onNext: function(record) {
-        dateData = record.get("date");
-        starttime = dateData.properties.start;
-        endtime = dateData.properties.end;
-      },
-      onCompleted: function() {
-        session.close();
-        var minDate = new Date(starttime);
-        var maxDate = new Date(endtime);
-        maxDate.setTime(maxDate.getTime() + 3600000);
-
-        var minDay = new Date(starttime);
-        var maxDay = new Date(endtime);
-        var setminDate = new Date(minDay.getFullYear(), minDay.getMonth(), minDay.getDate())
-        minDay.setTime(setminDate.getTime());
-        var setmaxDate = new Date(maxDay.getFullYear(), maxDay.getMonth(), maxDay.getDate())
-        maxDay.setTime(setmaxDate.getTime());
-
-        $('.fromdate').datetimepicker({
-          locale: "en",
-          format: "YYYY-MM-DD HH:00:00",
-          useCurrent: false,
-          defaultDate: minDate,
-          maxDate: maxDate,
-          minDate: minDate
-        });
+  fetch('api/daterange')
+    .then(function(response) {
+      if (!response.ok) {
+        throw new Error(response.statusText);
+      }
+      return response.json();
+    })
+    .then(function(dateData) {
+      var starttime = dateData.start;
+      var endtime = dateData.end;
+      var minDate = new Date(starttime);
+      var maxDate = new Date(endtime);
+      maxDate.setTime(maxDate.getTime() + 3600000);
+
+      var minDay = new Date(starttime);
+      var maxDay = new Date(endtime);
+      var setminDate = new Date(minDay.getFullYear(), minDay.getMonth(), minDay.getDate())
+      minDay.setTime(setminDate.getTime());
+      var setmaxDate = new Date(maxDay.getFullYear(), maxDay.getMonth(), maxDay.getDate())
+      maxDay.setTime(setmaxDate.getTime());
+
+      $('.fromdate').datetimepicker({
+        locale: "en",
+        format: "YYYY-MM-DD HH:00:00",
+        useCurrent: false,
+        defaultDate: minDate,
+        maxDate: maxDate,
+        minDate: minDate
+      });
 
-        $('.todate').datetimepicker({
-          locale: "en",
-          format: "YYYY-MM-DD HH:00:00",
-          useCurrent: false,
-          defaultDate: maxDate,
-          maxDate: maxDate,
-          minDate: minDate
-        });
+      $('.todate').datetimepicker({
+        locale: "en",
+        format: "YYYY-MM-DD HH:00:00",
+        useCurrent: false,
+        defaultDate: maxDate,
+        maxDate: maxDate,
+        minDate: minDate
+      });
 
-        $('.fromday').datetimepicker({
-          locale: "en",
-          format: "YYYY-MM-DD",
-          useCurrent: false,
-          defaultDate: minDay,
-          maxDate: maxDay,
-          minDate: minDay
-        });
+      $('.fromday').datetimepicker({
+        locale: "en",
+        format: "YYYY-MM-DD",
+        useCurrent: false,
+        defaultDate: minDay,
+        maxDate: maxDay,
+        minDate: minDay
+      });
 
-        $('.today').datetimepicker({
-          locale: "en",
-          format: "YYYY-MM-DD",
-          useCurrent: false,
-          defaultDate: maxDay,
-          maxDate: maxDay,
-          minDate: minDay
-        });
-      },
-      onError: function(error) {
-        console.log("Error: ", error);
-      }
+      $('.today').datetimepicker({
+        locale: "en",
+        format: "YYYY-MM-DD",
+        useCurrent: false,
+        defaultDate: maxDay,
+        maxDate: maxDay,
+        minDate: minDay
+      });
+    })
+    .catch(function(error) {
+      console.log("Error: ", error);
     });
 }
 